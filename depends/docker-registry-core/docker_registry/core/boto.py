@@ -26,11 +26,26 @@ Might be useful for
 
 """
 
+from __future__ import absolute_import
+
 import gevent.monkey
 gevent.monkey.patch_all()
 
+import gevent
+import gevent.lock
+import gevent.pool
+
+import calendar
+import collections
+import contextlib
+import email.utils
+import functools
+import itertools
 import logging
 import os
+import time
+
+import boto.exception
 
 from . import driver
 from . import lru
@@ -38,19 +53,160 @@ from .exceptions import FileNotFoundError
 
 logger = logging.getLogger(__name__)
 
+# Sentinel for batched calls that hit a missing key
+_missing = object()
+
+
+class ConnectionPool(object):
+
+    """Pool of boto connections, each with its own bucket handle.
+
+    `factory` returns a new bucket (bound to a new connection). A greenlet
+    holds at most one of them: nested checkouts reuse it. Idle buckets are
+    reused most recent first, so their HTTP connections are kept alive;
+    those idle for more than `max_idle` seconds, or whose holder failed
+    with a network error, are dropped and replaced.
+    """
+
+    def __init__(self, factory, size=32, max_idle=60):
+        self._factory = factory
+        self._size = size
+        self._max_idle = max_idle
+        self._slots = gevent.lock.BoundedSemaphore(size)
+        # (bucket, last used) pairs, oldest first
+        self._idle = collections.deque()
+        # greenlet -> [bucket, nested checkouts]
+        self._held = {}
+        self._waiting = 0
+        self._counters = dict.fromkeys(
+            ['created', 'reused', 'recycled', 'broken', 'waits'], 0)
+
+    def current(self):
+        """Bucket held by the current greenlet, or None."""
+        held = self._held.get(gevent.getcurrent())
+        return held[0] if held else None
+
+    @contextlib.contextmanager
+    def connection(self):
+        current = gevent.getcurrent()
+        held = self._held.get(current)
+        if held is not None:
+            held[1] += 1
+            try:
+                yield held[0]
+            finally:
+                held[1] -= 1
+            return
+        bucket = self._checkout()
+        self._held[current] = [bucket, 1]
+        healthy = True
+        try:
+            yield bucket
+        except IOError:
+            # Socket level failure, don't hand that connection out again
+            healthy = False
+            raise
+        finally:
+            del self._held[current]
+            self._checkin(bucket, healthy)
+
+    def _checkout(self):
+        if self._slots.locked():
+            self._counters['waits'] += 1
+            logger.debug('boto connection pool exhausted ({0} in use), '
+                         'waiting'.format(self._size))
+        self._waiting += 1
+        try:
+            self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        now = time.time()
+        while self._idle and now - self._idle[0][1] > self._max_idle:
+            self._idle.popleft()
+            self._counters['recycled'] += 1
+        if self._idle:
+            self._counters['reused'] += 1
+            return self._idle.pop()[0]
+        try:
+            bucket = self._factory()
+        except Exception:
+            self._slots.release()
+            raise
+        self._counters['created'] += 1
+        return bucket
+
+    def _checkin(self, bucket, healthy):
+        if healthy:
+            self._idle.append((bucket, time.time()))
+        else:
+            self._counters['broken'] += 1
+        self._slots.release()
+
+    def stats(self):
+        """Pool usage, `waiting` and `waits` telling about saturation."""
+        stats = dict(self._counters)
+        stats.update(size=self._size, in_use=len(self._held),
+                     idle=len(self._idle), waiting=self._waiting)
+        return stats
+
+
+def pooled(f):
+    """Run a driver method with a pooled connection held by the greenlet.
+
+    Within it, `_boto_bucket` is the bucket of that connection. Not for
+    generators: the connection would be released before they run.
+    """
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self._pool.connection():
+            return f(self, *args, **kwargs)
+    return wrapper
+
 
 class Base(driver.Base):
 
     supports_bytes_range = True
+    # Misses are only remembered by drivers forgetting them on each of
+    # their writes (see lru.missing)
+    negative_cache = False
 
     def __init__(self, path=None, config=None):
         self._config = config
         self._root_path = path or '/test'
-        self._boto_conn = self.makeConnection()
-        self._boto_bucket = self._boto_conn.get_bucket(
+        self._batch_concurrency = self._config.boto_batch_concurrency or 10
+        # Number of ranges fetched ahead by stream_read (0 disables it), and
+        # their size. Memory used per stream is bounded by their product.
+        self._read_ahead = self._config.boto_read_ahead or 0
+        self._read_ahead_chunk = (self._config.boto_read_ahead_chunk or
+                                  8 * 1024 * 1024)
+        # Bucket used outside of pooled methods. Getting it checks that the
+        # bucket exists, the pooled ones skip that request.
+        self._shared_bucket = self.makeConnection().get_bucket(
             self._config.boto_bucket)
+        self._pool = ConnectionPool(
+            self._new_bucket,
+            size=self._config.boto_pool_size or 32,
+            max_idle=self._config.boto_pool_max_idle or 60)
         logger.info("Boto based storage initialized")
 
+    def _new_bucket(self):
+        # Skips the request checking that the bucket exists
+        return self.makeConnection().get_bucket(self._config.boto_bucket,
+                                                validate=False)
+
+    @property
+    def _boto_bucket(self):
+        bucket = self._pool.current()
+        return bucket if bucket is not None else self._shared_bucket
+
+    @property
+    def _boto_conn(self):
+        # Kept for drivers built on this class
+        return self._boto_bucket.connection
+
+    def pool_stats(self):
+        return self._pool.stats()
+
     def _build_connection_params(self):
         kwargs = {'is_secure': (self._config.s3_secure is True)}
         config_args = [
@@ -77,6 +233,42 @@ class Base(driver.Base):
             return orig_meth(*args, **kwargs)
         key.bucket.connection.make_request = new_meth
 
+    def _batch(self, method, args):
+        """Run method over args concurrently, with a bounded pool.
+
+        Results are returned in order, `_missing` standing for calls that
+        raised FileNotFoundError.
+        """
+        def call(arg):
+            try:
+                return method(*arg)
+            except FileNotFoundError:
+                return _missing
+        pool = gevent.pool.Pool(self._batch_concurrency)
+        return pool.map(call, args)
+
+    def get_many(self, paths):
+        paths = list(paths)
+        # Cached ones first, in one go
+        contents = lru.get_many(paths)
+        paths = [p for p in paths if p not in contents]
+        results = self._batch(self.get_content, [(p,) for p in paths])
+        contents.update((path, content) for (path, content)
+                        in zip(paths, results) if content is not _missing)
+        return contents
+
+    def put_many(self, items):
+        self._batch(self.put_content, list(items.items()))
+
+    def exists_many(self, paths):
+        paths = list(paths)
+        return dict(zip(paths, self._batch(self.exists,
+                                           [(p,) for p in paths])))
+
+    def stat_many(self, paths):
+        paths = list(paths)
+        return dict(zip(paths, self._batch(self.stat, [(p,) for p in paths])))
+
     def _init_path(self, path=None):
         path = os.path.join(self._root_path, path) if path else self._root_path
         if path and path[0] == '/':
@@ -85,17 +277,97 @@ class Base(driver.Base):
 
     def stream_read(self, path, bytes_range=None):
         path = self._init_path(path)
+        if not self._read_ahead:
+            for buf in self._stream_read_key(path, bytes_range):
+                yield buf
+            return
+        # We need the size of the whole object to split it in ranges.
+        # Ranges are fetched on connections of their own, don't hold one
+        # meanwhile.
+        with self._pool.connection():
+            key = self._boto_bucket.lookup(path)
+        if not key:
+            raise FileNotFoundError('%s is not there' % path)
+        for buf in self._stream_read_ahead(path, key.size, bytes_range):
+            yield buf
+
+    def _stream_read_key(self, path, bytes_range=None):
+        """Stream path with a single GET, a buffer at a time.
+
+        The response is read for as long as the client reads: on a
+        connection of its own, a pooled one would be held meanwhile.
+        """
         headers = None
         if bytes_range:
             headers = {'Range': 'bytes={0}-{1}'.format(*bytes_range)}
-        key = self._boto_bucket.lookup(path, headers=headers)
-        if not key:
-            raise FileNotFoundError('%s is not there' % path)
+        key = self._new_bucket().new_key(path)
+        try:
+            key.open_read(headers=headers)
+        except boto.exception.StorageResponseError as e:
+            if e.status == 404:
+                raise FileNotFoundError('%s is not there' % path)
+            raise
+        try:
+            while True:
+                buf = key.read(self.buffer_size)
+                if not buf:
+                    break
+                yield buf
+        finally:
+            # Don't read what the client went away without
+            key.close(fast=True)
+
+    @pooled
+    def _fetch_range(self, path, start, end):
+        # A key of its own per range, so each runs on its own connection
+        key = self._boto_bucket.new_key(path)
+        headers = {'Range': 'bytes={0}-{1}'.format(start, end)}
+        return key.get_contents_as_string(headers=headers)
+
+    def _ranges(self, size, bytes_range=None):
+        """Split the object (or bytes_range of it) in ranges of a chunk."""
+        start, end = 0, size - 1
+        if bytes_range:
+            start, end = bytes_range[0], min(bytes_range[1], end)
+        chunk = self._read_ahead_chunk
+        return ((offset, min(offset + chunk, end + 1) - 1)
+                for offset in range(start, end + 1, chunk))
+
+    def _stream_read_ahead(self, path, size, bytes_range=None):
+        """Yield the content of path in order, while the next ranges are
+        being fetched concurrently.
+        """
+        ranges = self._ranges(size, bytes_range)
+        pending = collections.deque(
+            gevent.spawn(self._fetch_range, path, *r)
+            for r in itertools.islice(ranges, self._read_ahead))
+        try:
+            while pending:
+                buf = pending.popleft().get()
+                # Keep the pipe full while the caller consumes this chunk
+                for r in itertools.islice(ranges, 1):
+                    pending.append(gevent.spawn(self._fetch_range, path, *r))
+                yield buf
+        finally:
+            # Client went away (or a range failed): stop pending fetches
+            gevent.killall(list(pending), block=False)
+
+    def _list(self, **kwargs):
+        """Keys of the bucket, listed a page (1000 keys) at a time.
+
+        A connection is held while fetching a page, not while the caller
+        goes through it.
+        """
+        marker = ''
         while True:
-            buf = key.read(self.buffer_size)
-            if not buf:
-                break
-            yield buf
+            with self._pool.connection():
+                page = self._boto_bucket.get_all_keys(marker=marker,
+                                                      **kwargs)
+            for key in page:
+                yield key
+            if not page.is_truncated or not len(page):
+                return
+            marker = page.next_marker or page[-1].name
 
     def list_directory(self, path=None):
         path = self._init_path(path)
@@ -105,7 +377,7 @@ class Base(driver.Base):
         if self._root_path != '/':
             ln = len(self._root_path)
         exists = False
-        for key in self._boto_bucket.list(prefix=path, delimiter='/'):
+        for key in self._list(prefix=path, delimiter='/'):
             if '%s/' % key.name == path:
                 continue
             exists = True
@@ -117,6 +389,29 @@ class Base(driver.Base):
         if not exists:
             raise FileNotFoundError('%s is not there' % path)
 
+    def walk(self, prefix=None):
+        path = self._init_path(prefix)
+        if not path.endswith('/'):
+            path += '/'
+        ln = 0
+        if self._root_path != '/':
+            ln = len(self._root_path)
+        exists = False
+        # No delimiter: one LIST request per 1000 keys, whatever the depth
+        # of the tree
+        for key in self._list(prefix=path):
+            if key.name.endswith('/'):
+                continue
+            exists = True
+            mtime = None
+            if key.last_modified:
+                mtime = calendar.timegm(time.strptime(
+                    key.last_modified[:19], '%Y-%m-%dT%H:%M:%S'))
+            yield (key.name[ln:], key.size, mtime)
+        if not exists:
+            raise FileNotFoundError('%s is not there' % path)
+
+    @pooled
     def get_size(self, path):
         path = self._init_path(path)
         # Lookup does a HEAD HTTP Request on the object
@@ -125,20 +420,43 @@ class Base(driver.Base):
             raise FileNotFoundError('%s is not there' % path)
         return key.size
 
-    @lru.get
+    @lru.missing(driver.missing)
+    @pooled
+    def stat(self, path):
+        path = self._init_path(path)
+        # A single HEAD gives us everything
+        key = self._boto_bucket.lookup(path)
+        if not key:
+            return driver.missing
+        mtime = None
+        if key.last_modified:
+            mtime = email.utils.mktime_tz(
+                email.utils.parsedate_tz(key.last_modified))
+        etag = key.etag.strip('"') if key.etag else None
+        return driver.Stat(True, key.size, mtime, etag)
+
+    @lru.missing()
     def get_content(self, path):
+        return self._get_content(path)
+
+    @lru.get
+    @pooled
+    def _get_content(self, path):
         path = self._init_path(path)
         key = self.makeKey(path)
         if not key.exists():
             raise FileNotFoundError('%s is not there' % path)
         return key.get_contents_as_string()
 
+    @lru.missing(False)
+    @pooled
     def exists(self, path):
         path = self._init_path(path)
         key = self.makeKey(path)
         return key.exists()
 
     @lru.remove
+    @pooled
     def remove(self, path):
         path = self._init_path(path)
         key = self.makeKey(path)
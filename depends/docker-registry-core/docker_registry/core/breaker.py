@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Docker.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+docker_registry.core.breaker
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Circuit breaker, and a Redis client using it.
+
+Caches are optional: when their Redis is down or slow, we would rather do
+without them right away than wait for a socket timeout on every call.
+"""
+
+import logging
+import time
+
+import redis
+import redis.client
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class Unavailable(redis.exceptions.ConnectionError):
+
+    """Redis timed out, or was not even called because the circuit is open.
+
+    A ConnectionError, so that callers already handling those do the same.
+    """
+
+
+class CircuitBreaker(object):
+
+    """Opens after `threshold` consecutive failures.
+
+    While open, calls are refused. After `reset_timeout` seconds, one call is
+    let through (half-open): the circuit closes if it succeeds, and opens
+    again for another `reset_timeout` otherwise.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=10, name=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.state = CLOSED
+        self._failures = 0
+        self._since = 0
+        self._counters = dict.fromkeys(
+            ['calls', 'failures', 'trips', 'bypassed'], 0)
+
+    def allow(self):
+        """Whether the call about to be made should go ahead."""
+        if self.state == CLOSED:
+            self._counters['calls'] += 1
+            return True
+        # Also covers probes that never reported back
+        if time.time() - self._since >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._since = time.time()
+            self._counters['calls'] += 1
+            return True
+        self._counters['bypassed'] += 1
+        return False
+
+    def success(self):
+        if self.state != CLOSED:
+            logger.info('{0}: circuit closed'.format(self.name))
+        self.state = CLOSED
+        self._failures = 0
+
+    def failure(self):
+        self._failures += 1
+        self._counters['failures'] += 1
+        if self.state == HALF_OPEN or self._failures >= self.threshold:
+            if self.state != OPEN:
+                self._counters['trips'] += 1
+                logger.warning('{0}: circuit open for {1}s after {2} '
+                               'failure(s)'.format(self.name,
+                                                   self.reset_timeout,
+                                                   self._failures))
+            self.state = OPEN
+            self._since = time.time()
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats.update(state=self.state, consecutive_failures=self._failures)
+        return stats
+
+
+def _guarded(breaker, f, *args, **kwargs):
+    if not breaker.allow():
+        raise Unavailable('{0}: circuit open, call bypassed'.format(
+            breaker.name))
+    try:
+        result = f(*args, **kwargs)
+    except redis.exceptions.TimeoutError as e:
+        breaker.failure()
+        raise Unavailable('{0}: {1}'.format(breaker.name, e))
+    except redis.exceptions.ConnectionError:
+        breaker.failure()
+        raise
+    except Exception:
+        # Redis did answer
+        breaker.success()
+        raise
+    breaker.success()
+    return result
+
+
+class Pipeline(redis.client.StrictPipeline):
+
+    def __init__(self, breaker, *args, **kwargs):
+        self.breaker = breaker
+        super(Pipeline, self).__init__(*args, **kwargs)
+
+    def execute(self, raise_on_error=True):
+        return _guarded(self.breaker, super(Pipeline, self).execute,
+                        raise_on_error)
+
+
+class Redis(redis.StrictRedis):
+
+    """StrictRedis, failing fast (with Unavailable) while Redis is down.
+
+    Also takes the arguments of CircuitBreaker.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=10, **kwargs):
+        super(Redis, self).__init__(**kwargs)
+        self.breaker = CircuitBreaker(
+            threshold, reset_timeout,
+            name='redis {0}:{1}'.format(kwargs.get('host', 'localhost'),
+                                        kwargs.get('port', 6379)))
+
+    def execute_command(self, *args, **options):
+        return _guarded(self.breaker, super(Redis, self).execute_command,
+                        *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self.breaker, self.connection_pool,
+                        self.response_callbacks, transaction, shard_hint)
+
+    def stats(self):
+        return self.breaker.stats()
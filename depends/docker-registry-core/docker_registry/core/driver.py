@@ -26,43 +26,286 @@ Pretty much, the purpose of this is just to abstract the underlying storage
 implementation, for a given scheme.
 """
 
-__all__ = ["fetch", "available", "Base"]
+__all__ = ["fetch", "available", "fetch_layout", "Base", "Stat",
+           "FlatFallback"]
 
+import binascii
+import collections
 import functools
+import inspect
+import itertools
 import logging
+import os
 import pkgutil
+import re
 import urllib
 
 import docker_registry.drivers
 
+from . import compat
 from .compat import json
+from .exceptions import FileNotFoundError
 from .exceptions import NotImplementedError
 
 logger = logging.getLogger(__name__)
 
+# What a single `stat` call knows about a path. For missing paths, `exists`
+# is False and the other fields are None. `mtime` (a timestamp) and `etag`
+# may also be None if the backend cannot tell.
+Stat = collections.namedtuple('Stat', ['exists', 'size', 'mtime', 'etag'])
+missing = Stat(False, None, None, None)
+
+
+class StreamReader(object):
+    """File-like object on top of an iterable of chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = compat.bytes()
+
+    def read(self, size=-1):
+        # Joined once, reads much bigger than chunks (multipart uploads)
+        # would copy the buffer over and over otherwise
+        chunks, length = [self._buf], len(self._buf)
+        while size < 0 or length < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            # mmap'ed reads yield buffers
+            chunks.append(compat.bytes(chunk))
+            length += len(chunks[-1])
+        buf = compat.bytes().join(chunks) if len(chunks) > 1 else chunks[0]
+        if size < 0:
+            size = len(buf)
+        buf, self._buf = buf[:size], buf[size:]
+        return buf
+
+
+# What quote_plus leaves untouched: most values (image ids, names) need no
+# quoting at all
+_re_safe = re.compile(r'^[A-Za-z0-9_.-]+$')
+_checked = {}
+_checked_max = 10000
+
 
 def check(value):
     value = str(value)
+    if _re_safe.match(value) and value not in ('.', '..'):
+        return value
+    try:
+        return _checked[value]
+    except KeyError:
+        pass
     if value == '..':
-        value = '%2E%2E'
-    if value == '.':
-        value = '%2E'
-    return urllib.quote_plus(value)
+        quoted = '%2E%2E'
+    elif value == '.':
+        quoted = '%2E'
+    else:
+        quoted = urllib.quote_plus(value)
+    if len(_checked) >= _checked_max:
+        _checked.clear()
+    _checked[value] = quoted
+    return quoted
 
 
 def filter_args(f):
     @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        args = list(args)
-        ref = args.pop(0)
+    def wrapper(self, *args, **kwargs):
         args = [check(arg) for arg in args]
-        args.insert(0, ref)
         for key, value in kwargs.iteritems():
             kwargs[key] = check(value)
-        return f(*args, **kwargs)
+        return f(self, *args, **kwargs)
     return wrapper
 
 
+class FlatLayout(object):
+
+    """All images under a single prefix: images/<id>/..."""
+
+    def image_dir(self, store, image_id):
+        return '{0}/{1}'.format(store.images, image_id)
+
+
+class ShardedLayout(FlatLayout):
+
+    """Images spread by the first characters of their id.
+
+    With the defaults, images/ab/cd/abcd.../ keeps directories small on
+    filesystems and spreads the request rate over S3 prefixes.
+
+    Paths are computed without asking the storage. Images still in the flat
+    layout (not migrated yet, see scripts/migrate_layout.py) are read from
+    there by `FlatFallback`.
+    """
+
+    def __init__(self, levels=2, width=2):
+        self._levels = levels
+        self._width = width
+
+    def sharded_dir(self, store, image_id):
+        shards = [image_id[i * self._width:(i + 1) * self._width]
+                  for i in range(self._levels)]
+        return '/'.join([store.images] + shards + [image_id])
+
+    image_dir = sharded_dir
+
+    def flat_path(self, store, path):
+        """Where path, of an image directory or file, is in the flat
+        layout, or None for other paths.
+        """
+        prefix = store.images + '/'
+        if not path.startswith(prefix):
+            return None
+        parts = path[len(prefix):].split('/')
+        if len(parts) < self._levels + 1:
+            return None
+        image_id = parts[self._levels]
+        if '/'.join([store.images] + parts[:self._levels + 1]) != (
+                self.sharded_dir(store, image_id)):
+            return None
+        return prefix + '/'.join(parts[self._levels:])
+
+
+class FlatFallback(object):
+
+    """Wraps a storage driver in the sharded layout, reading the images
+    still in the flat layout from there.
+
+    Reads of the file of an image that isn't at its sharded path are tried
+    again at its flat one: only misses cost a second request. Writes go to
+    the sharded layout, removals to both.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def _flat(self, path):
+        return self._backend.layout.flat_path(self._backend, path)
+
+    def _fallback(self, name, path, *args, **kwargs):
+        method = getattr(self._backend, name)
+        try:
+            return method(path, *args, **kwargs)
+        except FileNotFoundError:
+            flat = self._flat(path)
+            if flat is None:
+                raise
+            return method(flat, *args, **kwargs)
+
+    def get_content(self, path):
+        return self._fallback('get_content', path)
+
+    def get_bytes(self, path):
+        return self._fallback('get_bytes', path)
+
+    def get_unicode(self, path):
+        return self._fallback('get_unicode', path)
+
+    def get_json(self, path):
+        return self._fallback('get_json', path)
+
+    def get_size(self, path):
+        return self._fallback('get_size', path)
+
+    def open_read(self, path, bytes_range=None):
+        return self._fallback('open_read', path, bytes_range)
+
+    def stream_read(self, path, bytes_range=None):
+        # Misses only show when reading the first chunk
+        try:
+            chunks = self._backend.stream_read(path, bytes_range)
+            first = next(chunks, None)
+        except FileNotFoundError:
+            flat = self._flat(path)
+            if flat is None:
+                raise
+            chunks = self._backend.stream_read(flat, bytes_range)
+            first = next(chunks, None)
+        if first is None:
+            return
+        yield first
+        for buf in chunks:
+            yield buf
+
+    def content_redirect_url(self, path):
+        flat = self._flat(path)
+        if flat is not None and not self._backend.exists(path):
+            path = flat
+        return self._backend.content_redirect_url(path)
+
+    def exists(self, path):
+        if self._backend.exists(path):
+            return True
+        flat = self._flat(path)
+        return flat is not None and self._backend.exists(flat)
+
+    def stat(self, path):
+        stat = self._backend.stat(path)
+        flat = self._flat(path)
+        if stat.exists or flat is None:
+            return stat
+        return self._backend.stat(flat)
+
+    def _many(self, name, paths, missing):
+        """Calls the batched method name on paths, then on the flat paths of
+        those missing from its result.
+        """
+        method = getattr(self._backend, name)
+        result = method(paths)
+        retry = dict((self._flat(path), path) for path in paths
+                     if missing(result, path) and self._flat(path))
+        if retry:
+            for flat, found in method(list(retry)).items():
+                if not missing({flat: found}, flat):
+                    result[retry[flat]] = found
+        return result
+
+    def get_many(self, paths):
+        return self._many('get_many', paths,
+                          lambda result, path: path not in result)
+
+    def exists_many(self, paths):
+        return self._many('exists_many', paths,
+                          lambda result, path: not result[path])
+
+    def stat_many(self, paths):
+        return self._many('stat_many', paths,
+                          lambda result, path: not result[path].exists)
+
+    def remove(self, path):
+        flat = self._flat(path)
+        if flat is None:
+            return self._backend.remove(path)
+        removed = False
+        for p in (path, flat):
+            try:
+                self._backend.remove(p)
+                removed = True
+            except FileNotFoundError:
+                pass
+        if not removed:
+            raise FileNotFoundError('%s is not there' % path)
+
+
+_layouts = {
+    'flat': FlatLayout,
+    'sharded': ShardedLayout,
+}
+
+
+def fetch_layout(name=None):
+    """Returns a new layout by name (flat by default)."""
+    try:
+        return _layouts[name or 'flat']()
+    except KeyError:
+        raise NotImplementedError(
+            'Unknown storage layout {0!r}, available: {1}'.format(
+                name, ', '.join(sorted(_layouts))))
+
+
 class Base(object):
 
     """Storage is a convenience class...
@@ -82,6 +325,11 @@ class Base(object):
     # the code which uses Storage
     repositories = 'repositories'
     images = 'images'
+    # Where images go under `images`, see `fetch_layout`
+    layout = FlatLayout()
+
+    def _image_path(self, image_id, name):
+        return '{0}/{1}'.format(self.layout.image_dir(self, image_id), name)
 
     def _repository_path(self, namespace, repository):
         return '{0}/{1}/{2}'.format(
@@ -104,31 +352,39 @@ class Base(object):
 
     @filter_args
     def image_json_path(self, image_id):
-        return '{0}/{1}/json'.format(self.images, image_id)
+        return self._image_path(image_id, 'json')
 
     @filter_args
     def image_mark_path(self, image_id):
-        return '{0}/{1}/_inprogress'.format(self.images, image_id)
+        return self._image_path(image_id, '_inprogress')
 
     @filter_args
     def image_checksum_path(self, image_id):
-        return '{0}/{1}/_checksum'.format(self.images, image_id)
+        return self._image_path(image_id, '_checksum')
 
     @filter_args
     def image_layer_path(self, image_id):
-        return '{0}/{1}/layer'.format(self.images, image_id)
+        return self._image_path(image_id, 'layer')
 
     @filter_args
     def image_ancestry_path(self, image_id):
-        return '{0}/{1}/ancestry'.format(self.images, image_id)
+        return self._image_path(image_id, 'ancestry')
 
     @filter_args
     def image_files_path(self, image_id):
-        return '{0}/{1}/_files'.format(self.images, image_id)
+        return self._image_path(image_id, '_files')
 
     @filter_args
     def image_diff_path(self, image_id):
-        return '{0}/{1}/_diff'.format(self.images, image_id)
+        return self._image_path(image_id, '_diff')
+
+    @filter_args
+    def image_ancestry_json_path(self, image_id):
+        return self._image_path(image_id, '_ancestry_json')
+
+    @filter_args
+    def image_upload_path(self, image_id):
+        return self._image_path(image_id, '_upload')
 
     @filter_args
     def repository_path(self, namespace, repository):
@@ -181,6 +437,17 @@ class Base(object):
         """
         return None
 
+    def open_read(self, path, bytes_range=None):
+        """Get a file object for content at path
+
+        Get a real file object (one that has a `fileno`) positioned at the
+        start of the requested range, which lets the WSGI server send it with
+        `wsgi.file_wrapper` / sendfile instead of copying it through python.
+        Reads past the end of the range return nothing. Return None if not
+        supported by this engine.
+        """
+        return None
+
     def get_json(self, path):
         return json.loads(self.get_unicode(path))
 
@@ -218,10 +485,14 @@ class Base(object):
             "on your storage %s" %
             self.__class__.__name__)
 
-    def stream_write(self, path, fp):
-        """Method to stream write."""
+    def stream_write(self, path, fp, size=None):
+        """Method to stream write.
+
+        `size` is the length of what fp holds, when known. Drivers may use it
+        to pick an upload strategy, but must not rely on it.
+        """
         raise NotImplementedError(
-            "You must implement stream_write(self, path, fp) " +
+            "You must implement stream_write(self, path, fp, size=None) " +
             "on your storage %s" %
             self.__class__.__name__)
 
@@ -232,6 +503,24 @@ class Base(object):
             "on your storage %s" %
             self.__class__.__name__)
 
+    def walk(self, prefix=None):
+        """Method to iterate over every key under prefix, recursively.
+
+        Yields (path, size, mtime) tuples, in no particular order, size and
+        mtime being None if unknown. Raises FileNotFoundError if there is
+        nothing under prefix. This default lists one level at a time,
+        backends that can should override it with a flat listing.
+        """
+        for path in self.list_directory(prefix):
+            try:
+                for entry in self.walk(path):
+                    yield entry
+            except FileNotFoundError:
+                # Not a directory, or an empty one
+                st = self.stat(path)
+                if st.exists:
+                    yield (path, st.size, st.mtime)
+
     def exists(self, path):
         """Method to test exists."""
         raise NotImplementedError(
@@ -250,6 +539,114 @@ class Base(object):
             "You must implement get_size(self, path) on your storage %s" %
             self.__class__.__name__)
 
+    def stat(self, path):
+        """Method to get exists, size, mtime and etag in one call.
+
+        Returns a `Stat`. This default costs a get_size call and does not
+        know mtime nor etag, backends should override it.
+        """
+        try:
+            return Stat(True, self.get_size(path), None, None)
+        except FileNotFoundError:
+            return missing
+
+    # Batched versions of the above. These default to one call per path,
+    # backends with expensive round trips should override them.
+    def get_many(self, paths):
+        """Method to get content of several paths.
+
+        Returns a dict of path -> content. Missing paths are left out.
+        """
+        result = {}
+        for path in paths:
+            try:
+                result[path] = self.get_content(path)
+            except FileNotFoundError:
+                pass
+        return result
+
+    def put_many(self, items):
+        """Method to put several contents, given a dict of path -> content."""
+        for path, content in items.items():
+            self.put_content(path, content)
+
+    def exists_many(self, paths):
+        """Method to test exists on several paths.
+
+        Returns a dict of path -> bool.
+        """
+        return dict((path, self.exists(path)) for path in paths)
+
+    def stat_many(self, paths):
+        """Method to stat several paths.
+
+        Returns a dict of path -> `Stat`.
+        """
+        return dict((path, self.stat(path)) for path in paths)
+
+    # Resumable uploads: the content of a path is sent in parts, possibly
+    # over several requests, and only shows up once completed. These
+    # defaults store each part under a path of its own, then copy them
+    # into place, backends able to assemble parts themselves should
+    # override them.
+
+    # Size of the parts of an upload, but the last one, at least
+    upload_min_part = 0
+
+    def upload_init(self, path):
+        """Method to start a resumable upload of path.
+
+        Returns its upload id.
+        """
+        return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+    def _upload_path(self, path, upload_id, number=None):
+        upload_path = '{0}.upload-{1}'.format(path, upload_id)
+        if number is None:
+            return upload_path
+        return '{0}/{1}'.format(upload_path, number)
+
+    def upload_part(self, path, upload_id, number, offset, fp, size=None):
+        """Method to store part `number` (from 1) of an upload.
+
+        offset is where the part starts in the content. Sending a part again
+        (after a failure) replaces it.
+        """
+        self.stream_write(self._upload_path(path, upload_id, number), fp,
+                          size)
+
+    def upload_complete(self, path, upload_id, numbers):
+        """Method to make the parts `numbers`, in that order, the content
+        of path, ending the upload.
+        """
+        parts = [self._upload_path(path, upload_id, number)
+                 for number in numbers]
+        self.stream_write(path, StreamReader(itertools.chain.from_iterable(
+            self.stream_read(part) for part in parts)))
+        self.upload_abort(path, upload_id)
+
+    def upload_abort(self, path, upload_id):
+        """Method to drop the parts of an upload."""
+        try:
+            self.remove(self._upload_path(path, upload_id))
+        except FileNotFoundError:
+            pass
+
+
+def _takes_size(stream_write):
+    """Whether a driver's stream_write accepts the size hint."""
+    spec = inspect.getargspec(stream_write)
+    return (spec.varargs is not None or 'size' in spec.args or
+            len(spec.args) > 3)
+
+
+def _drop_size(stream_write):
+    """Wrap the stream_write of a driver written before the size hint."""
+    @functools.wraps(stream_write)
+    def wrapper(self, path, fp, size=None):
+        return stream_write(self, path, fp)
+    return wrapper
+
 
 def fetch(name):
     try:
@@ -267,6 +664,9 @@ available on your system: %s. Exception was: %s"""
             % (name, name, available(), e)
         )
     module.Storage.scheme = name
+    if not _takes_size(module.Storage.stream_write):
+        # Callers always pass it
+        module.Storage.stream_write = _drop_size(module.Storage.stream_write)
     return module.Storage
 
 
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Docker.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+docker_registry.core.hashring
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Consistent hashing of keys over several Redis nodes.
+
+Each node owns many points of a hash ring, a key goes to the node owning
+the first point after its own hash. Adding or removing a node only moves
+the keys of the points it gains or loses.
+"""
+
+import bisect
+import hashlib
+import struct
+
+import redis
+
+
+def _hash(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf8')
+    return struct.unpack('>I', hashlib.md5(value).digest()[:4])[0]
+
+
+def route(key):
+    """What of a key is hashed: the part after its `prefix:`.
+
+    Keys made of different prefixes and the same path (cached content,
+    digest...) land on the same node, so pipelines about a path stay on
+    a single node.
+    """
+    return key.split(':', 1)[-1]
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        points = sorted((_hash('{0}-{1}'.format(node, i)), n)
+                        for n, node in enumerate(self.nodes)
+                        for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._owners = [n for _, n in points]
+
+    def index(self, key):
+        """Index of the node owning key."""
+        i = bisect.bisect(self._hashes, _hash(key))
+        return self._owners[i % len(self._owners)]
+
+
+class ShardedRedis(object):
+
+    """The subset of StrictRedis used by the caches, over several clients.
+
+    Single key commands go to the node of their key. A node being down only
+    fails the commands going to it.
+    """
+
+    def __init__(self, clients, names):
+        self.clients = list(clients)
+        self.names = list(names)
+        self.ring = HashRing(self.names)
+
+    def node(self, key):
+        return self.clients[self.ring.index(route(key))]
+
+    def __getattr__(self, name):
+        def command(key, *args, **kwargs):
+            return getattr(self.node(key), name)(key, *args, **kwargs)
+        return command
+
+    def delete(self, *keys):
+        deleted = 0
+        for client, group in self._group(keys):
+            deleted += client.delete(*group)
+        return deleted
+
+    def _group(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.index(route(key)), []).append(key)
+        return [(self.clients[i], group) for i, group in groups.items()]
+
+    def pipeline(self, transaction=False, shard_hint=None):
+        return ShardedPipeline(self)
+
+    def stats(self):
+        return dict((name, client.stats())
+                    for name, client in zip(self.names, self.clients)
+                    if hasattr(client, 'stats'))
+
+
+class ShardedPipeline(object):
+
+    """Queues commands per node, then runs one pipeline per node.
+
+    Not transactional, even on a single node.
+    """
+
+    def __init__(self, sharded):
+        self._sharded = sharded
+        # (node index, command, args, kwargs)
+        self._commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._commands = []
+
+    def __getattr__(self, name):
+        def command(key, *args, **kwargs):
+            index = self._sharded.ring.index(route(key))
+            self._commands.append((index, name, (key,) + args, kwargs))
+            return self
+        return command
+
+    def execute(self, raise_on_error=True):
+        """Results in the order of the commands.
+
+        Unless raise_on_error, the results of the commands sent to a node
+        that could not be reached are the error.
+        """
+        results = [None] * len(self._commands)
+        positions = {}
+        for position, (index, _, _, _) in enumerate(self._commands):
+            positions.setdefault(index, []).append(position)
+        for index, group in positions.items():
+            pipe = self._sharded.clients[index].pipeline(transaction=False)
+            for position in group:
+                _, name, args, kwargs = self._commands[position]
+                getattr(pipe, name)(*args, **kwargs)
+            try:
+                replies = pipe.execute(raise_on_error=raise_on_error)
+            except redis.exceptions.ConnectionError as e:
+                if raise_on_error:
+                    raise
+                replies = [e] * len(group)
+            for position, reply in zip(group, replies):
+                results[position] = reply
+        self._commands = []
+        return results
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Docker.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+docker_registry.core.layercache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Local disk cache of layers, in front of any (remote) storage driver.
+
+Layers are copied to disk while being streamed to the first client asking
+for them, then served from there (with sendfile, through `open_read`).
+The cache directory can be shared by the workers of a host: files are
+written under a temporary name then renamed, and their mtime is their last
+access time.
+"""
+
+import binascii
+import hashlib
+import logging
+import os
+import re
+import time
+
+from ..drivers.file import RangeFile
+
+logger = logging.getLogger(__name__)
+
+# What gets cached
+layer_paths = re.compile(r'(^|/)images/(.+/)?[^/]+/layer$')
+
+# Temporary files older than this were left by a dead worker
+_stale_tmp = 3600
+
+
+class LayerCache(object):
+
+    """Wraps a storage driver, caching the layers it serves on local disk.
+
+    Everything but layer reads (and the writes and removals that invalidate
+    them) goes straight to the wrapped driver.
+
+    :param backend: the storage driver to wrap
+    :param path: directory of the cache, created if needed
+    :param max_bytes: size budget of the cache
+    :param eviction: `lru` (least recently used first) or `lfu` (least
+                     frequently used first, by hits seen by this worker)
+    """
+
+    def __init__(self, backend, path, max_bytes, eviction='lru'):
+        if eviction not in ('lru', 'lfu'):
+            raise ValueError('Unknown layer cache eviction {0!r}'.format(
+                eviction))
+        self._backend = backend
+        self._path = path
+        self._max_bytes = max_bytes
+        self._eviction = eviction
+        # Hits per cached file, for lfu
+        self._hits = {}
+        self._counters = dict.fromkeys(
+            ['hits', 'misses', 'fills', 'evictions', 'hit_bytes',
+             'miss_bytes'], 0)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        logger.info('Layer cache in {0} ({1} bytes, {2})'.format(
+            path, max_bytes, eviction))
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+    def _local(self, path):
+        return os.path.join(self._path,
+                            hashlib.sha1(path.encode('utf8')).hexdigest())
+
+    def _lookup(self, path):
+        """Local copy of path if cached (marking it used), else None."""
+        local = self._local(path)
+        try:
+            os.utime(local, None)
+        except OSError:
+            return None
+        name = os.path.basename(local)
+        self._hits[name] = self._hits.get(name, 0) + 1
+        return local
+
+    def _forget(self, path):
+        local = self._local(path)
+        self._hits.pop(os.path.basename(local), None)
+        try:
+            os.remove(local)
+        except OSError:
+            pass
+
+    def _open_local(self, path, bytes_range=None):
+        """Open the cached copy of path (counting a hit), or return None."""
+        local = self._lookup(path)
+        if local is None:
+            return None
+        try:
+            f = open(local, 'rb')
+        except IOError:
+            # Evicted meanwhile
+            return None
+        self._counters['hits'] += 1
+        if not bytes_range:
+            self._counters['hit_bytes'] += os.fstat(f.fileno()).st_size
+            return RangeFile(f)
+        length = bytes_range[1] - bytes_range[0] + 1
+        self._counters['hit_bytes'] += length
+        f.seek(bytes_range[0])
+        return RangeFile(f, length)
+
+    def open_read(self, path, bytes_range=None):
+        f = None
+        if layer_paths.search(path):
+            f = self._open_local(path, bytes_range)
+        if f is None:
+            # A miss is counted by the stream_read that follows
+            return self._backend.open_read(path, bytes_range)
+        return f
+
+    def stream_read(self, path, bytes_range=None):
+        if not layer_paths.search(path):
+            return self._backend.stream_read(path, bytes_range)
+        f = self._open_local(path, bytes_range)
+        if f is not None:
+            return self._stream_file(f)
+        self._counters['misses'] += 1
+        if bytes_range:
+            # Partial content can't fill the cache
+            return self._count_miss(
+                self._backend.stream_read(path, bytes_range))
+        return self._stream_fill(path)
+
+    def _stream_file(self, f):
+        try:
+            while True:
+                buf = f.read(self.buffer_size)
+                if not buf:
+                    break
+                yield buf
+        finally:
+            f.close()
+
+    def _count_miss(self, stream):
+        for buf in stream:
+            self._counters['miss_bytes'] += len(buf)
+            yield buf
+
+    def _stream_fill(self, path):
+        """Stream path from the backend, keeping a copy on the way."""
+        local = self._local(path)
+        tmp = os.path.join(self._path, '.{0}.{1}'.format(
+            os.path.basename(local),
+            binascii.hexlify(os.urandom(6)).decode('ascii')))
+        f = open(tmp, 'wb')
+        size = 0
+        try:
+            for buf in self._backend.stream_read(path):
+                self._counters['miss_bytes'] += len(buf)
+                if f is not None:
+                    size += len(buf)
+                    if size > self._max_bytes:
+                        # Would not fit anyway
+                        f.close()
+                        f = None
+                        os.remove(tmp)
+                    else:
+                        f.write(buf)
+                yield buf
+            if f is not None:
+                f.close()
+                f = None
+                os.rename(tmp, local)
+                self._counters['fills'] += 1
+                self._evict()
+        finally:
+            # Client gone or backend failure: drop the partial copy
+            if f is not None:
+                f.close()
+                os.remove(tmp)
+
+    def _evict(self):
+        """Remove files until the cache fits its budget."""
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self._path):
+            local = os.path.join(self._path, name)
+            try:
+                st = os.stat(local)
+            except OSError:
+                continue
+            if name.startswith('.'):
+                if now - st.st_mtime > _stale_tmp:
+                    self._remove(local)
+                continue
+            total += st.st_size
+            if self._eviction == 'lfu':
+                rank = (self._hits.get(name, 0), st.st_mtime)
+            else:
+                rank = st.st_mtime
+            entries.append((rank, name, st.st_size))
+        if total <= self._max_bytes:
+            return
+        entries.sort()
+        for _, name, size in entries:
+            if total <= self._max_bytes:
+                break
+            self._remove(os.path.join(self._path, name))
+            self._hits.pop(name, None)
+            self._counters['evictions'] += 1
+            total -= size
+
+    def _remove(self, local):
+        try:
+            os.remove(local)
+        except OSError:
+            pass
+
+    def stream_write(self, path, fp, size=None):
+        result = self._backend.stream_write(path, fp, size)
+        if layer_paths.search(path):
+            self._forget(path)
+        return result
+
+    def upload_complete(self, path, upload_id, numbers):
+        result = self._backend.upload_complete(path, upload_id, numbers)
+        if layer_paths.search(path):
+            self._forget(path)
+        return result
+
+    def remove(self, path):
+        try:
+            return self._backend.remove(path)
+        finally:
+            # Removing an image directory removes its layer
+            self._forget(path)
+            self._forget(path.rstrip('/') + '/layer')
+
+    def cache_stats(self):
+        """Hits, misses (and bytes served by each), fills and evictions."""
+        stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0
+        return stats
@@ -24,19 +24,216 @@ Drivers are largely encouraged to use it.
 By default, doesn't run, until one calls init().
 """
 
+import bisect
+import collections
 import functools
+import hashlib
 import logging
+import re
+import time
 
 import redis
+
+from . import breaker
+from . import compat
+from . import hashring
+from . import sharedcache
+from .exceptions import FileNotFoundError
+
 logger = logging.getLogger(__name__)
 
 redis_conn = None
 cache_prefix = None
+# Digests of the cached contents, so writes can be skipped without reading
+# the content back
+digest_prefix = None
+# Paths known to be missing, for that many seconds (0 disables it)
+missing_prefix = None
+missing_ttl = 0
+
+Policy = collections.namedtuple('Policy', ['max_size', 'ttl', 'priority'])
+# Entries of high priority classes have their TTL renewed when hit, so
+# with Redis' `volatile-ttl` eviction those in use are the last to go.
+HIGH = 'high'
+LOW = 'low'
+
+_image = r'(^|/)images/(.+/)?[^/]+/{0}$'
+_repository = r'(^|/)repositories/.+/{0}$'
+# Path class -> (pattern, policy). Per image objects never change once
+# pushed, per repository ones do: their writes go through the cache anyway,
+# short TTLs only bound what goes stale when other writers don't.
+policies = collections.OrderedDict([
+    ('image_json', (_image.format('json'),
+                    Policy(256 * 1024, 7 * 24 * 3600, HIGH))),
+    ('ancestry', (_image.format('ancestry'),
+                  Policy(256 * 1024, 7 * 24 * 3600, HIGH))),
+    ('checksum', (_image.format('_checksum'),
+                  Policy(4 * 1024, 7 * 24 * 3600, HIGH))),
+    ('files', (_image.format('_files'),
+               Policy(1024 * 1024, 24 * 3600, LOW))),
+    ('diff', (_image.format('_diff'),
+              Policy(1024 * 1024, 24 * 3600, LOW))),
+    ('ancestry_json', (_image.format('_ancestry_json'),
+                       Policy(1024 * 1024, 7 * 24 * 3600, HIGH))),
+    ('tag', (_repository.format('tag_[^/]+'),
+             Policy(1024, 600, HIGH))),
+    ('index_images', (_repository.format('_index_images'),
+                      Policy(1024 * 1024, 300, LOW))),
+    ('private', (_repository.format('_private'),
+                 Policy(1024, 600, HIGH))),
+])
+# Anything else
+default_policy = Policy(64 * 1024, 3600, LOW)
+_policy_patterns = None
+
+# Upper bounds (seconds) of the latency histograms buckets, a last one
+# counts anything slower
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1)
+
+# Host local tier, in front of Redis: a LocalCache or a SharedCache
+local = None
+
+
+class Stats(object):
+
+    """Counters and latency histograms of the caches, per path class.
+
+    Counted events are `hits` (from Redis), `local_hits` (from the local
+    tier), `misses`, `sets`, `skipped_sets` (content already cached),
+    `evictions` (from the local tier) and `errors` (of Redis). Timed
+    operations are `fetch` (Redis reads), `store` (Redis writes) and
+    `backend` (storage reads on misses).
+    """
+
+    events = ('hits', 'local_hits', 'misses', 'sets', 'skipped_sets',
+              'evictions', 'errors')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        # path class -> event -> count
+        self._counters = {}
+        # path class -> operation -> count per bucket
+        self._latencies = {}
+
+    def count(self, event, path_class, n=1):
+        counters = self._counters.get(path_class)
+        if counters is None:
+            counters = self._counters[path_class] = dict.fromkeys(
+                self.events, 0)
+        counters[event] += n
+
+    def timing(self, operation, path_class, seconds):
+        latencies = self._latencies.setdefault(path_class, {})
+        buckets = latencies.get(operation)
+        if buckets is None:
+            buckets = latencies[operation] = [0] * (len(latency_buckets) + 1)
+        buckets[bisect.bisect_left(latency_buckets, seconds)] += 1
+
+    def snapshot(self):
+        """Everything counted so far, as a dict per path class.
+
+        Histograms map the upper bound of each bucket, in milliseconds, to
+        the count of operations that took at most that long (and more than
+        the bound of the previous bucket).
+        """
+        labels = ['{0:g}'.format(bound * 1000) for bound in latency_buckets]
+        labels.append('inf')
+        classes = {}
+        names = list(self._counters) + [name for name in self._latencies
+                                        if name not in self._counters]
+        for path_class in names:
+            counters = dict(self._counters.get(path_class) or
+                            dict.fromkeys(self.events, 0))
+            lookups = (counters['hits'] + counters['local_hits'] +
+                       counters['misses'])
+            counters['hit_ratio'] = (
+                float(lookups - counters['misses']) / lookups
+                if lookups else 0)
+            counters['latency_ms'] = dict(
+                (operation, dict(zip(labels, buckets)))
+                for operation, buckets in
+                self._latencies.get(path_class, {}).items())
+            classes[path_class] = counters
+        return {'since': self.since, 'classes': classes}
+
+
+stats = Stats()
+
+
+class LocalCache(object):
+
+    """In-process LRU, bounded by the bytes it holds, with a TTL.
+
+    Other workers' writes don't invalidate it, only the TTL does: it is meant
+    for content that does not change.
+    """
+
+    # What it holds: per image metadata, immutable once pushed
+    paths = re.compile(r'(^|/)images/(.+/)?[^/]+/(json|ancestry)$')
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # Called with the key of entries dropped to make room
+        self.on_evict = None
+        # key -> (content, expiry), least recently used first
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            self.size -= len(entry[0])
+            return None
+        self._entries[key] = entry
+        return entry[0]
+
+    def set(self, key, content):
+        self.delete(key)
+        if len(content) > self.max_bytes:
+            return
+        self._entries[key] = (content, time.time() + self.ttl)
+        self.size += len(content)
+        while self.size > self.max_bytes:
+            old_key, (old, _) = self._entries.popitem(last=False)
+            self.size -= len(old)
+            if self.on_evict is not None:
+                self.on_evict(old_key)
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def delete_tree(self, key):
+        """Delete key and everything under it."""
+        self.delete(key)
+        prefix = key.rstrip('/') + '/'
+        for k in [k for k in self._entries if k.startswith(prefix)]:
+            self.delete(k)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
 
 
 def init(enable=True,
-         host='localhost', port=6379, db=0, password=None, path='/'):
-    global redis_conn, cache_prefix
+         host='localhost', port=6379, db=0, password=None, path='/',
+         negative_ttl=10, socket_timeout=1, socket_connect_timeout=0.5,
+         threshold=5, reset_timeout=10, nodes=None):
+    """Enable the Redis LRU.
+
+    With `nodes`, a list of (host, port), keys are spread over those Redis
+    instead of host and port.
+    """
+    global redis_conn, cache_prefix, digest_prefix, missing_prefix
+    global missing_ttl
     if not enable:
         redis_conn = None
         return
@@ -46,82 +243,353 @@ def init(enable=True,
         'port': port,
         'db': db,
         'password': password,
-        'path': path
+        'path': path,
+        'nodes': nodes
     }))
-    redis_conn = redis.StrictRedis(host=host,
-                                   port=int(port),
-                                   db=int(db),
-                                   password=password)
+
+    def connect(host, port):
+        # Fails fast while Redis is unreachable
+        return breaker.Redis(host=host,
+                             port=int(port),
+                             db=int(db),
+                             password=password,
+                             socket_timeout=socket_timeout,
+                             socket_connect_timeout=socket_connect_timeout,
+                             threshold=threshold,
+                             reset_timeout=reset_timeout)
+    if nodes:
+        redis_conn = hashring.ShardedRedis(
+            [connect(*node) for node in nodes],
+            ['{0}:{1}'.format(*node) for node in nodes])
+    else:
+        redis_conn = connect(host, port)
     cache_prefix = 'cache_path:{0}'.format(path)
+    digest_prefix = 'cache_digest:{0}'.format(path)
+    missing_prefix = 'cache_missing:{0}'.format(path)
+    missing_ttl = int(negative_ttl or 0)
+
+
+def init_local(size=0, ttl=60, path=None):
+    """Enable the local tier, holding up to size bytes.
+
+    In process memory, per worker, or when given a path, in a file memory
+    mapped by all the workers of the host.
+    """
+    global local
+    if not size:
+        local = None
+        return
+    if path:
+        logging.info('Enabling shared storage cache in {0} ({1} bytes, '
+                     'TTL {2}s)'.format(path, size, ttl))
+        local = sharedcache.SharedCache(path, int(size), int(ttl))
+    else:
+        logging.info('Enabling in-process storage cache ({0} bytes, TTL '
+                     '{1}s)'.format(size, ttl))
+        local = LocalCache(int(size), int(ttl))
+    local.on_evict = _evicted
+
+
+def _evicted(key):
+    if isinstance(key, compat.bytes):
+        key = key.decode('utf8')
+    stats.count('evictions', path_class(key))
+
+
+def set_policy(name, **kwargs):
+    """Override some fields of the policy of a path class."""
+    global _policy_patterns
+    pattern, policy = policies[name]
+    policies[name] = (pattern, policy._replace(**kwargs))
+    _policy_patterns = None
+
+
+def _classes():
+    global _policy_patterns
+    if _policy_patterns is None:
+        _policy_patterns = [(re.compile(pattern), name, policy)
+                            for name, (pattern, policy) in policies.items()]
+    return _policy_patterns
+
+
+def policy(path):
+    for pattern, _, policy in _classes():
+        if pattern.search(path):
+            return policy
+    return default_policy
+
+
+def path_class(path):
+    """Name of the policy class of path, `other` when it has none."""
+    for pattern, name, _ in _classes():
+        if pattern.search(path):
+            return name
+    return 'other'
 
 
 def cache_key(key):
     return cache_prefix + key
 
 
+def digest_key(key):
+    return digest_prefix + key
+
+
+def missing_key(key):
+    return missing_prefix + key
+
+
+def _digest(content):
+    if not isinstance(content, compat.bytes):
+        content = content.encode('utf8')
+    return hashlib.sha1(content).hexdigest().encode('ascii')
+
+
+def _error(e, path):
+    stats.count('errors', path_class(path))
+    logging.warning("LRU: Redis connection error: {0}".format(e))
+
+
+def _store(path, content, digest=None):
+    """Cache content in Redis, along with its digest, per its policy."""
+    start = time.time()
+    pipe = redis_conn.pipeline(transaction=False)
+    rule = policy(path)
+    pipe.delete(missing_key(path))
+    if len(content) > rule.max_size:
+        # Not worth the memory, don't leave a previous version behind
+        pipe.delete(cache_key(path), digest_key(path))
+    else:
+        pipe.set(cache_key(path), content, ex=rule.ttl)
+        pipe.set(digest_key(path), digest or _digest(content), ex=rule.ttl)
+    try:
+        pipe.execute()
+    except redis.exceptions.ConnectionError as e:
+        _error(e, path)
+        return
+    stats.timing('store', path_class(path), time.time() - start)
+
+
+def _set_local(path, content):
+    if local is not None and local.paths.search(path):
+        if not isinstance(content, compat.bytes):
+            content = content.encode('utf8')
+        local.set(path, content)
+
+
+def _args(args, kwargs, *names):
+    """Trailing positional arguments of the decorated method, by name."""
+    args = args[1:] + tuple(kwargs[name] for name in names if name in kwargs)
+    return args[-len(names):]
+
+
 def set(f):
     @functools.wraps(f)
-    def wrapper(*args):
-        content = args[-1]
-        key = args[-2]
-        key = cache_key(key)
-        try:
-            cached_content = get_by_key(key)
-            if cached_content and cached_content == content:
-                # If cached content is the same as what we are about to
-                # write, we don't need to write again.
-                return args[-2]
-            redis_conn.set(key, content)
-        except redis.exceptions.ConnectionError as e:
-            logging.warning("LRU: Redis connection error: {0}".format(e))
-
-        return f(*args)
-    if redis_conn is None:
-        return f
+    def wrapper(*args, **kwargs):
+        if redis_conn is None and local is None:
+            return f(*args, **kwargs)
+        path, content = _args(args, kwargs, 'path', 'content')
+        if local is not None:
+            local.delete(path)
+        if redis_conn is None:
+            result = f(*args, **kwargs)
+            stats.count('sets', path_class(path))
+            _set_local(path, content)
+            return result
+        digest = _digest(content)
+        if get_by_key(digest_key(path), path) == digest:
+            # If cached content is the same as what we are about to
+            # write, we don't need to write again.
+            stats.count('skipped_sets', path_class(path))
+            _set_local(path, content)
+            return path
+        result = f(*args, **kwargs)
+        stats.count('sets', path_class(path))
+        # Only once stored: a failed write must not be skipped when retried
+        _store(path, content, digest)
+        _set_local(path, content)
+        return result
     return wrapper
 
 
 def get(f):
     @functools.wraps(f)
-    def wrapper(*args):
-        key = args[-1]
-        key = cache_key(key)
-        content = get_by_key(key)
-
-        if content is not None:
-            return content
+    def wrapper(*args, **kwargs):
+        if redis_conn is None and local is None:
+            return f(*args, **kwargs)
+        path, = _args(args, kwargs, 'path')
+        path_cls = path_class(path)
+        if local is not None:
+            content = local.get(path)
+            if content is not None:
+                stats.count('local_hits', path_cls)
+                return content
+        if redis_conn is not None:
+            start = time.time()
+            content = _fetch(path)
+            stats.timing('fetch', path_cls, time.time() - start)
+            if content is not None:
+                stats.count('hits', path_cls)
+                _set_local(path, content)
+                return content
+        stats.count('misses', path_cls)
         # Refresh cache
-        content = f(*args)
+        start = time.time()
+        content = f(*args, **kwargs)
+        stats.timing('backend', path_cls, time.time() - start)
         if content is not None:
+            if redis_conn is not None:
+                _store(path, content)
+            _set_local(path, content)
+        return content
+    return wrapper
+
+
+def _fetch(path):
+    key = cache_key(path)
+    rule = policy(path)
+    if rule.priority != HIGH:
+        return get_by_key(key, path)
+    # Renew the TTL in the same round trip
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.get(key)
+    pipe.expire(key, rule.ttl)
+    pipe.expire(digest_key(path), rule.ttl)
+    try:
+        return pipe.execute()[0]
+    except redis.exceptions.ConnectionError as e:
+        _error(e, path)
+        return None
+
+
+def missing(absent=None):
+    """Negative cache, for methods probing a path.
+
+    Misses are remembered in Redis for `missing_ttl` seconds, and answered
+    without calling the method: raising FileNotFoundError when `absent` is
+    None, returning `absent` otherwise. Writes going through `set` or
+    `created` forget them.
+
+    Only for drivers setting `negative_cache`: those whose every write goes
+    through `set` or `created`, or a miss would outlive the write.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if (redis_conn is None or not missing_ttl or
+                    not getattr(args[0], 'negative_cache', False)):
+                return f(*args, **kwargs)
+            path, = _args(args, kwargs, 'path')
+            if get_by_key(missing_key(path), path) is not None:
+                if absent is None:
+                    raise FileNotFoundError('%s is not there' % path)
+                return absent
             try:
-                redis_conn.set(key, content)
+                result = f(*args, **kwargs)
+            except FileNotFoundError:
+                if absent is None:
+                    _set_missing(path)
+                raise
+            if absent is not None and result == absent:
+                _set_missing(path)
+            return result
+        return wrapper
+    return decorator
+
+
+def _set_missing(path):
+    try:
+        redis_conn.set(missing_key(path), 1, ex=missing_ttl)
+    except redis.exceptions.ConnectionError as e:
+        _error(e, path)
+
+
+def created(f):
+    """For methods writing a path other than through `set`."""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        result = f(*args, **kwargs)
+        if redis_conn is not None and missing_ttl:
+            path = args[1] if len(args) > 1 else kwargs['path']
+            try:
+                redis_conn.delete(missing_key(path))
             except redis.exceptions.ConnectionError as e:
-                logging.warning("LRU: Redis connection error: {0}".format(e))
-        return content
-    if redis_conn is None:
-        return f
+                _error(e, path)
+        return result
     return wrapper
 
 
-def get_by_key(key):
+def get_many(paths):
+    """Cached contents of those of paths that are, as a dict.
+
+    Redis is asked in a single round trip (per node).
+    """
+    found = {}
+    if local is not None:
+        for path in paths:
+            content = local.get(path)
+            if content is not None:
+                stats.count('local_hits', path_class(path))
+                found[path] = content
+    rest = [path for path in paths if path not in found]
+    if redis_conn is None or not rest:
+        return found
+    start = time.time()
+    pipe = redis_conn.pipeline(transaction=False)
+    for path in rest:
+        pipe.get(cache_key(path))
+    try:
+        results = pipe.execute(raise_on_error=False)
+    except redis.exceptions.ConnectionError as e:
+        for path in rest:
+            _error(e, path)
+        return found
+    elapsed = time.time() - start
+    timed = []
+    for path, content in zip(rest, results):
+        path_cls = path_class(path)
+        if isinstance(content, Exception):
+            _error(content, path)
+            continue
+        if path_cls not in timed:
+            # Each class got its answers in that time
+            stats.timing('fetch', path_cls, elapsed)
+            timed.append(path_cls)
+        if content is None:
+            # The caller reads them from the storage
+            stats.count('misses', path_cls)
+            continue
+        stats.count('hits', path_cls)
+        found[path] = content
+        _set_local(path, content)
+    return found
+
+
+def get_by_key(key, path=None):
+    """Content of key in Redis, None if absent or Redis is unreachable.
+
+    path, the one key is about, is for the stats.
+    """
     try:
         content = redis_conn.get(key)
     except redis.exceptions.ConnectionError as e:
-        logging.warning("LRU: Redis connection error: {0}".format(e))
+        _error(e, path or key)
         return None
     return content
 
 
 def remove(f):
     @functools.wraps(f)
-    def wrapper(*args):
-        key = args[-1]
-        key = cache_key(key)
-        try:
-            redis_conn.delete(key)
-        except redis.exceptions.ConnectionError as e:
-            logging.warning("LRU: Redis connection error: {0}".format(e))
-        return f(*args)
-    if redis_conn is None:
-        return f
+    def wrapper(*args, **kwargs):
+        if redis_conn is None and local is None:
+            return f(*args, **kwargs)
+        path, = _args(args, kwargs, 'path')
+        if local is not None:
+            local.delete_tree(path)
+        if redis_conn is not None:
+            try:
+                redis_conn.delete(cache_key(path), digest_key(path))
+            except redis.exceptions.ConnectionError as e:
+                _error(e, path)
+        return f(*args, **kwargs)
     return wrapper
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Docker.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+docker_registry.core.sharedcache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Cache of small objects in a memory mapped file, shared by the workers of a
+host and outliving them.
+
+The file is an array of fixed size slots, grouped in sets of `WAYS`: a key
+can only live in the slots of the set its hash points to. Writers take an
+exclusive flock on the file. Readers take no lock: each slot has a sequence
+number, odd while being written, and a read is retried when it changed
+meanwhile.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import re
+import struct
+import time
+
+from . import compat
+
+# Slots per set
+WAYS = 4
+_magic = b'DRSHC001'
+# magic, slot count, slot size
+_header = struct.Struct('=8sII')
+_data_offset = 64
+# sequence, expiry, key hash, key length, value length
+_slot = struct.Struct('=IdQHI')
+# Reads torn by writers more times than this are misses
+_retries = 3
+
+
+class SharedCache(object):
+
+    """Same interface as lru.LocalCache, shared between processes.
+
+    Entries of a full set replace the one that expires first.
+    """
+
+    # What it holds: per image metadata, immutable once pushed. Not tags:
+    # they change, and pushes through other hosts wouldn't invalidate them.
+    names = ('json', 'ancestry', '_checksum')
+    paths = re.compile(
+        r'(^|/)images/(.+/)?[^/]+/({0})$'.format('|'.join(names)))
+    # Directories of an image, and the ones above them
+    _image_dir = re.compile(r'(^|/)images/(.+/)?([0-9a-f]{16}|[0-9a-f]{64})$')
+    _parent_dir = re.compile(r'^((.+/)?images(/[0-9a-f]+)*)?$')
+
+    def __init__(self, path, max_bytes, ttl, slot_size=16 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.slot_size = slot_size
+        self.slots = max(WAYS, max_bytes // slot_size // WAYS * WAYS)
+        self._length = _data_offset + self.slots * slot_size
+        self._pid = None
+        # Called with the key of live entries replaced to make room
+        self.on_evict = None
+
+    def _open(self):
+        """Map the file, (re)creating it when it isn't what we expect."""
+        while True:
+            try:
+                fd = os.open(self.path, os.O_RDWR)
+            except OSError:
+                self._create()
+                continue
+            header = os.read(fd, _header.size)
+            if (len(header) < _header.size or _header.unpack(header) !=
+                    (_magic, self.slots, self.slot_size) or
+                    os.fstat(fd).st_size != self._length):
+                os.close(fd)
+                self._create()
+                continue
+            if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                # Replaced meanwhile
+                os.close(fd)
+                continue
+            break
+        self._fd = fd
+        self._map = mmap.mmap(fd, self._length)
+        # A file descriptor inherited through fork would share its lock
+        self._pid = os.getpid()
+
+    def _create(self):
+        # Processes still mapping the previous file keep their own copy
+        tmp = '{0}.{1}'.format(self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(_header.pack(_magic, self.slots, self.slot_size))
+            f.truncate(self._length)
+        os.rename(tmp, self.path)
+
+    def _mapped(self):
+        if self._pid != os.getpid():
+            self._open()
+        return self._map
+
+    def _lock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _key(key):
+        if not isinstance(key, compat.bytes):
+            key = key.encode('utf8')
+        # 0 marks empty slots
+        return key, struct.unpack('=Q', hashlib.sha1(key).digest()[:8])[0] or 1
+
+    def _set_of(self, keyhash):
+        first = keyhash % (self.slots // WAYS) * WAYS
+        return [_data_offset + (first + i) * self.slot_size
+                for i in range(WAYS)]
+
+    def _read(self, mapping, offset, keyhash):
+        """Key and value in the slot, if it holds keyhash and didn't
+        expire, else None.
+        """
+        for _ in range(_retries):
+            seq, expires, h, klen, vlen = _slot.unpack_from(mapping, offset)
+            if seq & 1:
+                continue
+            if h != keyhash or expires < time.time():
+                return None
+            start = offset + _slot.size
+            key = mapping[start:start + klen]
+            value = mapping[start + klen:start + klen + vlen]
+            if _slot.unpack_from(mapping, offset)[0] == seq:
+                return key, value
+        return None
+
+    def get(self, key):
+        key, keyhash = self._key(key)
+        mapping = self._mapped()
+        for offset in self._set_of(keyhash):
+            entry = self._read(mapping, offset, keyhash)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+        return None
+
+    def _write(self, mapping, offset, expires=0, keyhash=0, key=b'',
+               value=b''):
+        seq = _slot.unpack_from(mapping, offset)[0]
+        _slot.pack_into(mapping, offset, seq + 1, 0, 0, 0, 0)
+        start = offset + _slot.size
+        mapping[start:start + len(key) + len(value)] = key + value
+        _slot.pack_into(mapping, offset, seq + 2, expires, keyhash,
+                        len(key), len(value))
+
+    def set(self, key, content):
+        key, keyhash = self._key(key)
+        if _slot.size + len(key) + len(content) > self.slot_size:
+            self.delete(key)
+            return
+        mapping = self._mapped()
+        self._lock()
+        try:
+            victim, victim_expires = None, None
+            for offset in self._set_of(keyhash):
+                _, expires, h, klen, _ = _slot.unpack_from(mapping, offset)
+                start = offset + _slot.size
+                if h == keyhash and mapping[start:start + klen] == key:
+                    victim = offset
+                    break
+                if victim is None or expires < victim_expires:
+                    victim, victim_expires = offset, expires
+            else:
+                self._evicting(mapping, victim)
+            self._write(mapping, victim, time.time() + self.ttl, keyhash,
+                        key, content)
+        finally:
+            self._unlock()
+
+    def _evicting(self, mapping, offset):
+        _, expires, h, klen, _ = _slot.unpack_from(mapping, offset)
+        if self.on_evict is None or not h or expires < time.time():
+            return
+        start = offset + _slot.size
+        self.on_evict(mapping[start:start + klen])
+
+    def delete(self, key):
+        key, keyhash = self._key(key)
+        mapping = self._mapped()
+        self._lock()
+        try:
+            for offset in self._set_of(keyhash):
+                _, _, h, klen, _ = _slot.unpack_from(mapping, offset)
+                start = offset + _slot.size
+                if h == keyhash and mapping[start:start + klen] == key:
+                    self._write(mapping, offset)
+        finally:
+            self._unlock()
+
+    def delete_tree(self, key):
+        """Delete key and everything under it.
+
+        Only the slots of what can be cached are touched: the entries of an
+        image directory are deleted by name, and the whole file is only
+        scanned for the directories above them.
+        """
+        if isinstance(key, compat.bytes):
+            key = key.decode('utf8')
+        name = key.rstrip('/')
+        if self._image_dir.search(name):
+            for entry in (name, ) + tuple(
+                    '{0}/{1}'.format(name, n) for n in self.names):
+                self.delete(entry)
+            return
+        if not self._parent_dir.search(name):
+            # A file of an image (like the mark of a push), or of a
+            # repository
+            self.delete(key)
+            return
+        key, _ = self._key(key)
+        # Everything, for the root
+        prefix = key.rstrip(b'/') + b'/' if key.strip(b'/') else b''
+        mapping = self._mapped()
+        self._lock()
+        try:
+            for i in range(self.slots):
+                offset = _data_offset + i * self.slot_size
+                _, _, h, klen, _ = _slot.unpack_from(mapping, offset)
+                if not h:
+                    continue
+                start = offset + _slot.size
+                name = mapping[start:start + klen]
+                if name == key or name.startswith(prefix):
+                    self._write(mapping, offset)
+        finally:
+            self._unlock()
+
+    def clear(self):
+        mapping = self._mapped()
+        self._lock()
+        try:
+            for i in range(self.slots):
+                offset = _data_offset + i * self.slot_size
+                if _slot.unpack_from(mapping, offset)[2]:
+                    self._write(mapping, offset)
+        finally:
+            self._unlock()
@@ -100,7 +100,7 @@ class Storage(driver.Base):
                 break
             yield buf
 
-    def stream_write(self, path, fp):
+    def stream_write(self, path, fp, size=None):
         # Size is mandatory
         if path not in self._storage:
             self._storage[path] = compat.StringIO()
@@ -115,6 +115,14 @@ class Storage(driver.Base):
         except IOError:
             pass
 
+    def walk(self, prefix=None):
+        base = '%s/' % prefix if prefix else ''
+        entries = [(k, self.get_size(k), None) for k in self._storage
+                   if k.startswith(base)]
+        if not entries:
+            raise exceptions.FileNotFoundError('%s is not there' % prefix)
+        return iter(entries)
+
     def list_directory(self, path=None):
         # if path not in self._storage:
         #     raise exceptions.FileNotFoundError('%s is not there' % path)
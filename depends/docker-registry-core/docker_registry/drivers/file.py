@@ -22,13 +22,100 @@ This is a simple filesystem based driver.
 
 """
 
+import binascii
+import collections
+import contextlib
+import mmap
 import os
 import shutil
 
+from ..core import compat
 from ..core import driver
 from ..core import exceptions
 from ..core import lru
 
+# os.scandir saves a stat per directory entry (python >= 3.5)
+scandir = getattr(os, 'scandir', None)
+
+
+def _view(mapping, offset, size):
+    """Zero-copy slice of a memory map."""
+    if compat.is_py2:
+        # python 2 mmap objects only speak the old buffer protocol
+        return buffer(mapping, offset, size)  # noqa
+    return memoryview(mapping)[offset:offset + size]
+
+
+def _walk_tree(root, base):
+    """Yield (path, size, mtime) for the files under root, path being
+    relative to root and prefixed by base.
+
+    Dot files are in-progress writes (see Storage._replace), skip them.
+    """
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel = os.path.relpath(dirpath, root)
+            prefix = base if rel == '.' else '{0}{1}/'.format(base, rel)
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    # Removed meanwhile
+                    continue
+                yield (prefix + name, st.st_size, st.st_mtime)
+        return
+    stack = [(root, base)]
+    while stack:
+        dirpath, prefix = stack.pop()
+        try:
+            entries = list(scandir(dirpath))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                stack.append((entry.path, prefix + entry.name + '/'))
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            yield (prefix + entry.name, st.st_size, st.st_mtime)
+
+
+class RangeFile(object):
+
+    """Read-only file object bounded to a byte range of an open file.
+
+    `fileno` is exposed so that WSGI servers can sendfile the range: they
+    pick up the current offset of the descriptor and send `Content-Length`
+    bytes from there.
+    """
+
+    def __init__(self, f, length=None):
+        self._f = f
+        self._left = length
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def read(self, size=-1):
+        if self._left is None:
+            return self._f.read(size)
+        if size < 0 or size > self._left:
+            size = self._left
+        if size <= 0:
+            return compat.bytes()
+        buf = self._f.read(size)
+        self._left -= len(buf)
+        return buf
+
+    def close(self):
+        self._f.close()
+
 
 class Storage(driver.Base):
 
@@ -36,6 +123,9 @@ class Storage(driver.Base):
 
     def __init__(self, path=None, config=None):
         self._root_path = path or './tmp'
+        self._mmap = bool(config and config.file_mmap)
+        self._mmap_size = (config and config.file_mmap_cache_size) or 64
+        self._maps = collections.OrderedDict()
 
     def _init_path(self, path=None, create=False):
         path = os.path.join(self._root_path, path) if path else self._root_path
@@ -45,6 +135,63 @@ class Storage(driver.Base):
                 os.makedirs(dirname)
         return path
 
+    @contextlib.contextmanager
+    def _replace(self, path):
+        """Write to a temporary file then rename it over path.
+
+        Readers (and memory maps) of the previous content keep seeing the old
+        file instead of a truncated one.
+        """
+        dirname, basename = os.path.split(path)
+        tmp = os.path.join(dirname, '.{0}.{1}'.format(
+            basename, binascii.hexlify(os.urandom(6)).decode('ascii')))
+        try:
+            with open(tmp, mode='wb') as f:
+                yield f
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _get_map(self, path):
+        """Get a (shared) read-only memory map of the file at path.
+
+        Maps are kept in a bounded LRU so that concurrent readers of a hot
+        layer share one mapping. Maps are never closed explicitly: dropping
+        them from the cache leaves them alive until their last reader is done.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise exceptions.FileNotFoundError('%s is not there' % path)
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        cached = self._maps.pop(path, None)
+        if cached is None or cached[0] != key:
+            if not st.st_size:
+                # Empty files cannot be mapped
+                return None
+            with open(path, mode='rb') as f:
+                cached = (key, mmap.mmap(f.fileno(), 0,
+                                         access=mmap.ACCESS_READ))
+        self._maps[path] = cached
+        while len(self._maps) > self._mmap_size:
+            self._maps.popitem(last=False)
+        return cached[1]
+
+    def _stream_read_mmap(self, path, bytes_range=None):
+        mapping = self._get_map(path)
+        if mapping is None:
+            return
+        start, end = 0, len(mapping) - 1
+        if bytes_range:
+            start, end = bytes_range[0], min(bytes_range[1], end)
+        offset = start
+        while offset <= end:
+            yield _view(mapping, offset,
+                        min(self.buffer_size, end + 1 - offset))
+            offset += self.buffer_size
+
     @lru.get
     def get_content(self, path):
         path = self._init_path(path)
@@ -59,45 +206,47 @@ class Storage(driver.Base):
     @lru.set
     def put_content(self, path, content):
         path = self._init_path(path, create=True)
-        with open(path, mode='wb') as f:
+        with self._replace(path) as f:
             f.write(content)
         return path
 
     def stream_read(self, path, bytes_range=None):
         path = self._init_path(path)
-        nb_bytes = 0
-        total_size = 0
+        if self._mmap:
+            # Yields buffer / memoryview slices of the mapped file, which
+            # WSGI servers don't take: responses go through open_read
+            for buf in self._stream_read_mmap(path, bytes_range):
+                yield buf
+            return
+        f = self._open_range(path, bytes_range)
         try:
-            with open(path, mode='rb') as f:
-                if bytes_range:
-                    f.seek(bytes_range[0])
-                    total_size = bytes_range[1] - bytes_range[0] + 1
-                while True:
-                    buf = None
-                    if bytes_range:
-                        # Bytes Range is enabled
-                        buf_size = self.buffer_size
-                        if nb_bytes + buf_size > total_size:
-                            # We make sure we don't read out of the range
-                            buf_size = total_size - nb_bytes
-                        if buf_size > 0:
-                            buf = f.read(buf_size)
-                            nb_bytes += len(buf)
-                        else:
-                            # We're at the end of the range
-                            buf = ''
-                    else:
-                        buf = f.read(self.buffer_size)
-                    if not buf:
-                        break
-                    yield buf
+            while True:
+                buf = f.read(self.buffer_size)
+                if not buf:
+                    break
+                yield buf
         except IOError:
             raise exceptions.FileNotFoundError('%s is not there' % path)
+        finally:
+            f.close()
 
-    def stream_write(self, path, fp):
+    def open_read(self, path, bytes_range=None):
+        return self._open_range(self._init_path(path), bytes_range)
+
+    def _open_range(self, path, bytes_range=None):
+        try:
+            f = open(path, mode='rb')
+        except IOError:
+            raise exceptions.FileNotFoundError('%s is not there' % path)
+        if not bytes_range:
+            return RangeFile(f)
+        f.seek(bytes_range[0])
+        return RangeFile(f, bytes_range[1] - bytes_range[0] + 1)
+
+    def stream_write(self, path, fp, size=None):
         # Size is mandatory
         path = self._init_path(path, create=True)
-        with open(path, mode='wb') as f:
+        with self._replace(path) as f:
             try:
                 while True:
                     buf = fp.read(self.buffer_size)
@@ -107,6 +256,36 @@ class Storage(driver.Base):
             except IOError:
                 pass
 
+    def _upload_file(self, path, upload_id):
+        dirname, basename = os.path.split(self._init_path(path, create=True))
+        return os.path.join(dirname, '.{0}.upload-{1}'.format(basename,
+                                                              upload_id))
+
+    def upload_part(self, path, upload_id, number, offset, fp, size=None):
+        # Parts are appended to a single file, cut at offset first: a
+        # previous attempt at this part may have been interrupted midway
+        tmp = self._upload_file(path, upload_id)
+        with open(tmp, mode='r+b' if os.path.exists(tmp) else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                buf = fp.read(self.buffer_size)
+                if not buf:
+                    break
+                f.write(buf)
+
+    def upload_complete(self, path, upload_id, numbers):
+        tmp = self._upload_file(path, upload_id)
+        if not os.path.exists(tmp):
+            raise exceptions.FileNotFoundError('%s is not there' % tmp)
+        os.rename(tmp, self._init_path(path))
+
+    def upload_abort(self, path, upload_id):
+        try:
+            os.remove(self._upload_file(path, upload_id))
+        except OSError:
+            pass
+
     def list_directory(self, path=None):
         prefix = ''
         if path:
@@ -122,6 +301,16 @@ class Storage(driver.Base):
         if not exists:
             raise exceptions.FileNotFoundError('%s is not there' % path)
 
+    def walk(self, prefix=None):
+        path = self._init_path(prefix)
+        base = '%s/' % prefix if prefix else ''
+        exists = False
+        for entry in _walk_tree(path, base):
+            exists = True
+            yield entry
+        if not exists:
+            raise exceptions.FileNotFoundError('%s is not there' % path)
+
     def exists(self, path):
         path = self._init_path(path)
         return os.path.exists(path)
@@ -143,3 +332,13 @@ class Storage(driver.Base):
             return os.path.getsize(path)
         except OSError:
             raise exceptions.FileNotFoundError('%s is not there' % path)
+
+    def stat(self, path):
+        path = self._init_path(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return driver.missing
+        # Same scheme as nginx: hex mtime and size
+        etag = '{0:x}-{1:x}'.format(int(st.st_mtime), st.st_size)
+        return driver.Stat(True, st.st_size, st.st_mtime, etag)
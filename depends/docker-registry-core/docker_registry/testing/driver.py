@@ -206,6 +206,37 @@ class Driver(object):
         filename = self.gen_random_string()
         self._storage.get_size(filename)
 
+    def test_stat(self):
+        filename = self.gen_random_string()
+        content = self.gen_random_string().encode('utf8')
+        assert self._storage.stat(filename) == driver.missing
+        self._storage.put_content(filename, content)
+        st = self._storage.stat(filename)
+        assert st.exists
+        assert st.size == len(content)
+        self._storage.remove(filename)
+        assert not self._storage.stat(filename).exists
+
+    def test_many(self):
+        items = dict((self.gen_random_string(),
+                      self.gen_random_string().encode('utf8'))
+                     for i in range(5))
+        notexist = self.gen_random_string()
+        self._storage.put_many(items)
+        paths = list(items) + [notexist]
+
+        assert self._storage.get_many(paths) == items
+        exists = self._storage.exists_many(paths)
+        assert exists.pop(notexist) is False
+        assert exists == dict((path, True) for path in items)
+        stats = self._storage.stat_many(paths)
+        assert stats.pop(notexist) == driver.missing
+        assert dict((path, st.size) for (path, st) in stats.items()) == dict(
+            (path, len(content)) for (path, content) in items.items())
+
+        for path in items:
+            self._storage.remove(path)
+
     def test_stream(self):
         filename = self.gen_random_string()
         # test 7MB
@@ -224,7 +255,8 @@ class Driver(object):
         # test read / write
         data = compat.bytes()
         for buf in self._storage.stream_read(filename):
-            data += buf
+            # Chunks may be any buffer-like object (eg: mmap views)
+            data += compat.bytes(buf)
 
         assert content == data
 
@@ -234,7 +266,7 @@ class Driver(object):
             bytes_range = (b, random.randint(b + 1, len(content) - 1))
             data = compat.bytes()
             for buf in self._storage.stream_read(filename, bytes_range):
-                data += buf
+                data += compat.bytes(buf)
             expected_content = content[bytes_range[0]:bytes_range[1] + 1]
             assert data == expected_content
 
@@ -248,6 +280,58 @@ class Driver(object):
         self._storage.remove(filename)
         assert not self._storage.exists(filename)
 
+    def test_open_read(self):
+        filename = self.gen_random_string()
+        content = self.gen_random_string(1024).encode('utf8')
+        self._storage.put_content(filename, content)
+        f = self._storage.open_read(filename)
+        if f is None:
+            # Not supported by this backend
+            return
+        try:
+            assert f.read() == content
+        finally:
+            f.close()
+
+        if self._storage.supports_bytes_range:
+            bytes_range = (10, 100)
+            f = self._storage.open_read(filename, bytes_range)
+            try:
+                assert f.read(7) == content[10:17]
+                assert f.read() == content[17:101]
+                end = f.read()
+                assert end == compat.bytes()
+                assert isinstance(end, compat.bytes)
+            finally:
+                f.close()
+
+    def test_upload(self):
+        filename = self.gen_random_string()
+        chunks = [self.gen_random_string(size).encode('utf8')
+                  for size in (100, 100, 10)]
+        upload_id = self._storage.upload_init(filename)
+        offset = 0
+        for number, chunk in enumerate(chunks, 1):
+            self._storage.upload_part(filename, upload_id, number, offset,
+                                      compat.StringIO(chunk), len(chunk))
+            offset += len(chunk)
+        # Nothing shows up before completion
+        assert not self._storage.exists(filename)
+        self._storage.upload_complete(filename, upload_id, [1, 2, 3])
+        data = compat.bytes()
+        for buf in self._storage.stream_read(filename):
+            data += compat.bytes(buf)
+        assert data == compat.bytes().join(chunks)
+        self._storage.remove(filename)
+
+        upload_id = self._storage.upload_init(filename)
+        self._storage.upload_part(filename, upload_id, 1, 0,
+                                  compat.StringIO(chunks[0]))
+        self._storage.upload_abort(filename, upload_id)
+        assert not self._storage.exists(filename)
+        # Aborting twice is fine
+        self._storage.upload_abort(filename, upload_id)
+
     @tools.raises(exceptions.FileNotFoundError)
     def test_stream_read_inexistent(self):
         filename = self.gen_random_string()
@@ -312,6 +396,30 @@ class Driver(object):
     #     assert sorted([fb1, fb2]
     #                   ) == sorted(list(self._storage.list_directory()))
 
+    def test_walk(self):
+        base = self.gen_random_string()
+        files = {}
+        for path in ('a', 'b/c', 'b/d/e', 'b/d/f'):
+            path = '%s/%s' % (base, path)
+            files[path] = self.gen_random_string().encode('utf8')
+            self._storage.put_content(path, files[path])
+
+        sizes = dict((path, size)
+                     for (path, size, mtime) in self._storage.walk(base))
+        assert sizes == dict((path, len(content))
+                             for (path, content) in files.items())
+        sub = '%s/b' % base
+        assert sorted(path for (path, size, mtime)
+                      in self._storage.walk(sub)) == sorted(
+            path for path in files if path.startswith(sub + '/'))
+
+        self._storage.remove(base)
+
+    @tools.raises(exceptions.FileNotFoundError)
+    def test_walk_inexistent(self):
+        notexist = self.gen_random_string()
+        next(self._storage.walk(notexist))
+
     @tools.raises(exceptions.FileNotFoundError, StopIteration)
     def test_empty_after_remove_list_directory(self):
         base = self.gen_random_string()
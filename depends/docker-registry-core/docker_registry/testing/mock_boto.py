@@ -18,8 +18,14 @@
 XXX this mock is crass and break gcs.
 Look into moto instead.'''
 
+import binascii
+import hashlib
+import os
+
 from . import mock_dict
 from . import utils
+import boto.exception
+import boto.resultset
 import boto.s3.bucket
 import boto.s3.connection
 import boto.s3.key
@@ -31,14 +37,20 @@ Bucket__init__ = boto.s3.bucket.Bucket.__init__
 @six.add_metaclass(utils.monkeypatch_class)
 class MultiPartUpload(boto.s3.multipart.MultiPartUpload):
 
-    def upload_part_from_file(self, io, num_part):
-        if num_part == 1:
-            self.bucket._bucket[self.bucket.name][self._tmp_key] = io.read()
-        else:
-            self.bucket._bucket[self.bucket.name][self._tmp_key] += io.read()
+    # upload id -> part number -> content, shared by the handles of an
+    # upload
+    _uploads = {}
+
+    def upload_part_from_file(self, io, num_part, **kwargs):
+        self._uploads.setdefault(self.id, {})[num_part] = io.read()
 
     def complete_upload(self):
-        return None
+        parts = self._uploads.pop(self.id, {})
+        self.bucket._bucket[self.bucket.name][self.key_name] = ''.join(
+            parts[num] for num in sorted(parts))
+
+    def cancel_upload(self):
+        self._uploads.pop(self.id, None)
 
 
 @six.add_metaclass(utils.monkeypatch_class)
@@ -47,9 +59,12 @@ class S3Connection(boto.s3.connection.S3Connection):
     def __init__(self, *args, **kwargs):
         return None
 
-    def get_bucket(self, name, **kwargs):
-        # Create a bucket for testing
+    def get_bucket(self, name, validate=True, **kwargs):
+        # Create a bucket for testing. Pooled connections (which skip the
+        # validation) get handles on the driver's bucket.
         bucket = Bucket(connection=self, name=name, key_class=Key)
+        if validate:
+            bucket.delete()
         return bucket
 
     def make_request(self, *args, **kwargs):
@@ -69,30 +84,41 @@ class Bucket(boto.s3.bucket.Bucket):
 
     def __init__(self, *args, **kwargs):
         Bucket__init__(self, *args, **kwargs)
-        Bucket._bucket[self.name] = mock_dict.MockDict()
-        Bucket._bucket[self.name].add_dict_methods()
+        # Several handles (pooled connections) share the same bucket
+        if self.name not in Bucket._bucket:
+            Bucket._bucket[self.name] = mock_dict.MockDict()
+            Bucket._bucket[self.name].add_dict_methods()
 
     def delete(self):
         if self.name in Bucket._bucket:
             Bucket._bucket[self.name] = mock_dict.MockDict()
             Bucket._bucket[self.name].add_dict_methods()
 
-    def list(self, **kwargs):
-        return ([self.lookup(k) for k in self._bucket_dict.keys()]
+    def list(self, prefix='', **kwargs):
+        return ([self.lookup(k) for k in self._bucket_dict.keys()
+                 if k.startswith(prefix)]
                 if self._bucket_dict else [])
 
+    def get_all_keys(self, headers=None, prefix='', **kwargs):
+        # A single page
+        rs = boto.resultset.ResultSet()
+        rs.extend(self.list(prefix))
+        return rs
+
     def lookup(self, key_name, **kwargs):
         if self._bucket_dict and key_name in self._bucket_dict:
             value = Bucket._bucket[self.name][key_name]
             k = Key(self)
             k.name = key_name
             k.size = len(value)
+            k.etag = '"{0}"'.format(hashlib.md5(value).hexdigest())
             return k
 
     def initiate_multipart_upload(self, key_name, **kwargs):
         # Pass key_name to MultiPartUpload
         mp = MultiPartUpload(self)
-        mp._tmp_key = key_name
+        mp.key_name = key_name
+        mp.id = binascii.hexlify(os.urandom(8)).decode('ascii')
         return mp
 
 
@@ -111,7 +137,13 @@ class Key(boto.s3.key.Key):
         self.bucket._bucket_dict[self.name] = value
 
     def get_contents_as_string(self, *args, **kwargs):
-        return self.bucket._bucket_dict[self.name]
+        value = self.bucket._bucket_dict[self.name]
+        headers = kwargs.get('headers') or {}
+        if 'Range' in headers:
+            min_cur, max_cur = (headers['Range'].replace('bytes=', '')
+                                .split('-'))
+            return value[int(min_cur):int(max_cur) + 1]
+        return value
 
     def get_contents_to_file(self, fp, **kwargs):
         min_cur, max_cur = (kwargs['headers']['Range'].replace('bytes=', '')
@@ -120,8 +152,20 @@ class Key(boto.s3.key.Key):
         fp.write(value[int(min_cur):int(max_cur) + 1])
         fp.flush()
 
+    def open_read(self, headers=None, **kwargs):
+        bucket_dict = self.bucket._bucket_dict
+        if not bucket_dict or self.name not in bucket_dict:
+            raise boto.exception.S3ResponseError(404, 'Not Found')
+        headers = headers or {}
+        if 'Range' in headers:
+            min_cur, max_cur = (headers['Range'].replace('bytes=', '')
+                                .split('-'))
+            self._last_position = int(min_cur)
+            self._end = int(max_cur) + 1
+
     def read(self, buffer_size):
         # fetch read status
         lp = getattr(self, '_last_position', 0)
-        self._last_position = lp + buffer_size
-        return self.bucket._bucket_dict[self.name][lp:lp + buffer_size]
+        end = min(lp + buffer_size, getattr(self, '_end', lp + buffer_size))
+        self._last_position = end
+        return self.bucket._bucket_dict[self.name][lp:end]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Docker.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import redis
+
+from docker_registry.core import breaker
+
+
+class TestCircuitBreaker(object):
+
+    def setUp(self):
+        self._breaker = breaker.CircuitBreaker(threshold=2, reset_timeout=60)
+
+    def testTrip(self):
+        assert self._breaker.allow()
+        self._breaker.failure()
+        assert self._breaker.state == breaker.CLOSED
+        self._breaker.failure()
+        assert self._breaker.state == breaker.OPEN
+        assert not self._breaker.allow()
+        stats = self._breaker.stats()
+        assert (stats['trips'], stats['bypassed']) == (1, 1)
+
+    def testSuccessResets(self):
+        self._breaker.failure()
+        self._breaker.success()
+        self._breaker.failure()
+        assert self._breaker.state == breaker.CLOSED
+
+    def testHalfOpen(self):
+        self._breaker.failure()
+        self._breaker.failure()
+        self._breaker.reset_timeout = 0
+        # One probe goes through
+        assert self._breaker.allow()
+        assert self._breaker.state == breaker.HALF_OPEN
+        self._breaker.failure()
+        assert self._breaker.state == breaker.OPEN
+        assert self._breaker.allow()
+        self._breaker.success()
+        assert self._breaker.state == breaker.CLOSED
+
+
+class TestRedis(object):
+
+    def testUp(self):
+        conn = breaker.Redis(socket_timeout=1)
+        conn.set('breaker-test', 'foo')
+        pipe = conn.pipeline(transaction=False)
+        pipe.get('breaker-test')
+        pipe.delete('breaker-test')
+        assert pipe.execute() == [b'foo', 1]
+        assert conn.stats()['state'] == breaker.CLOSED
+
+    def testDown(self):
+        # Nothing listens there
+        conn = breaker.Redis(port=1, threshold=2, reset_timeout=60,
+                             socket_connect_timeout=0.1)
+        for _ in range(4):
+            try:
+                conn.get('breaker-test')
+            except redis.exceptions.ConnectionError:
+                pass
+            else:
+                assert False
+        try:
+            conn.pipeline().get('breaker-test').execute()
+        except breaker.Unavailable:
+            pass
+        else:
+            assert False
+        stats = conn.stats()
+        assert stats['state'] == breaker.OPEN
+        assert (stats['failures'], stats['bypassed']) == (2, 3)
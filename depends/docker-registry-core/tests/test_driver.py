@@ -14,6 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
+import time
+
+from docker_registry.core import compat
+from docker_registry.core import driver
+from docker_registry.core import exceptions
+from docker_registry.core import layercache
 import docker_registry.testing as testing
 
 
@@ -39,3 +48,236 @@ class TestDriverFile(testing.Driver):
         self.scheme = 'file'
         self.path = ''
         self.config = testing.Config({})
+
+    def test_upload_retry(self):
+        filename = self.gen_random_string()
+        upload_id = self._storage.upload_init(filename)
+        self._storage.upload_part(filename, upload_id, 1, 0,
+                                  compat.StringIO(b'0123456789'))
+        # Interrupted midway, then sent again
+        self._storage.upload_part(filename, upload_id, 2, 10,
+                                  compat.StringIO(b'abc'))
+        self._storage.upload_part(filename, upload_id, 2, 10,
+                                  compat.StringIO(b'abcdef'))
+        self._storage.upload_complete(filename, upload_id, [1, 2])
+        assert self._storage.get_content(filename) == b'0123456789abcdef'
+        # Nothing left behind
+        assert not os.path.exists(
+            self._storage._upload_file(filename, upload_id))
+        self._storage.remove(filename)
+
+
+class TestDriverFileMmap(testing.Driver):
+    def __init__(self):
+        self.scheme = 'file'
+        self.path = ''
+        self.config = testing.Config({'file_mmap': True,
+                                      'file_mmap_cache_size': 2})
+
+    def test_stream_mmap_shared(self):
+        filename = self.gen_random_string()
+        content = self.gen_random_string(1024).encode('utf8')
+        self._storage.put_content(filename, content)
+        self._storage.buffer_size = 100
+        first = self._storage.stream_read(filename, (50, 549))
+        second = self._storage.stream_read(filename, (50, 549))
+        data = compat.bytes(next(first))
+        assert len(self._storage._maps) == 1
+        data += compat.bytes().join(compat.bytes(buf) for buf in first)
+        assert data == content[50:550]
+        assert compat.bytes().join(
+            compat.bytes(buf) for buf in second) == data
+        assert len(self._storage._maps) == 1
+        # Responses are still sent with sendfile
+        f = self._storage.open_read(filename)
+        assert f.read() == content
+        f.close()
+
+        # Rewriting the file does not disturb the old mapping
+        self._storage.put_content(filename, content[::-1])
+        data = compat.bytes().join(
+            compat.bytes(buf) for buf in self._storage.stream_read(filename))
+        assert data == content[::-1]
+
+
+class TestDriverFileSharded(testing.Driver):
+    def __init__(self):
+        self.scheme = 'file'
+        self.path = ''
+        self.config = testing.Config({})
+
+    def setUp(self):
+        super(TestDriverFileSharded, self).setUp()
+        self._storage.layout = driver.fetch_layout('sharded')
+        self._storage = driver.FlatFallback(self._storage)
+
+    def test_sharded_paths(self):
+        image_id = self.gen_random_string(64)
+        path = self._storage.image_json_path(image_id)
+        assert path == 'images/{0}/{1}/{2}/json'.format(
+            image_id[:2], image_id[2:4], image_id)
+
+    def test_dual_read(self):
+        image_id = self.gen_random_string(64)
+        flat = 'images/{0}'.format(image_id)
+        sharded = self._storage.layout.sharded_dir(self._storage, image_id)
+        self._storage.put_content(flat + '/json', b'{}')
+        self._storage.put_content(flat + '/layer', b'layer')
+        # Paths don't depend on what's stored
+        assert self._storage.image_layer_path(image_id) == sharded + '/layer'
+        # Not migrated yet, read from the flat layout
+        layer_path = self._storage.image_layer_path(image_id)
+        json_path = self._storage.image_json_path(image_id)
+        assert self._storage.get_content(layer_path) == b'layer'
+        assert self._storage.get_json(json_path) == {}
+        assert b''.join(self._storage.stream_read(layer_path)) == b'layer'
+        assert self._storage.exists(layer_path)
+        assert self._storage.stat(layer_path).size == 5
+        assert self._storage.get_many([json_path, layer_path]) == {
+            json_path: b'{}', layer_path: b'layer'}
+        assert self._storage.stat_many([layer_path])[layer_path].exists
+        # Migrated: read from the sharded layout
+        self._storage.put_content(sharded + '/layer', b'sharded')
+        assert self._storage.get_content(layer_path) == b'sharded'
+        # Removing the image removes both copies
+        self._storage.remove(sharded)
+        assert not self._storage.exists(json_path)
+        assert not self._storage.exists(flat + '/layer')
+        assert self._storage.exists_many([json_path]) == {json_path: False}
+
+
+class TestDriverDumbLayerCache(testing.Driver):
+    def __init__(self):
+        self.scheme = 'dumb'
+        self.path = ''
+        self.config = testing.Config({})
+
+    def setUp(self):
+        super(TestDriverDumbLayerCache, self).setUp()
+        self._cache_path = tempfile.mkdtemp()
+        self._storage = layercache.LayerCache(self._storage, self._cache_path,
+                                              3000)
+
+    def tearDown(self):
+        shutil.rmtree(self._cache_path)
+        super(TestDriverDumbLayerCache, self).tearDown()
+
+    def _read(self, path, bytes_range=None):
+        return compat.bytes().join(
+            compat.bytes(buf)
+            for buf in self._storage.stream_read(path, bytes_range))
+
+    def _layer(self, size=1000):
+        path = 'images/{0}/layer'.format(self.gen_random_string())
+        content = self.gen_random_string(size).encode('utf8')
+        self._storage.stream_write(path, compat.StringIO(content))
+        return path, content
+
+    def test_layer_cache(self):
+        path, content = self._layer()
+        assert self._storage.open_read(path) is None
+        assert self._read(path) == content
+        stats = self._storage.cache_stats()
+        assert (stats['misses'], stats['fills'], stats['hits']) == (1, 1, 0)
+        # Hits don't go to the backend anymore
+        self._storage._backend.remove(path)
+        f = self._storage.open_read(path, (10, 19))
+        assert f.read() == content[10:20]
+        f.close()
+        assert self._read(path) == content
+        assert self._read(path, (0, 99)) == content[:100]
+        stats = self._storage.cache_stats()
+        assert stats['hits'] == 3
+        assert stats['hit_ratio'] == 0.75
+
+    def test_layer_cache_invalidation(self):
+        path, content = self._layer()
+        self._read(path)
+        self._storage._backend.remove(path)
+        self._storage.stream_write(path, compat.StringIO(content[::-1]))
+        assert self._read(path) == content[::-1]
+        self._storage.remove(path.rsplit('/', 1)[0])
+        assert self._storage.open_read(path) is None
+
+    def test_layer_cache_partial(self):
+        path, content = self._layer()
+        stream = self._storage.stream_read(path)
+        next(stream)
+        # Client went away
+        stream.close()
+        assert self._storage.open_read(path) is None
+        assert self._read(path, (0, 9)) == content[:10]
+        assert self._storage.open_read(path) is None
+
+    def test_layer_cache_eviction(self):
+        layers = [self._layer() for _ in range(3)]
+        for i, (path, _) in enumerate(layers):
+            self._read(path)
+            # Filled in that order, a minute apart
+            mtime = time.time() - 60 * (3 - i)
+            os.utime(self._storage._local(path), (mtime, mtime))
+        # Makes the first one the most recently used
+        first = self._storage.open_read(layers[0][0])
+        first.close()
+        path, _ = self._layer(1500)
+        self._read(path)
+        assert self._storage.cache_stats()['evictions'] == 2
+        assert self._storage.open_read(layers[0][0]) is not None
+        assert self._storage.open_read(layers[1][0]) is None
+        assert self._storage.open_read(layers[2][0]) is None
+        # Too big to be cached
+        path, content = self._layer(4000)
+        assert self._read(path) == content
+        assert self._storage.open_read(path) is None
+
+
+def test_check():
+    assert driver.check('a-b_c.d') == 'a-b_c.d'
+    assert driver.check('.') == '%2E'
+    assert driver.check('..') == '%2E%2E'
+    assert driver.check('a b/c') == 'a+b%2Fc'
+    # Memoized
+    assert driver.check('a b/c') == 'a+b%2Fc'
+
+
+def test_walk_empty_directory():
+    class Storage(driver.Base):
+        def list_directory(self, path=None):
+            if path == 'base':
+                return iter(['base/empty', 'base/file'])
+            # Nothing in there, be it a file or an empty directory
+            raise exceptions.FileNotFoundError('%s is not there' % path)
+
+        def get_size(self, path):
+            if path == 'base/file':
+                return 3
+            raise exceptions.FileNotFoundError('%s is not there' % path)
+
+    assert list(Storage().walk('base')) == [('base/file', 3, None)]
+
+
+def test_stream_write_size():
+    from docker_registry.drivers import dumb
+    original = dumb.Storage
+
+    class Storage(original):
+        # Written before the size hint
+        def stream_write(self, path, fp):
+            return original.stream_write(self, path, fp)
+
+    dumb.Storage = Storage
+    try:
+        store = driver.fetch('dumb')()
+        store.stream_write('foo', compat.StringIO('bar'), 3)
+        assert ''.join(store.stream_read('foo')) == 'bar'
+        store.remove('foo')
+        # Wrapped once only
+        wrapper = Storage.__dict__['stream_write']
+        driver.fetch('dumb')
+        assert Storage.__dict__['stream_write'] is wrapper
+    finally:
+        dumb.Storage = original
+    # Drivers taking it are left alone
+    stream_write = original.__dict__['stream_write']
+    driver.fetch('dumb')
+    assert original.__dict__['stream_write'] is stream_write
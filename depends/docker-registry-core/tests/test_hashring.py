@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Docker.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import redis
+
+from docker_registry.core import breaker
+from docker_registry.core import hashring
+
+
+def test_ring_balance():
+    ring = hashring.HashRing(['a', 'b', 'c'])
+    owners = [ring.index('images/{0}/json'.format(i)) for i in range(3000)]
+    for n in range(3):
+        assert 800 < owners.count(n) < 1200
+
+
+def test_ring_minimal_moves():
+    keys = ['images/{0}/json'.format(i) for i in range(3000)]
+    before = hashring.HashRing(['a', 'b', 'c'])
+    after = hashring.HashRing(['a', 'b', 'c', 'd'])
+    moved = [key for key in keys if before.nodes[before.index(key)] !=
+             after.nodes[after.index(key)]]
+    # Only towards the new node, about a quarter of them
+    assert all(after.nodes[after.index(key)] == 'd' for key in moved)
+    assert 500 < len(moved) < 1000
+
+
+def test_route():
+    assert hashring.route('cache_path:/images/42/json') == (
+        hashring.route('cache_digest:/images/42/json'))
+
+
+class TestShardedRedis(object):
+
+    def setUp(self):
+        self._conn = hashring.ShardedRedis(
+            [breaker.Redis(db=1), breaker.Redis(db=2)], ['a', 'b'])
+        self._keys = ['test:images/{0}/json'.format(i) for i in range(20)]
+
+    def tearDown(self):
+        self._conn.delete(*self._keys)
+
+    def testSpread(self):
+        for key in self._keys:
+            self._conn.set(key, key)
+        assert 0 < breaker.Redis(db=1).dbsize() < 20
+        assert 0 < breaker.Redis(db=2).dbsize() < 20
+        assert all(self._conn.get(key) == key for key in self._keys)
+        assert self._conn.delete(*self._keys) == 20
+
+    def testPipeline(self):
+        pipe = self._conn.pipeline()
+        for key in self._keys:
+            pipe.set(key, key)
+        assert pipe.execute() == [True] * 20
+        for key in self._keys:
+            pipe.get(key)
+        assert pipe.execute() == self._keys
+
+    def testNodeDown(self):
+        # Nothing listens on port 1
+        down = breaker.Redis(port=1, socket_connect_timeout=0.1)
+        conn = hashring.ShardedRedis([breaker.Redis(db=1), down], ['a', 'b'])
+        pipe = conn.pipeline()
+        for key in self._keys:
+            pipe.set(key, key)
+        results = pipe.execute(raise_on_error=False)
+        up = [key for key, result in zip(self._keys, results)
+              if result is True]
+        assert 0 < len(up) < 20
+        assert all(isinstance(result, redis.exceptions.ConnectionError)
+                   for result in results if result is not True)
+        assert all(conn.get(key) == key for key in up)
@@ -14,8 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
+
+from nose import tools
+
 from docker_registry.core import compat
+from docker_registry.core import exceptions
 from docker_registry.core import lru
+from docker_registry.core import sharedcache
 
 # In case you want to mock (and that doesn't work well)
 # import mock
@@ -51,6 +59,28 @@ class Dumb(object):
         del self.value[key]
 
 
+class Probed(Dumb):
+
+    negative_cache = True
+    calls = 0
+
+    @lru.missing()
+    def get_content(self, key):
+        self.calls += 1
+        if key not in self.value:
+            raise exceptions.FileNotFoundError('%s is not there' % key)
+        return self.value[key]
+
+    @lru.missing(False)
+    def exists(self, key):
+        self.calls += 1
+        return key in self.value
+
+    @lru.created
+    def write(self, key, value):
+        self.value[key] = value
+
+
 class TestLru(object):
 
     def setUp(self):
@@ -112,3 +142,315 @@ class TestLru(object):
         self._dumb.remove('foo')
         assert not self._dumb.get('foo')
         assert not self._dumb.get('foo')
+
+    def testSetUnchanged(self):
+        self._dumb.set('foo', 'bar')
+        assert lru.redis_conn.get(lru.digest_key('foo'))
+        self._dumb.value['foo'] = 'untouched'
+        # Same content: skipped on its digest alone
+        self._dumb.set('foo', 'bar')
+        assert self._dumb.value['foo'] == 'untouched'
+        self._dumb.set('foo', 'baz')
+        assert self._dumb.value['foo'] == 'baz'
+        assert self._dumb.get('foo') == b'baz'
+
+    def testGetMany(self):
+        self._dumb.set('foo', 'bar')
+        self._dumb.remove('baz')
+        assert lru.get_many(['foo', 'baz']) == {'foo': b'bar'}
+
+    def testRemoveDigest(self):
+        self._dumb.set('foo', 'bar')
+        self._dumb.remove('foo')
+        assert not lru.redis_conn.get(lru.digest_key('foo'))
+
+
+class TestMissing(object):
+
+    def setUp(self):
+        self._probed = Probed()
+        self._probed.remove('missing')
+        lru.redis_conn.delete(lru.missing_key('missing'))
+
+    def testExists(self):
+        assert not self._probed.exists('missing')
+        assert not self._probed.exists('missing')
+        assert self._probed.calls == 1
+        assert lru.redis_conn.ttl(lru.missing_key('missing')) > 0
+
+    @tools.raises(exceptions.FileNotFoundError)
+    def testGetContent(self):
+        try:
+            self._probed.get_content('missing')
+        except exceptions.FileNotFoundError:
+            pass
+        try:
+            self._probed.get_content('missing')
+        finally:
+            assert self._probed.calls == 1
+
+    def testForgetOnSet(self):
+        assert not self._probed.exists('missing')
+        self._probed.set('missing', 'bar')
+        assert self._probed.exists('missing')
+
+    def testForgetOnCreated(self):
+        assert not self._probed.exists('missing')
+        self._probed.write('missing', 'bar')
+        assert self._probed.get_content('missing') == 'bar'
+
+    def testDisabled(self):
+        ttl = lru.missing_ttl
+        lru.missing_ttl = 0
+        try:
+            assert not self._probed.exists('missing')
+            assert not self._probed.exists('missing')
+            assert self._probed.calls == 2
+        finally:
+            lru.missing_ttl = ttl
+
+    def testOptIn(self):
+        # Drivers not forgetting misses on all their writes don't cache them
+        self._probed.negative_cache = False
+        assert not self._probed.exists('missing')
+        assert not self._probed.exists('missing')
+        assert self._probed.calls == 2
+        assert not lru.redis_conn.get(lru.missing_key('missing'))
+
+
+class TestPolicies(object):
+
+    def setUp(self):
+        self._dumb = Dumb()
+
+    def tearDown(self):
+        lru.set_policy('files', max_size=1024 * 1024)
+
+    def testPolicyOf(self):
+        assert lru.policy('images/42/json') == lru.policies['image_json'][1]
+        assert lru.policy('images/ab/cd/42/_files') == (
+            lru.policies['files'][1])
+        assert lru.policy('repositories/foo/bar/tag_latest') == (
+            lru.policies['tag'][1])
+        assert lru.policy('repositories/foo/bar/json') == lru.default_policy
+
+    def testTtl(self):
+        self._dumb.set('images/42/_diff', 'bar')
+        ttl = lru.redis_conn.ttl(lru.cache_key('images/42/_diff'))
+        assert 0 < ttl <= lru.policies['diff'][1].ttl
+
+    def testRenewOnHit(self):
+        path = 'images/42/json'
+        self._dumb.set(path, 'bar')
+        lru.redis_conn.expire(lru.cache_key(path), 10)
+        assert self._dumb.get(path) == b'bar'
+        assert lru.redis_conn.ttl(lru.cache_key(path)) > 10
+
+    def testMaxSize(self):
+        path = 'images/42/_files'
+        self._dumb.set(path, 'bar')
+        assert lru.redis_conn.get(lru.cache_key(path)) == b'bar'
+        lru.set_policy('files', max_size=2)
+        self._dumb.set(path, 'baz')
+        assert lru.redis_conn.get(lru.cache_key(path)) is None
+        assert lru.redis_conn.get(lru.digest_key(path)) is None
+        assert self._dumb.get(path) == 'baz'
+
+
+class TestLocalLru(object):
+
+    path = 'images/42/json'
+
+    def setUp(self):
+        lru.init_local(size=1024, ttl=60)
+        self._dumb = Dumb()
+
+    def tearDown(self):
+        lru.init_local(size=0)
+
+    def testLocalHit(self):
+        self._dumb.set(self.path, u'ß')
+        self._dumb.value[self.path] = 'changed behind our back'
+        lru.redis_conn.delete(lru.cache_key(self.path))
+        assert self._dumb.get(self.path) == b'\xc3\x9f'
+
+    def testLocalOnlyMetadata(self):
+        self._dumb.set('foo', 'bar')
+        assert lru.local.get('foo') is None
+        self._dumb.set(self.path, 'bar')
+        assert lru.local.get(self.path) == b'bar'
+
+    def testLocalRemoveTree(self):
+        self._dumb.set(self.path, 'bar')
+        self._dumb.remove('images/42')
+        assert lru.local.get(self.path) is None
+
+    def testLocalEviction(self):
+        cache = lru.LocalCache(10, 60)
+        cache.set('a', b'12345')
+        cache.set('b', b'12345')
+        cache.get('a')
+        cache.set('c', b'12345')
+        assert cache.get('b') is None
+        assert cache.get('a') == b'12345'
+        assert cache.size == 10
+        cache.set('d', b'x' * 11)
+        assert cache.get('d') is None
+
+    def testLocalExpiry(self):
+        cache = lru.LocalCache(10, -1)
+        cache.set('a', b'12345')
+        assert cache.get('a') is None
+        assert cache.size == 0
+
+    def testLocalWithoutRedis(self):
+        conn = lru.redis_conn
+        lru.redis_conn = None
+        try:
+            self._dumb.set(self.path, 'bar')
+            self._dumb.value[self.path] = 'changed'
+            assert self._dumb.get(self.path) == b'bar'
+        finally:
+            lru.redis_conn = conn
+
+
+class TestSharedLru(object):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'cache')
+        # 8 slots of 1KB, in 2 sets
+        self._cache = sharedcache.SharedCache(self._path, 8 * 1024, 60,
+                                              slot_size=1024)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+        lru.init_local(size=0)
+
+    def testShared(self):
+        other = sharedcache.SharedCache(self._path, 8 * 1024, 60,
+                                        slot_size=1024)
+        self._cache.set('images/42/json', b'{}')
+        assert other.get('images/42/json') == b'{}'
+        other.set('images/42/json', b'{"id": "42"}')
+        assert self._cache.get('images/42/json') == b'{"id": "42"}'
+        other.delete('images/42/json')
+        assert self._cache.get('images/42/json') is None
+
+    def testBounded(self):
+        for i in range(20):
+            self._cache.set('images/{0}/json'.format(i), b'x' * 100)
+        assert os.path.getsize(self._path) == 64 + 8 * 1024
+        found = [i for i in range(20)
+                 if self._cache.get('images/{0}/json'.format(i))]
+        assert 0 < len(found) <= 8
+        # Too big for a slot
+        self._cache.set('images/42/json', b'{}')
+        self._cache.set('images/42/json', b'x' * 1024)
+        assert self._cache.get('images/42/json') is None
+
+    def testExpiry(self):
+        cache = sharedcache.SharedCache(self._path, 8 * 1024, -1,
+                                        slot_size=1024)
+        cache.set('images/42/json', b'{}')
+        assert cache.get('images/42/json') is None
+
+    def testDeleteTree(self):
+        self._cache.set('images/42/json', b'{}')
+        self._cache.set('images/42/ancestry', b'[]')
+        self._cache.set('images/4242/json', b'{}')
+        self._cache.delete_tree('images/42')
+        assert self._cache.get('images/42/json') is None
+        assert self._cache.get('images/42/ancestry') is None
+        assert self._cache.get('images/4242/json') == b'{}'
+        image_dir = 'images/{0}'.format('a' * 16)
+        self._cache.set(image_dir + '/json', b'{}')
+        self._cache.set(image_dir + '/_checksum', b'[]')
+        self._cache.delete_tree(image_dir + '/_inprogress')
+        assert self._cache.get(image_dir + '/json') == b'{}'
+        self._cache.delete_tree(image_dir)
+        assert self._cache.get(image_dir + '/json') is None
+        assert self._cache.get(image_dir + '/_checksum') is None
+        # Everything
+        self._cache.delete_tree('')
+        assert self._cache.get('images/4242/json') is None
+
+    def testRecreated(self):
+        self._cache.set('images/42/json', b'{}')
+        # Different geometry: starts over with a new file
+        other = sharedcache.SharedCache(self._path, 16 * 1024, 60,
+                                        slot_size=1024)
+        assert other.get('images/42/json') is None
+        assert os.path.getsize(self._path) == 64 + 16 * 1024
+        assert self._cache.get('images/42/json') == b'{}'
+
+    def testLru(self):
+        lru.init_local(size=8 * 1024, path=self._path)
+        dumb = Dumb()
+        dumb.set('images/42/json', 'bar')
+        dumb.value['images/42/json'] = 'changed'
+        lru.redis_conn.delete(lru.cache_key('images/42/json'))
+        assert dumb.get('images/42/json') == b'bar'
+        # Tags change through other hosts: never held
+        dumb.set('repositories/foo/bar/tag_latest', 'bar')
+        dumb.value['repositories/foo/bar/tag_latest'] = 'changed'
+        lru.redis_conn.delete(
+            lru.cache_key('repositories/foo/bar/tag_latest'))
+        assert dumb.get('repositories/foo/bar/tag_latest') == b'changed'
+
+
+class TestStats(object):
+
+    path = 'images/42/json'
+
+    def setUp(self):
+        lru.stats.reset()
+        self._dumb = Dumb()
+        self._dumb.remove(self.path)
+
+    def tearDown(self):
+        lru.init_local(size=0)
+
+    def _counters(self, path_class='image_json'):
+        return lru.stats.snapshot()['classes'][path_class]
+
+    def testCounters(self):
+        self._dumb.value[self.path] = 'bar'
+        self._dumb.get(self.path)
+        self._dumb.get(self.path)
+        self._dumb.set(self.path, 'bar')
+        self._dumb.set(self.path, 'baz')
+        counters = self._counters()
+        assert counters['misses'] == 1
+        assert counters['hits'] == 1
+        assert counters['skipped_sets'] == 1
+        assert counters['sets'] == 1
+        assert counters['hit_ratio'] == 0.5
+        latencies = counters['latency_ms']
+        assert sum(latencies['fetch'].values()) == 2
+        assert sum(latencies['backend'].values()) == 1
+        assert set(latencies['fetch']) == set(
+            ['1', '2.5', '5', '10', '25', '50', '100', '250', '500', '1000',
+             'inf'])
+        self._dumb.get('nonexistent')
+        assert self._counters('other')['misses'] == 1
+
+    def testLocal(self):
+        lru.init_local(size=10, ttl=60)
+        self._dumb.set('images/1/json', b'12345')
+        self._dumb.set('images/2/ancestry', b'12345')
+        self._dumb.get('images/2/ancestry')
+        self._dumb.set('images/3/json', b'12345')
+        assert self._counters('ancestry')['local_hits'] == 1
+        assert self._counters()['evictions'] == 1
+
+    def testErrors(self):
+        conn = lru.redis_conn
+        lru.init(port=1, socket_connect_timeout=0.1)
+        try:
+            self._dumb.value[self.path] = 'bar'
+            assert self._dumb.get(self.path) == 'bar'
+        finally:
+            lru.redis_conn = conn
+        # Reading, then caching what was read
+        assert self._counters()['errors'] == 2
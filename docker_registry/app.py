@@ -20,6 +20,7 @@ logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt="%d/%b/%Y:%H:%M:%S %z")
 
 from .lib import mirroring  # noqa
+from .lib import stats  # noqa
 
 app = flask.Flask('docker-registry')
 
@@ -54,6 +55,21 @@ def ping():
     return toolkit.response(infos, headers=headers)
 
 
+@app.route('/_stats')
+@toolkit.requires_auth
+def cache_stats():
+    """Statistics of the caches, as seen by the worker answering."""
+    if not stats.exposed():
+        return toolkit.api_error('Not found', 404)
+    return toolkit.response(stats.snapshot())
+
+
+@app.after_request
+def log_stats(response):
+    stats.maybe_log()
+    return response
+
+
 @app.route('/')
 def root():
     return toolkit.response(cfg.issue)
@@ -17,20 +17,27 @@ u'fix for gevent deadlock'.encode('idna')
 import gevent.monkey
 gevent.monkey.patch_all()
 
+import gevent.pool
+
 import docker_registry.core.boto as coreboto
 from docker_registry.core import compat
 from docker_registry.core import exceptions
 from docker_registry.core import lru
 
+import base64
+import hashlib
+import itertools
 import logging
 import os
 import re
+import tempfile
 import time
 
 import boto.exception
 import boto.s3
 import boto.s3.connection
 import boto.s3.key
+import boto.s3.multipart
 
 logger = logging.getLogger(__name__)
 
@@ -68,8 +75,15 @@ class Cloudfront(object):
 
 class Storage(coreboto.Base):
 
+    # Writes all go through lru.set or lru.created
+    negative_cache = True
+
     def __init__(self, path, config):
         super(Storage, self).__init__(path, config)
+        # Minimum size of upload part size on S3 is 5MB
+        self._upload_part_size = max(self._config.s3_upload_part_size or 0,
+                                     5 * 1024 * 1024)
+        self._upload_concurrency = self._config.s3_upload_concurrency or 4
 
     def _build_connection_params(self):
         kwargs = super(Storage, self)._build_connection_params()
@@ -94,7 +108,9 @@ class Storage(coreboto.Base):
         if self._config.s3_use_sigv4 is True:
             if self._config.boto_host is None:
                 logger.warn("No S3 Host specified, Boto won't use SIGV4!")
-            boto.config.add_section('s3')
+            # Called for every pooled connection
+            if not boto.config.has_section('s3'):
+                boto.config.add_section('s3')
             boto.config.set('s3', 'use-sigv4', 'True')
 
         if self._config.s3_region is not None:
@@ -115,6 +131,7 @@ class Storage(coreboto.Base):
         return boto.s3.key.Key(self._boto_bucket, path)
 
     @lru.set
+    @coreboto.pooled
     def put_content(self, path, content):
         path = self._init_path(path)
         key = self.makeKey(path)
@@ -122,28 +139,142 @@ class Storage(coreboto.Base):
             content, encrypt_key=(self._config.s3_encrypt is True))
         return path
 
-    def stream_write(self, path, fp):
-        # Minimum size of upload part size on S3 is 5MB
-        buffer_size = 5 * 1024 * 1024
-        if self.buffer_size > buffer_size:
-            buffer_size = self.buffer_size
-        path = self._init_path(path)
-        mp = self._boto_bucket.initiate_multipart_upload(
-            path, encrypt_key=(self._config.s3_encrypt is True))
-        num_part = 1
+    @coreboto.pooled
+    def _upload_part(self, path, upload_id, buf, num_part):
+        # Parts go concurrently, each on a connection of its own.
+        # Hash in one go, boto would otherwise read the part once more
+        md5 = hashlib.md5(buf)
+        io = compat.StringIO(buf)
+        try:
+            self._multipart(path, upload_id).upload_part_from_file(
+                io, num_part, size=len(buf),
+                md5=(md5.hexdigest(), base64.b64encode(md5.digest())))
+        finally:
+            io.close()
+
+    @coreboto.pooled
+    def _put_small(self, path, buf):
+        md5 = hashlib.md5(buf)
+        key = self.makeKey(path)
+        key.set_contents_from_string(
+            buf, encrypt_key=(self._config.s3_encrypt is True),
+            md5=(md5.hexdigest(), base64.b64encode(md5.digest())))
+
+    def _read_part(self, fp, part_size):
+        """Read part_size bytes from fp, less only at EOF.
+
+        A read may return less than asked (sockets do): a short part
+        would look like the last one, or be refused by S3.
+        """
+        bufs = []
+        missing = part_size
+        while missing:
+            buf = fp.read(missing)
+            if not buf:
+                break
+            bufs.append(buf)
+            missing -= len(buf)
+        return ''.join(bufs)
+
+    @lru.created
+    def stream_write(self, path, fp, size=None):
+        part_size = max(self._upload_part_size, self.buffer_size)
+        if size:
+            # S3 accepts at most 10000 parts
+            part_size = max(part_size, -(-size // 10000))
+        # Anything that fits in a single part is sent with a single PUT,
+        # instead of the 3 requests of a multipart upload. Without a size
+        # hint, we only know after peeking past the first part.
+        parts = [self._read_part(fp, part_size)]
+        if size is not None and size <= part_size:
+            return self._put_small(self._init_path(path), parts[0])
+        if len(parts[0]) == part_size:
+            parts.append(self._read_part(fp, part_size))
+        if not parts[-1] or len(parts) == 1:
+            return self._put_small(self._init_path(path), parts[0])
+        # Each request checks a connection out, none is held in between
+        upload_id = self.upload_init(path)
+        parts = itertools.chain(
+            parts, iter(lambda: self._read_part(fp, part_size), ''))
+        # Parts are read while the previous ones are being uploaded. At most
+        # s3_upload_concurrency parts are in flight (spawn blocks when the
+        # pool is full), which bounds the memory used by an upload.
+        pool = gevent.pool.Pool(self._upload_concurrency)
+        errors = []
+        try:
+            for num_part, buf in enumerate(parts, 1):
+                if errors:
+                    break
+                g = pool.spawn(self._upload_part, path, upload_id, buf,
+                               num_part)
+                g.link_exception(lambda g: errors.append(g.exception))
+            pool.join()
+            if errors:
+                raise errors[0]
+            self._multipart_complete(path, upload_id)
+        except Exception:
+            # Don't leave orphaned parts behind (S3 bills them)
+            pool.kill()
+            self.upload_abort(path, upload_id)
+            raise
+
+    # Resumable uploads are S3 multipart uploads, a part per chunk
+    upload_min_part = 5 * 1024 * 1024
+
+    def _multipart(self, path, upload_id):
+        # A handle on the bucket of the connection held by the caller
+        mp = boto.s3.multipart.MultiPartUpload(self._boto_bucket)
+        mp.key_name = self._init_path(path)
+        mp.id = upload_id
+        return mp
+
+    @coreboto.pooled
+    def upload_init(self, path):
+        return self._boto_bucket.initiate_multipart_upload(
+            self._init_path(path),
+            encrypt_key=(self._config.s3_encrypt is True)).id
+
+    @coreboto.pooled
+    def upload_part(self, path, upload_id, number, offset, fp, size=None):
+        # Spooled to hash it before sending, which S3 wants up front.
+        # Uploading a part number again replaces it.
+        md5 = hashlib.md5()
+        tmp = tempfile.SpooledTemporaryFile(max_size=self._upload_part_size)
         try:
             while True:
-                buf = fp.read(buffer_size)
+                buf = fp.read(self.buffer_size)
                 if not buf:
                     break
-                io = compat.StringIO(buf)
-                mp.upload_part_from_file(io, num_part)
-                num_part += 1
-                io.close()
-        except IOError as e:
-            raise e
-        mp.complete_upload()
+                md5.update(buf)
+                tmp.write(buf)
+            length = tmp.tell()
+            tmp.seek(0)
+            self._multipart(path, upload_id).upload_part_from_file(
+                tmp, number, size=length,
+                md5=(md5.hexdigest(), base64.b64encode(md5.digest())))
+        finally:
+            tmp.close()
+
+    @coreboto.pooled
+    def _multipart_complete(self, path, upload_id):
+        self._multipart(path, upload_id).complete_upload()
+
+    @lru.created
+    def upload_complete(self, path, upload_id, numbers):
+        # Parts are numbered in order by the caller, and a part that
+        # failed gets sent again under the same number: those uploaded
+        # are the ones wanted
+        self._multipart_complete(path, upload_id)
 
+    @coreboto.pooled
+    def upload_abort(self, path, upload_id):
+        try:
+            self._multipart(path, upload_id).cancel_upload()
+        except boto.exception.S3ResponseError as e:
+            if e.status != 404:
+                raise
+
+    @coreboto.pooled
     def content_redirect_url(self, path):
         path = self._init_path(path)
         key = self.makeKey(path)
@@ -160,12 +291,13 @@ class Storage(coreboto.Base):
         # Have cloudfront? Sign it
         return self.signer(path, expire_time=60)
 
-    def get_content(self, path, tries=0):
-        try:
-            return super(Storage, self).get_content(path)
-        except exceptions.FileNotFoundError as e:
-            if tries <= 3:
+    @lru.missing()
+    def get_content(self, path):
+        # Retried, in case it has just been written. Once given up on, the
+        # miss is remembered: probing it again doesn't wait anymore.
+        for _ in range(4):
+            try:
+                return self._get_content(path)
+            except exceptions.FileNotFoundError:
                 time.sleep(.1)
-                return self.get_content(path, tries + 1)
-            else:
-                raise e
+        return self._get_content(path)
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import binascii
 import datetime
 import functools
+import hashlib
+import itertools
 import logging
+import os
 import time
 
 import flask
+import gevent.pool
+import werkzeug.wsgi
 
 from docker_registry.core import compat
 from docker_registry.core import exceptions
@@ -19,7 +25,9 @@ from .lib import cache
 from .lib import checksums
 from .lib import layers
 from .lib import mirroring
+from .lib import popularity
 from .lib import signals
+from .lib import uploads
 # this is our monkey patched snippet from python v2.7.6 'tarfile'
 # with xattr support
 from .lib.xtarfile import tarfile
@@ -29,18 +37,38 @@ store = storage.load()
 logger = logging.getLogger(__name__)
 
 
+def _stat(path):
+    """Stat path, at most once per request.
+
+    Several checks of a request (push completion, layer size...) look at
+    the same paths, on remote storages each of them would cost a round trip.
+    Only use it on read paths: the memo is not invalidated by writes.
+    """
+    stats = getattr(flask.g, 'storage_stats', None)
+    if stats is None:
+        stats = flask.g.storage_stats = {}
+    if path not in stats:
+        stats[path] = store.stat(path)
+    return stats[path]
+
+
 def require_completion(f):
     """This make sure that the image push correctly finished."""
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        if store.exists(store.image_mark_path(kwargs['image_id'])):
+        if _stat(store.image_mark_path(kwargs['image_id'])).exists:
             return toolkit.api_error('Image is being uploaded, retry later')
         return f(*args, **kwargs)
     return wrapper
 
 
 def set_cache_headers(f):
-    """Returns HTTP headers suitable for caching."""
+    """Returns HTTP headers suitable for caching.
+
+    Images never change once pushed: a client having a copy of one, that
+    still exists, has a current copy. Entity tags are checked by the
+    handlers, `If-None-Match` wins over `If-Modified-Since` (RFC 7232).
+    """
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
         # Set TTL to 1 year by default
@@ -52,7 +80,9 @@ def set_cache_headers(f):
             'Expires': expires,
             'Last-Modified': 'Thu, 01 Jan 1970 00:00:00 GMT',
         }
-        if 'If-Modified-Since' in flask.request.headers:
+        if ('If-Modified-Since' in flask.request.headers and
+                'If-None-Match' not in flask.request.headers and
+                _stat(store.image_json_path(kwargs['image_id'])).exists):
             return flask.Response(status=304, headers=headers)
         kwargs['headers'] = headers
         # Prevent the Cookie to be sent when the object is cacheable
@@ -60,7 +90,35 @@ def set_cache_headers(f):
     return wrapper
 
 
-def _get_image_layer(image_id, headers=None, bytes_range=None):
+def _etag(content):
+    """Strong entity tag of content."""
+    if not isinstance(content, compat.bytes):
+        content = content.encode('utf8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def _not_modified(etag, headers):
+    """Set the ETag header, and tell whether the client has that version.
+    """
+    headers['ETag'] = '"{0}"'.format(etag)
+    return flask.request.if_none_match.contains_weak(etag)
+
+
+def _layer_etag(image_id):
+    """Entity tag of a layer: its checksum, None if it has none."""
+    try:
+        checksums = load_checksums(image_id)
+    except exceptions.FileNotFoundError:
+        return None
+    if not checksums:
+        return None
+    return checksums[0]
+
+
+def _get_image_layer(image_id, headers=None, ranges=None):
+    """Response with the layer of image_id, or the ranges of it asked for
+    (as parsed by _parse_ranges).
+    """
     if headers is None:
         headers = {}
 
@@ -89,30 +147,36 @@ def _get_image_layer(image_id, headers=None, bytes_range=None):
             logger.debug(str(e))
 
     status = None
-    layer_size = 0
 
-    if not store.exists(path):
+    stat = _stat(path)
+    if not stat.exists:
         raise exceptions.FileNotFoundError("Image layer absent from store")
-    try:
-        layer_size = store.get_size(path)
-    except exceptions.FileNotFoundError:
-        # XXX why would that fail given we know the layer exists?
-        pass
-    if bytes_range and bytes_range[1] == -1 and not layer_size == 0:
-        bytes_range = (bytes_range[0], layer_size)
-
-    if bytes_range:
-        content_length = bytes_range[1] - bytes_range[0] + 1
-        if not _valid_bytes_range(bytes_range):
+    layer_size = stat.size
+    bytes_range = None
+    if ranges:
+        spans = _satisfiable_ranges(ranges, layer_size)
+        if not spans:
+            headers['Content-Range'] = 'bytes */{0}'.format(layer_size)
             return flask.Response(status=416, headers=headers)
+        if len(spans) > 1:
+            return _multipart_layer(path, spans, layer_size, headers)
+        bytes_range = spans[0]
         status = 206
-        content_range = (bytes_range[0], bytes_range[1], layer_size)
-        headers['Content-Range'] = '{0}-{1}/{2}'.format(*content_range)
-        headers['Content-Length'] = content_length
+        headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+            bytes_range[0], bytes_range[1], layer_size)
+        headers['Content-Length'] = bytes_range[1] - bytes_range[0] + 1
     elif layer_size > 0:
         headers['Content-Length'] = layer_size
     else:
         return flask.Response(status=416, headers=headers)
+    # If store gives us a real file, let the WSGI server send it from the page
+    # cache (sendfile) rather than copying every byte through python
+    layer_file = store.open_read(path, bytes_range)
+    if layer_file is not None:
+        body = werkzeug.wsgi.wrap_file(flask.request.environ, layer_file,
+                                       store.buffer_size)
+        return flask.Response(body, headers=headers, status=status,
+                              direct_passthrough=True)
     return flask.Response(store.stream_read(path, bytes_range),
                           headers=headers, status=status)
 
@@ -120,53 +184,134 @@ def _get_image_layer(image_id, headers=None, bytes_range=None):
 def _get_image_json(image_id, headers=None):
     if headers is None:
         headers = {}
-    data = store.get_content(store.image_json_path(image_id))
-    try:
-        size = store.get_size(store.image_layer_path(image_id))
-        headers['X-Docker-Size'] = str(size)
-    except exceptions.FileNotFoundError:
-        pass
-    try:
-        csums = load_checksums(image_id)
+    json_path = store.image_json_path(image_id)
+    checksum_path = store.image_checksum_path(image_id)
+    layer_path = store.image_layer_path(image_id)
+    # One batch for the json and checksum, instead of sequential round trips
+    contents = store.get_many([json_path, checksum_path])
+    if json_path not in contents:
+        raise exceptions.FileNotFoundError('%s is not there' % json_path)
+    if _not_modified(_etag(contents[json_path]), headers):
+        return flask.Response(status=304, headers=headers)
+    stat = _stat(layer_path)
+    if stat.exists:
+        headers['X-Docker-Size'] = str(stat.size)
+    if checksum_path in contents:
+        csums = _parse_checksums(contents[checksum_path])
         headers['X-Docker-Checksum-Payload'] = csums
-    except exceptions.FileNotFoundError:
-        pass
-    return toolkit.response(data, headers=headers, raw=True)
+    return toolkit.response(contents[json_path], headers=headers, raw=True)
+
 
+# More ranges than this in a request make it get the whole layer
+MAX_RANGES = 64
 
-def _parse_bytes_range():
-    headers = flask.request.headers
-    range_header = headers.get('range')
+
+def _parse_ranges():
+    """Byte ranges of the Range header (RFC 7233), as (first, last) pairs.
+
+    `last` is None for open ended ranges (`bytes=N-`), `first` is None for
+    suffixes (`bytes=-N`, last being N). Returns None when there is no
+    header, or one to ignore: malformed, another unit, too many ranges.
+    """
+    range_header = flask.request.headers.get('range')
     if not range_header:
         return
-    log_msg = ('_parse_bytes_range: Malformed bytes range request header: '
+    log_msg = ('_parse_ranges: Malformed bytes range request header: '
                '{0}'.format(range_header))
-    if not range_header.startswith('bytes='):
+    unit, _, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
         logger.debug(log_msg)
         return
-    bytes_range = range_header[6:].split('-')
-    if len(bytes_range) != 2 and not range_header[-1] == '-':
-        logger.debug(log_msg)
-        return
-    if len(bytes_range) == 1 or bytes_range[1] == '':
-        bytes_range = (bytes_range[0], -1)
+    ranges = []
+    for spec in specs.split(','):
+        first, sep, last = spec.strip().partition('-')
         try:
-            return (int(bytes_range[0]), -1)
+            first = int(first) if first else None
+            last = int(last) if last else None
         except ValueError:
+            sep = None
+        bounds = [n for n in (first, last) if n is not None]
+        if (not sep or not bounds or min(bounds) < 0 or
+                len(bounds) == 2 and last < first):
             logger.debug(log_msg)
-    try:
-        return (int(bytes_range[0]), int(bytes_range[1]))
-    except ValueError:
-        logger.debug(log_msg)
+            return
+        ranges.append((first, last))
+    if len(ranges) > MAX_RANGES:
+        logger.debug('_parse_ranges: {0} ranges, ignored'.format(
+            len(ranges)))
+        return
+    return ranges
+
+
+def _satisfiable_ranges(ranges, size):
+    """Satisfiable ranges of a size bytes content, as inclusive (first,
+    last) offsets, sorted.
+
+    Overlapping and adjacent ranges are coalesced: each is read with a
+    single storage request.
+    """
+    spans = []
+    for first, last in ranges:
+        if first is None:
+            # Suffix
+            if not last:
+                continue
+            first, last = max(size - last, 0), size - 1
+        elif first >= size:
+            continue
+        elif last is None or last >= size:
+            last = size - 1
+        spans.append((first, last))
+    spans.sort()
+    coalesced = []
+    for first, last in spans:
+        if coalesced and first <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], last))
+        else:
+            coalesced.append((first, last))
+    return coalesced
 
 
-def _valid_bytes_range(bytes_range):
-    length = bytes_range[1] - bytes_range[0] + 1
-    if bytes_range[0] < 0 or bytes_range[1] < 1:
-        return False
-    if length < 2:
-        return False
-    return True
+def _read_range(path, bytes_range):
+    layer_file = store.open_read(path, bytes_range)
+    if layer_file is None:
+        for buf in store.stream_read(path, bytes_range):
+            yield buf
+        return
+    try:
+        while True:
+            buf = layer_file.read(store.buffer_size)
+            if not buf:
+                break
+            yield buf
+    finally:
+        layer_file.close()
+
+
+def _multipart_layer(path, spans, size, headers):
+    """206 response with several ranges of the layer at path, as a
+    multipart/byteranges body.
+    """
+    boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+    part_headers = [('--{0}\r\nContent-Type: application/octet-stream\r\n'
+                     'Content-Range: bytes {1}-{2}/{3}\r\n\r\n').format(
+                         boundary, first, last, size)
+                    for first, last in spans]
+    end = '--{0}--\r\n'.format(boundary)
+    headers['Content-Type'] = 'multipart/byteranges; boundary={0}'.format(
+        boundary)
+    headers['Content-Length'] = sum(
+        len(part) + last - first + 1 + 2
+        for part, (first, last) in zip(part_headers, spans)) + len(end)
+
+    def body():
+        for part, span in zip(part_headers, spans):
+            yield part
+            for buf in _read_range(path, span):
+                yield buf
+            yield '\r\n'
+        yield end
+    return flask.Response(body(), headers=headers, status=206)
 
 
 @app.route('/v1/images/<image_id>/layer', methods=['GET'])
@@ -177,49 +322,82 @@ def _valid_bytes_range(bytes_range):
 @mirroring.source_lookup(cache=True, stream=True)
 def get_image_layer(image_id, headers):
     try:
-        bytes_range = None
+        ranges = None
         if store.supports_bytes_range:
             headers['Accept-Ranges'] = 'bytes'
-            bytes_range = _parse_bytes_range()
+            ranges = _parse_ranges()
         repository = toolkit.get_repository()
         if repository and store.is_private(*repository):
             if not toolkit.validate_parent_access(image_id):
                 return toolkit.api_error('Image not found', 404)
+        etag = _layer_etag(image_id)
+        if etag and _not_modified(etag, headers):
+            return flask.Response(status=304, headers=headers)
+        if_range = flask.request.headers.get('If-Range', '')
+        if if_range.startswith(('"', 'W/')) and (
+                not etag or if_range != headers['ETag']):
+            # Ranges of another version of the layer: send all of it.
+            # Dates are always fine, layers don't change.
+            ranges = None
         # If no auth token found, either standalone registry or privileged
         # access. In both cases, access is always "public".
-        return _get_image_layer(image_id, headers, bytes_range)
+        response = _get_image_layer(image_id, headers, ranges)
+        popularity.record_image(image_id, toolkit.get_remote_ip())
+        return response
     except exceptions.FileNotFoundError:
         return toolkit.api_error('Image not found', 404)
 
 
-@app.route('/v1/images/<image_id>/layer', methods=['PUT'])
-@toolkit.requires_auth
-@toolkit.valid_image_id
-def put_image_layer(image_id):
+def _check_layer_upload(image_id):
+    """Returns the json of image_id, and an error response when its layer
+    can't be uploaded.
+    """
     client_version = toolkit.docker_client_version()
     if client_version and client_version < (0, 10):
-        return toolkit.api_error(
+        return None, toolkit.api_error(
             'This endpoint does not support Docker daemons older than 0.10',
             412)
     try:
         json_data = store.get_content(store.image_json_path(image_id))
     except exceptions.FileNotFoundError:
-        return toolkit.api_error('Image not found', 404)
+        return None, toolkit.api_error('Image not found', 404)
     layer_path = store.image_layer_path(image_id)
     mark_path = store.image_mark_path(image_id)
-    if store.exists(layer_path) and not store.exists(mark_path):
-        return toolkit.api_error('Image already exists', 409)
-    input_stream = flask.request.stream
+    exists = store.exists_many([layer_path, mark_path])
+    if exists[layer_path] and not exists[mark_path]:
+        return None, toolkit.api_error('Image already exists', 409)
+    return json_data, None
+
+
+def _input_stream():
     if flask.request.headers.get('transfer-encoding') == 'chunked':
         # Careful, might work only with WSGI servers supporting chunked
         # encoding (Gunicorn)
-        input_stream = flask.request.environ['wsgi.input']
+        return flask.request.environ['wsgi.input']
+    return flask.request.stream
+
+
+@app.route('/v1/images/<image_id>/layer', methods=['PUT'])
+@toolkit.requires_auth
+@toolkit.valid_image_id
+def put_image_layer(image_id):
+    json_data, error = _check_layer_upload(image_id)
+    if error is not None:
+        return error
+    layer_path = store.image_layer_path(image_id)
     # compute checksums
     csums = []
-    sr = toolkit.SocketReader(input_stream)
+    # Received, hashed and stored concurrently
+    sr = toolkit.PipelinedReader(_input_stream())
     h, sum_hndlr = checksums.simple_checksum_handler(json_data)
     sr.add_handler(sum_hndlr)
-    store.stream_write(layer_path, sr)
+    try:
+        # Content-Length is unknown for chunked requests, the driver then
+        # finds out by itself
+        store.stream_write(layer_path, sr, flask.request.content_length)
+        sr.join()
+    finally:
+        sr.close()
     csums.append('sha256:{0}'.format(h.hexdigest()))
 
     # We store the computed checksums for a later check
@@ -227,6 +405,92 @@ def put_image_layer(image_id):
     return toolkit.response()
 
 
+def _upload_response(upload, code=200):
+    return toolkit.response({'offset': upload['offset']}, code, headers={
+        'X-Docker-Upload-Offset': str(upload['offset'])})
+
+
+@app.route('/v1/images/<image_id>/layer/upload', methods=['POST'])
+@toolkit.requires_auth
+@toolkit.valid_image_id
+def start_image_layer_upload(image_id):
+    _, error = _check_layer_upload(image_id)
+    if error is not None:
+        return error
+    return _upload_response(uploads.start(image_id), 201)
+
+
+@app.route('/v1/images/<image_id>/layer/upload', methods=['GET'])
+@toolkit.requires_auth
+@toolkit.valid_image_id
+def get_image_layer_upload(image_id):
+    try:
+        return _upload_response(uploads.state(image_id))
+    except exceptions.FileNotFoundError:
+        return toolkit.api_error('Upload not found', 404)
+
+
+@app.route('/v1/images/<image_id>/layer/upload', methods=['PUT'])
+@toolkit.requires_auth
+@toolkit.valid_image_id
+def put_image_layer_upload(image_id):
+    json_data, error = _check_layer_upload(image_id)
+    if error is not None:
+        return error
+    try:
+        upload = uploads.state(image_id)
+    except exceptions.FileNotFoundError:
+        return toolkit.api_error('Upload not found', 404)
+    offset = flask.request.args.get('offset', '')
+    last_offset = uploads.last_offset(upload)
+    # The last chunk can be sent again, replacing it
+    replace = offset.isdigit() and int(offset) == last_offset
+    if not replace and (not offset.isdigit() or
+                        int(offset) != upload['offset']):
+        # The client resumes from the offset we have
+        response = _upload_response(upload, 416)
+        response.headers['Content-Range'] = 'bytes */{0}'.format(
+            upload['offset'])
+        return response
+    if not replace and upload['parts'] and (
+            upload['parts'][-1][1] < store.upload_min_part):
+        # Only the last chunk can be short: the client sends it again along
+        # with what follows
+        return toolkit.api_error(
+            'Only the last chunk can be smaller than {0} bytes, send it '
+            'again from offset {1}'.format(store.upload_min_part,
+                                           last_offset),
+            headers={'X-Docker-Upload-Offset': str(last_offset)})
+    return _upload_response(uploads.append(
+        image_id, upload, json_data, _input_stream(),
+        flask.request.content_length, replace))
+
+
+@app.route('/v1/images/<image_id>/layer/upload/complete', methods=['POST'])
+@toolkit.requires_auth
+@toolkit.valid_image_id
+def complete_image_layer_upload(image_id):
+    json_data, error = _check_layer_upload(image_id)
+    if error is not None:
+        return error
+    try:
+        upload = uploads.state(image_id)
+    except exceptions.FileNotFoundError:
+        return toolkit.api_error('Upload not found', 404)
+    if not upload['parts']:
+        return toolkit.api_error('Nothing was uploaded')
+    save_checksums(image_id, [uploads.complete(image_id, upload, json_data)])
+    return toolkit.response()
+
+
+@app.route('/v1/images/<image_id>/layer/upload', methods=['DELETE'])
+@toolkit.requires_auth
+@toolkit.valid_image_id
+def abort_image_layer_upload(image_id):
+    uploads.abort(image_id)
+    return toolkit.response()
+
+
 @app.route('/v1/images/<image_id>/checksum', methods=['PUT'])
 @toolkit.requires_auth
 @toolkit.valid_image_id
@@ -271,7 +535,9 @@ def get_image_json(image_id, headers):
                 return toolkit.api_error('Image not found', 404)
         # If no auth token found, either standalone registry or privileged
         # access. In both cases, access is always "public".
-        return _get_image_json(image_id, headers)
+        response = _get_image_json(image_id, headers)
+        popularity.record_image(image_id, toolkit.get_remote_ip())
+        return response
     except exceptions.FileNotFoundError:
         return toolkit.api_error('Image not found', 404)
 
@@ -285,13 +551,153 @@ def get_image_json(image_id, headers):
 def get_image_ancestry(image_id, headers):
     ancestry_path = store.image_ancestry_path(image_id)
     try:
-        # Note(dmp): unicode patch
-        data = store.get_json(ancestry_path)
+        content = store.get_content(ancestry_path)
     except exceptions.FileNotFoundError:
         return toolkit.api_error('Image not found', 404)
+    if _not_modified(_etag(content), headers):
+        return flask.Response(status=304, headers=headers)
+    # Note(dmp): unicode patch
+    data = json.loads(content.decode('utf8')
+                      if isinstance(content, compat.bytes) else content)
     return toolkit.response(data, headers=headers)
 
 
+# Images whose metadata is read per storage batch, by the ancestry json
+ANCESTRY_BATCH = 10
+
+
+def _ancestry_entries(ancestry):
+    """Metadata of each image of ancestry, in order, read from the storage
+    a batch of images at a time.
+
+    The json is as stored: the checksums cover its exact bytes. It is None
+    for images missing from the store, so is the size of missing layers.
+    """
+    for start in range(0, len(ancestry), ANCESTRY_BATCH):
+        ids = ancestry[start:start + ANCESTRY_BATCH]
+        contents = store.get_many(
+            [store.image_json_path(i) for i in ids] +
+            [store.image_checksum_path(i) for i in ids])
+        stats = store.stat_many([store.image_layer_path(i) for i in ids])
+        for i in ids:
+            data = contents.get(store.image_json_path(i))
+            if isinstance(data, compat.bytes):
+                data = data.decode('utf8')
+            checksums = contents.get(store.image_checksum_path(i))
+            stat = stats[store.image_layer_path(i)]
+            yield {
+                'id': i,
+                'json': data,
+                'size': stat.size if stat.exists else None,
+                'checksums': (None if checksums is None
+                              else _parse_checksums(checksums)),
+            }
+
+
+def _layer_url(image_id):
+    try:
+        return store.content_redirect_url(store.image_layer_path(image_id))
+    except IOError as e:
+        logger.debug(str(e))
+
+
+def _layer_urls(image_ids):
+    """_layer_url of each of image_ids, in order.
+
+    Each is a request to remote storages: they run concurrently, a batch
+    at a time.
+    """
+    return gevent.pool.Pool(ANCESTRY_BATCH).map(_layer_url, image_ids)
+
+
+def _stream_ancestry_json(image_id, ancestry, layer_urls):
+    """Stream the entries of ancestry as they are read, then keep them
+    for next time when they are all complete.
+
+    The response is already sent when the document is stored, failures
+    to do so can only be logged.
+    """
+    parts = []
+    yield '['
+    entries = _ancestry_entries(ancestry)
+    while True:
+        # A batch as read by _ancestry_entries
+        batch = list(itertools.islice(entries, ANCESTRY_BATCH))
+        if not batch:
+            break
+        urls = [None] * len(batch)
+        if layer_urls:
+            urls = _layer_urls([entry['id'] for entry in batch])
+        for entry, url in zip(batch, urls):
+            part = json.dumps(entry, sort_keys=True)
+            # Missing images, layers not pushed yet or without checksums
+            # would be cached for good
+            complete = None not in (entry['json'], entry['size'],
+                                    entry['checksums'])
+            parts.append(part if complete else None)
+            if layer_urls:
+                entry['layer_url'] = url
+                part = json.dumps(entry, sort_keys=True)
+            yield (',' if len(parts) > 1 else '') + part
+    yield ']'
+    if None in parts:
+        return
+    try:
+        # Ancestries never change once pushed
+        store.put_content(store.image_ancestry_json_path(image_id),
+                          '[{0}]'.format(','.join(parts)))
+    except Exception as e:
+        logger.warning('Could not cache the ancestry json of {0}: '
+                       '{1}'.format(image_id, e))
+
+
+@app.route('/v1/images/<image_id>/ancestry/json', methods=['GET'])
+@toolkit.requires_auth
+@toolkit.valid_image_id
+@require_completion
+@set_cache_headers
+def get_image_ancestry_json(image_id, headers):
+    """The json, layer size and checksums of every image of the ancestry
+    of image_id, in a single response instead of a request per image.
+
+    With `?layer_urls=true` and `storage_redirect` set, also the URL to
+    download each layer from (`layer_url`, null when there is none).
+    """
+    repository = toolkit.get_repository()
+    if repository and store.is_private(*repository):
+        if not toolkit.validate_parent_access(image_id):
+            return toolkit.api_error('Image not found', 404)
+    layer_urls = bool(cfg.storage_redirect and
+                      flask.request.args.get('layer_urls') in ('1', 'true'))
+    if layer_urls:
+        # Redirect URLs expire
+        headers = {}
+    try:
+        data = store.get_content(store.image_ancestry_json_path(image_id))
+    except exceptions.FileNotFoundError:
+        data = None
+    if data is not None and not layer_urls:
+        if _not_modified(_etag(data), headers):
+            return flask.Response(status=304, headers=headers)
+        return toolkit.response(data, headers=headers, raw=True)
+    if data is not None:
+        entries = json.loads(data)
+        urls = _layer_urls([entry['id'] for entry in entries])
+        for entry, url in zip(entries, urls):
+            entry['layer_url'] = url
+        return toolkit.response(entries, headers=headers)
+    try:
+        ancestry = store.get_json(store.image_ancestry_path(image_id))
+    except exceptions.FileNotFoundError:
+        return toolkit.api_error('Image not found', 404)
+    headers['Content-Type'] = 'application/json'
+    # No ETag: it is the hash of the document, only known once it is all
+    # sent. Later responses are served from the cache, with one.
+    return flask.Response(
+        _stream_ancestry_json(image_id, ancestry, layer_urls),
+        headers=headers)
+
+
 def check_images_list(image_id):
     if cfg.disable_token_auth is True or cfg.standalone is True:
         # We enforce the check only when auth is enabled so we have a token.
@@ -318,7 +724,10 @@ def save_checksums(image_id, checksums):
 
 def load_checksums(image_id):
     checksum_path = store.image_checksum_path(image_id)
-    data = store.get_content(checksum_path)
+    return _parse_checksums(store.get_content(checksum_path))
+
+
+def _parse_checksums(data):
     try:
         # Note(dmp): unicode patch NOT applied here
         return json.loads(data)
@@ -354,7 +763,8 @@ def put_image_json(image_id):
         return toolkit.api_error('Image depends on an unauthorized parent')
     json_path = store.image_json_path(image_id)
     mark_path = store.image_mark_path(image_id)
-    if store.exists(json_path) and not store.exists(mark_path):
+    exists = store.exists_many([json_path, mark_path])
+    if exists[json_path] and not exists[mark_path]:
         return toolkit.api_error('Image already exists', 409)
 
     sender = flask.current_app._get_current_object()
@@ -390,6 +800,8 @@ def get_image_files(image_id, headers):
         # If no auth token found, either standalone registry or privileged
         # access. In both cases, access is always "public".
         data = layers.get_image_files_json(image_id)
+        if _not_modified(_etag(data), headers):
+            return flask.Response(status=304, headers=headers)
         return toolkit.response(data, headers=headers, raw=True)
     except exceptions.FileNotFoundError:
         return toolkit.api_error('Image not found', 404)
@@ -418,6 +830,8 @@ def get_image_diff(image_id, headers):
             layers.diff_queue.push(image_id)
             # empty response
             diff_json = ""
+        elif _not_modified(_etag(diff_json), headers):
+            return flask.Response(status=304, headers=headers)
 
         return toolkit.response(diff_json, headers=headers, raw=True)
     except exceptions.FileNotFoundError:
@@ -2,8 +2,10 @@
 
 import logging
 
-import redis
+import redis  # noqa
 
+from docker_registry.core import breaker
+from docker_registry.core import compat
 from docker_registry.core import lru
 
 from . import config
@@ -19,6 +21,16 @@ cfg = config.load()
 def init():
     enable_redis_cache(cfg.cache, cfg.storage_path)
     enable_redis_lru(cfg.cache_lru, cfg.storage_path)
+    enable_local_lru(cfg.cache_lru)
+
+
+def _client_options(cache):
+    """Timeouts and circuit breaker settings of a Redis client."""
+    return dict(
+        socket_timeout=cache.timeout or 1,
+        socket_connect_timeout=cache.connect_timeout or 0.5,
+        threshold=cache.breaker_threshold or 5,
+        reset_timeout=cache.breaker_reset or 10)
 
 
 def enable_redis_cache(cache, path):
@@ -31,30 +43,68 @@ def enable_redis_cache(cache, path):
     logger.info(
         'Redis host: {0}:{1} (db{2})'.format(cache.host, cache.port, cache.db)
     )
-    redis_conn = redis.StrictRedis(
+    redis_conn = breaker.Redis(
         host=cache.host,
         port=int(cache.port),
         db=int(cache.db),
-        password=cache.password
+        password=cache.password,
+        **_client_options(cache)
     )
     cache_prefix = 'cache_path:{0}'.format(path or '/')
 
 
+def _nodes(nodes):
+    """(host, port) pairs, out of a list or a comma separated string of
+    `host[:port]`.
+    """
+    if not nodes:
+        return None
+    if isinstance(nodes, compat.basestring):
+        nodes = nodes.split(',')
+    pairs = []
+    for node in nodes:
+        host, _, port = str(node).strip().partition(':')
+        pairs.append((host, int(port or 6379)))
+    return pairs
+
+
 def enable_redis_lru(cache, path):
-    if not cache or not cache.host:
+    if not cache or not (cache.host or cache.nodes):
         logger.warn('LRU cache disabled!')
         return
+    nodes = _nodes(cache.nodes)
     logger.info('Enabling lru cache on Redis')
-    logger.info(
-        'Redis lru host: {0}:{1} (db{2})'.format(cache.host, cache.port,
-                                                 cache.db)
-    )
+    if nodes:
+        logger.info('Redis lru nodes: {0} (db{1})'.format(
+            ', '.join('{0}:{1}'.format(*node) for node in nodes), cache.db))
+    else:
+        logger.info(
+            'Redis lru host: {0}:{1} (db{2})'.format(cache.host, cache.port,
+                                                     cache.db)
+        )
     lru.init(
         host=cache.host,
         port=cache.port,
         db=cache.db,
         password=cache.password,
-        path=path or '/'
+        path=path or '/',
+        nodes=nodes,
+        negative_ttl=(10 if cache.negative_ttl is None
+                      else cache.negative_ttl),
+        **_client_options(cache)
     )
+    policies = cache.policies or {}
+    for name in policies.keys():
+        lru.set_policy(name, **dict((field, policies[name][field])
+                                    for field in policies[name].keys()))
+
+
+def enable_local_lru(cache):
+    if not cache or not cache.local_size:
+        return
+    logger.info('Enabling local lru cache')
+    lru.init_local(size=cache.local_size, ttl=cache.local_ttl or 60,
+                   path=cache.local_path)
+
 
 init()
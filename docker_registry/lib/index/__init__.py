@@ -33,23 +33,21 @@ class Index (object):
 
           {'name': name, 'description': description}
         """
+        seen = set()
         try:
-            namespace_paths = list(
-                store.list_directory(path=store.repositories))
-        except exceptions.FileNotFoundError:
-            namespace_paths = []
-        for namespace_path in namespace_paths:
-            namespace = namespace_path.rsplit('/', 1)[-1]
-            try:
-                repository_paths = list(
-                    store.list_directory(path=namespace_path))
-            except exceptions.FileNotFoundError:
-                repository_paths = []
-            for path in repository_paths:
-                repository = path.rsplit('/', 1)[-1]
-                name = '{0}/{1}'.format(namespace, repository)
+            # repositories/<namespace>/<repository>/<file>
+            for (path, size, mtime) in store.walk(store.repositories):
+                parts = path.split('/')
+                if len(parts) != 4:
+                    continue
+                name = '{0}/{1}'.format(*parts[1:3])
+                if name in seen:
+                    continue
+                seen.add(name)
                 description = None  # TODO(wking): store descriptions
                 yield({'name': name, 'description': description})
+        except exceptions.FileNotFoundError:
+            pass
 
     def _handle_repository_created(
             self, sender, namespace, repository, value):
@@ -210,8 +210,9 @@ def _handle_mirrored_layer(source_resp, layer_path, store, headers):
         for chunk in sr.iterate(store.buffer_size):
             yield chunk
         # FIXME: this could be done outside of the request context
+        size = tmp.tell()
         tmp.seek(0)
-        store.stream_write(layer_path, tmp)
+        store.stream_write(layer_path, tmp, size)
         tmp.close()
     return flask.Response(generate(), headers=dict(headers))
 
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""Which images and tags get pulled the most.
+
+Pulls are counted in Redis (the `cache` one), in sorted sets per time
+window, and unique clients per image are estimated with HyperLogLogs.
+Windows expire on their own, and rankings weigh older windows less.
+
+Each worker buffers its counts and sends them at most every
+`flush_interval` seconds, in a single round trip: counting stays off the
+path of requests as much as possible, and a Redis down only loses counts.
+"""
+
+import collections
+import logging
+import time
+
+import redis
+
+from . import cache
+from . import config
+
+logger = logging.getLogger(__name__)
+
+cfg = config.load()
+
+# Seconds between sends of the buffered counts
+flush_interval = 5
+
+_counts = collections.Counter()
+_clients = {}
+_last_flush = time.time()
+
+
+def _settings():
+    """Window length (seconds), number of windows kept, decay per window."""
+    popularity = cfg.popularity
+    if not popularity:
+        return 3600, 24, 0.8
+    return (int(popularity.window or 3600), int(popularity.windows or 24),
+            float(popularity.decay or 0.8))
+
+
+def enabled():
+    return bool(cfg.popularity and cfg.popularity.enabled and
+                cache.redis_conn is not None)
+
+
+def _window(offset=0):
+    return int(time.time() // _settings()[0]) - offset
+
+
+def counts_key(kind, window):
+    return 'popularity:{0}:{1}'.format(kind, window)
+
+
+def clients_key(image_id, window):
+    return 'popularity:clients:{0}:{1}'.format(image_id, window)
+
+
+def record_image(image_id, client=None):
+    """Count a pull of image_id (its json or layer) by client."""
+    if not enabled():
+        return
+    _counts['image', image_id] += 1
+    if client:
+        _clients.setdefault(image_id, set()).add(client)
+    _maybe_flush()
+
+
+def record_tag(namespace, repository, tag):
+    if not enabled():
+        return
+    _counts['tag', '{0}/{1}:{2}'.format(namespace, repository, tag)] += 1
+    _maybe_flush()
+
+
+def _maybe_flush():
+    if time.time() - _last_flush >= flush_interval:
+        flush()
+
+
+def flush():
+    """Send the buffered counts."""
+    global _counts, _clients, _last_flush
+    counts, clients = _counts, _clients
+    _counts, _clients = collections.Counter(), {}
+    _last_flush = time.time()
+    if not (counts or clients) or cache.redis_conn is None:
+        return
+    length, windows, _ = _settings()
+    window = _window()
+    ttl = length * windows
+    pipe = cache.redis_conn.pipeline(transaction=False)
+    for (kind, name), count in counts.items():
+        pipe.zincrby(counts_key(kind, window), value=name, amount=count)
+    for kind in set(kind for kind, _ in counts):
+        pipe.expire(counts_key(kind, window), ttl)
+    for image_id, addresses in clients.items():
+        pipe.pfadd(clients_key(image_id, window), *addresses)
+        pipe.expire(clients_key(image_id, window), ttl)
+    try:
+        pipe.execute()
+    except redis.exceptions.ConnectionError as e:
+        logger.warning('Popularity counts lost: {0}'.format(e))
+
+
+def _top(kind, n):
+    _, windows, decay = _settings()
+    now = _window()
+    weights = dict((counts_key(kind, now - age), decay ** age)
+                   for age in range(windows))
+    dest = 'popularity:top:{0}'.format(kind)
+    pipe = cache.redis_conn.pipeline(transaction=False)
+    pipe.zunionstore(dest, weights, aggregate='SUM')
+    pipe.zrevrange(dest, 0, n - 1, withscores=True)
+    pipe.delete(dest)
+    return [(name.decode('utf8') if isinstance(name, bytes) else name, score)
+            for name, score in pipe.execute()[1]]
+
+
+def top_images(n=100):
+    """(image id, decayed pull count) of the n most pulled images, most
+    pulled first.
+    """
+    return _top('image', n)
+
+
+def top_tags(n=100):
+    """Same as top_images, for `namespace/repository:tag`."""
+    return _top('tag', n)
+
+
+def unique_clients(image_id):
+    """Estimated count of distinct clients that pulled image_id lately."""
+    _, windows, _ = _settings()
+    now = _window()
+    # redis-py 2.10 pfcount only takes a single key
+    return cache.redis_conn.execute_command(
+        'PFCOUNT', *[clients_key(image_id, now - age)
+                     for age in range(windows)])
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""Statistics of the caches of this worker, to size and tune them.
+
+Served by the `/_stats` endpoint when `stats_endpoint` is set, and logged
+every `stats_log_interval` seconds. Counters are per worker, and since it
+started.
+"""
+
+import logging
+import time
+
+import redis
+
+from docker_registry.core import compat
+from docker_registry.core import lru
+json = compat.json
+
+from .. import storage
+from . import cache
+from . import config
+
+logger = logging.getLogger(__name__)
+
+cfg = config.load()
+
+_last_log = time.time()
+
+# Seconds the endpoint serves the same snapshot for: collecting one asks
+# each Redis node for its INFO
+snapshot_ttl = 10
+_snapshot = (0, None)
+
+
+def _redis(conn):
+    """Circuit breaker and server side counters of a Redis client, or of
+    each node of a sharded one.
+    """
+    if hasattr(conn, 'clients'):
+        return dict((name, _redis(client))
+                    for name, client in zip(conn.names, conn.clients))
+    stats = conn.stats() if hasattr(conn, 'stats') else {}
+    try:
+        info = conn.info('stats')
+    except redis.exceptions.ConnectionError as e:
+        stats['error'] = str(e)
+        return stats
+    for name in ('evicted_keys', 'expired_keys', 'keyspace_hits',
+                 'keyspace_misses'):
+        stats[name] = info.get(name)
+    return stats
+
+
+def collect():
+    """Everything known about the caches, as a dict."""
+    stats = {'lru': lru.stats.snapshot()}
+    if lru.redis_conn is not None:
+        stats['lru_redis'] = _redis(lru.redis_conn)
+    if cache.redis_conn is not None:
+        stats['cache_redis'] = _redis(cache.redis_conn)
+    store = storage.load()
+    if hasattr(store, 'cache_stats'):
+        stats['layer_cache'] = store.cache_stats()
+    if hasattr(store, 'pool_stats'):
+        stats['storage_pool'] = store.pool_stats()
+    return stats
+
+
+def exposed():
+    return bool(cfg.stats_endpoint)
+
+
+def snapshot():
+    """collect(), at most once every `snapshot_ttl` seconds."""
+    global _snapshot
+    collected, stats = _snapshot
+    if stats is None or time.time() - collected >= snapshot_ttl:
+        _snapshot = (time.time(), collect())
+    return _snapshot[1]
+
+
+def summary():
+    """Counters of the lru, per path class, and of the layer cache.
+
+    Without latencies nor what asking Redis would take.
+    """
+    classes = lru.stats.snapshot()['classes']
+    stats = dict((name, dict((event, counters[event])
+                             for event in lru.Stats.events + ('hit_ratio',)
+                             if counters[event]))
+                 for name, counters in classes.items())
+    store = storage.load()
+    if hasattr(store, 'cache_stats'):
+        stats['layer_cache'] = store.cache_stats()
+    return stats
+
+
+def maybe_log():
+    """Log the summary, if it wasn't for `stats_log_interval` seconds."""
+    global _last_log
+    interval = cfg.stats_log_interval
+    if interval is None:
+        interval = 300
+    if not interval or time.time() - _last_log < interval:
+        return
+    _last_log = time.time()
+    logger.info('Cache stats: {0}'.format(json.dumps(summary(),
+                                                     sort_keys=True)))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""Resumable uploads of layers, in chunks sent by separate requests.
+
+The state of an upload (its id in the storage, the offset reached and the
+parts sent) is stored next to the image, so that any worker can take the
+next chunk, and an upload survives restarts. A chunk only moves the offset
+once it is stored: a failed one is sent again, from the same offset. The
+last chunk stored can be sent again too, replacing it (S3 refuses parts
+but the last under 5MB).
+
+The checksum of the layer is computed as chunks come in, by the worker
+that takes them. The state of a sha256 can't be stored, so when chunks
+land on different workers, or one restarted, the layer is read back once
+complete to compute it.
+"""
+
+import collections
+import logging
+
+from docker_registry.core import compat
+from docker_registry.core import exceptions
+json = compat.json
+
+from .. import storage
+from .. import toolkit
+from . import checksums
+
+logger = logging.getLogger(__name__)
+
+store = storage.load()
+
+# Checksums of the uploads in progress in this worker: upload id ->
+# (offset, sha256 of the content up to that offset)
+max_hashes = 1000
+_hashes = collections.OrderedDict()
+
+
+def _remember(upload_id, offset, h):
+    _hashes.pop(upload_id, None)
+    _hashes[upload_id] = (offset, h)
+    while len(_hashes) > max_hashes:
+        _hashes.popitem(last=False)
+
+
+def state(image_id):
+    """State of the upload of image_id's layer, as a dict.
+
+    Raises FileNotFoundError when there is none.
+    """
+    return json.loads(store.get_content(store.image_upload_path(image_id)))
+
+
+def _save(image_id, upload):
+    store.put_content(store.image_upload_path(image_id), json.dumps(upload))
+
+
+def start(image_id):
+    """Start an upload of image_id's layer, dropping any previous one."""
+    abort(image_id)
+    upload = {'id': store.upload_init(store.image_layer_path(image_id)),
+              'offset': 0, 'parts': []}
+    _save(image_id, upload)
+    return upload
+
+
+def last_offset(upload):
+    """Offset the last chunk sent starts at, None if there is none."""
+    if not upload['parts']:
+        return None
+    return upload['offset'] - upload['parts'][-1][1]
+
+
+def append(image_id, upload, json_data, fp, size=None, replace=False):
+    """Store the chunk read from fp after the content sent so far, or in
+    place of the last chunk with `replace`.
+
+    Returns the new state of the upload.
+    """
+    upload_id, parts = upload['id'], upload['parts']
+    if replace:
+        offset = last_offset(upload)
+        number = parts[-1][0]
+        parts = parts[:-1]
+    else:
+        offset = upload['offset']
+        number = len(parts) + 1
+    known = _hashes.get(upload_id)
+    if known is not None and known[0] == offset:
+        h = known[1].copy()
+    elif offset == 0:
+        h, _ = checksums.simple_checksum_handler(json_data)
+    else:
+        # The one we have could match the new offset by chance
+        _hashes.pop(upload_id, None)
+        h = None
+    received = [0]
+
+    def count(buf):
+        received[0] += len(buf)
+        if h is not None:
+            h.update(buf)
+
+    sr = toolkit.PipelinedReader(fp)
+    sr.add_handler(count)
+    try:
+        store.upload_part(store.image_layer_path(image_id), upload_id,
+                          number, offset, sr, size)
+        sr.join()
+    finally:
+        sr.close()
+    upload = dict(upload, offset=offset + received[0],
+                  parts=parts + [[number, received[0]]])
+    _save(image_id, upload)
+    if h is not None:
+        _remember(upload_id, upload['offset'], h)
+    return upload
+
+
+def complete(image_id, upload, json_data):
+    """Move the content sent in place as the layer of image_id.
+
+    Returns its checksum.
+    """
+    layer_path = store.image_layer_path(image_id)
+    store.upload_complete(layer_path, upload['id'],
+                          [number for number, _ in upload['parts']])
+    known = _hashes.pop(upload['id'], None)
+    if known is not None and known[0] == upload['offset']:
+        h = known[1]
+    else:
+        # As long as the layer takes to read, within the request
+        logger.info('Reading back the layer of {0} to checksum it'.format(
+            image_id))
+        h, sum_hndlr = checksums.simple_checksum_handler(json_data)
+        for buf in store.stream_read(layer_path):
+            sum_hndlr(buf)
+    try:
+        store.remove(store.image_upload_path(image_id))
+    except exceptions.FileNotFoundError:
+        pass
+    return 'sha256:{0}'.format(h.hexdigest())
+
+
+def abort(image_id):
+    """Drop the upload of image_id's layer in progress, if any."""
+    try:
+        upload = state(image_id)
+    except exceptions.FileNotFoundError:
+        return
+    _hashes.pop(upload['id'], None)
+    store.upload_abort(store.image_layer_path(image_id), upload['id'])
+    try:
+        store.remove(store.image_upload_path(image_id))
+    except exceptions.FileNotFoundError:
+        pass
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import docker_registry.core.driver as engine
+from docker_registry.core import layercache
 
 import tempfile
 
@@ -36,5 +37,13 @@ def load(kind=None):
     _storage[kind] = engine.fetch(kind)(
         path=cfg.storage_path,
         config=cfg)
+    _storage[kind].layout = engine.fetch_layout(cfg.storage_layout)
+    if isinstance(_storage[kind].layout, engine.ShardedLayout):
+        _storage[kind] = engine.FlatFallback(_storage[kind])
+    if cfg.layer_cache and cfg.layer_cache.path:
+        _storage[kind] = layercache.LayerCache(
+            _storage[kind], cfg.layer_cache.path,
+            int(cfg.layer_cache.size or 10 * 1024 ** 3),
+            eviction=cfg.layer_cache.eviction or 'lru')
 
     return _storage[kind]
@@ -6,7 +6,6 @@ import re
 import time
 
 import flask
-import gevent
 import requests
 
 from docker_registry.core import compat
@@ -17,6 +16,7 @@ from . import storage
 from . import toolkit
 from .app import app
 from .lib import mirroring
+from .lib import popularity
 from .lib import signals
 
 
@@ -74,18 +74,15 @@ def get_properties(namespace, repository):
 
 def get_tags(namespace, repository):
     tag_path = store.tag_path(namespace, repository)
-    greenlets = {}
-    for fname in store.list_directory(tag_path):
+    paths = {}
+    for (fname, size, mtime) in store.walk(tag_path):
         full_tag_name = fname.split('/').pop()
         if not full_tag_name.startswith('tag_'):
             continue
         tag_name = full_tag_name[4:]
-        greenlets[tag_name] = gevent.spawn(
-            store.get_content,
-            store.tag_path(namespace, repository, tag_name),
-        )
-    gevent.joinall(greenlets.values())
-    return dict((k, g.value) for (k, g) in greenlets.items())
+        paths[tag_name] = store.tag_path(namespace, repository, tag_name)
+    contents = store.get_many(paths.values())
+    return dict((k, contents.get(path)) for (k, path) in paths.items())
 
 
 @app.route('/v1/repositories/<path:repository>/tags', methods=['GET'])
@@ -115,6 +112,7 @@ def get_tag(namespace, repository, tag):
         data = store.get_content(tag_path)
     except exceptions.FileNotFoundError:
         return toolkit.api_error('Tag not found', 404)
+    popularity.record_tag(namespace, repository, tag)
     return toolkit.response(data)
 
 
@@ -211,11 +209,10 @@ def put_tag(namespace, repository, tag):
     # Write some meta-data about the repos
     ua = flask.request.headers.get('user-agent', '')
     data = create_tag_json(user_agent=ua)
-    json_path = store.repository_tag_json_path(namespace, repository, tag)
-    store.put_content(json_path, data)
+    items = {store.repository_tag_json_path(namespace, repository, tag): data}
     if tag == "latest":  # TODO(dustinlacewell) : deprecate this for v2
-        json_path = store.repository_json_path(namespace, repository)
-        store.put_content(json_path, data)
+        items[store.repository_json_path(namespace, repository)] = data
+    store.put_many(items)
     return toolkit.response()
 
 
@@ -12,10 +12,13 @@ import time
 import urllib
 
 import flask
+import gevent
+import gevent.queue
 from M2Crypto import RSA
 import requests
 
 from docker_registry.core import compat
+from docker_registry.core import driver
 json = compat.json
 
 from . import storage
@@ -96,6 +99,89 @@ class SocketReader(object):
         return buf
 
 
+class PipelinedReader(object):
+
+    """Reads ahead from fp while what was read gets hashed and stored.
+
+    A greenlet receives chunks from fp, another one runs the handlers
+    (checksums) on them in the threads of the gevent hub (hashlib releases
+    the GIL), while the storage driver reads them. At most `depth` chunks
+    wait between stages: when the storage is slower than the client, fp
+    isn't read anymore and the client waits on its socket.
+
+    Call join() once the driver is done, for the handlers to be, and close()
+    in any case.
+    """
+
+    def __init__(self, fp, depth=None, chunk_size=128 * 1024):
+        self._fp = fp
+        self.handlers = []
+        self._chunk_size = chunk_size
+        depth = depth or cfg.upload_pipeline_depth or 16
+        self._received = gevent.queue.Queue(depth)
+        self._unhashed = gevent.queue.Queue(depth)
+        self._greenlets = []
+        self._reader = driver.StreamReader(self._iterate())
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def _receive(self):
+        try:
+            while True:
+                buf = self._fp.read(self._chunk_size)
+                if not buf:
+                    break
+                self._unhashed.put(buf)
+                self._received.put(buf)
+        except Exception as e:
+            self._received.put(e)
+        finally:
+            self._unhashed.put(None)
+        self._received.put(None)
+
+    def _run_handlers(self, buf):
+        # Errors are returned: gevent's threadpool only prints them
+        try:
+            for handler in self.handlers:
+                handler(buf)
+        except Exception as e:
+            return e
+
+    def _hash(self):
+        threadpool = gevent.get_hub().threadpool
+        error = None
+        for buf in iter(self._unhashed.get, None):
+            # Keeps taking chunks after a failure, for the receiver not to
+            # block
+            if error is None:
+                error = threadpool.apply(self._run_handlers, (buf,))
+        if error is not None:
+            raise error
+
+    def _iterate(self):
+        if not self._greenlets:
+            self._greenlets = [gevent.spawn(self._receive),
+                               gevent.spawn(self._hash)]
+        for buf in iter(self._received.get, None):
+            if isinstance(buf, Exception):
+                raise buf
+            yield buf
+
+    def read(self, n=-1):
+        return self._reader.read(n)
+
+    def join(self):
+        """Wait for the handlers to have seen everything fp had."""
+        # What the driver didn't read still goes through the handlers
+        while self._reader.read(self._chunk_size):
+            pass
+        self._greenlets[1].get()
+
+    def close(self):
+        gevent.killall(self._greenlets)
+
+
 def response(data=None, code=200, headers=None, raw=False):
     if data is None:
         data = True
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""Compare layer download paths of the file storage driver.
+
+ * stream: `Storage.stream_read` chunks written to the socket (copy path)
+ * sendfile: `Storage.open_read` handed over to sendfile (zero-copy path)
+
+Each path pushes the layer (and a byte range of it) through a socket drained
+by a forked reader, and reports throughput and server-side CPU per GB.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import resource
+import shutil
+import socket
+import tempfile
+import time
+
+from docker_registry.core import driver
+
+try:
+    # Python 3.3 has os.sendfile()
+    from os import sendfile
+except ImportError:
+    from gunicorn.http._sendfile import sendfile
+
+
+def drain(sock, peer):
+    pid = os.fork()
+    if pid:
+        return pid
+    peer.close()
+    while sock.recv(1024 * 1024):
+        pass
+    os._exit(0)
+
+
+def send_stream(store, path, sock, bytes_range):
+    for buf in store.stream_read(path, bytes_range):
+        sock.sendall(buf)
+
+
+def send_file(store, path, sock, bytes_range):
+    f = store.open_read(path, bytes_range)
+    try:
+        fileno = f.fileno()
+        offset = os.lseek(fileno, 0, os.SEEK_CUR)
+        if bytes_range:
+            nbytes = bytes_range[1] - bytes_range[0] + 1
+        else:
+            nbytes = os.fstat(fileno).st_size
+        sent = 0
+        while sent < nbytes:
+            sent += sendfile(sock.fileno(), fileno, offset + sent,
+                             min(nbytes - sent, 0x7ffff000))
+    finally:
+        f.close()
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(send, store, path, size, bytes_range, rounds):
+    nbytes = size
+    if bytes_range:
+        nbytes = bytes_range[1] - bytes_range[0] + 1
+    wall = cpu = 0.0
+    for i in range(rounds):
+        server, client = socket.socketpair()
+        pid = drain(client, server)
+        client.close()
+        start, start_cpu = time.time(), cpu_time()
+        send(store, path, server, bytes_range)
+        server.close()
+        os.waitpid(pid, 0)
+        wall += time.time() - start
+        cpu += cpu_time() - start_cpu
+    total = float(nbytes * rounds)
+    return total / wall / 2 ** 20, cpu / (total / 2 ** 30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256,
+                        help='layer size in MB (default: 256)')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='downloads per measurement (default: 5)')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        store = driver.fetch('file')(path=root)
+        path = store.image_layer_path('0' * 64)
+        size = args.size * 2 ** 20
+        chunk = os.urandom(2 ** 20)
+        with open(store._init_path(path, create=True), 'wb') as f:
+            for i in range(args.size):
+                f.write(chunk)
+
+        print('{0:<10}{1:<8}{2:>12}{3:>14}'.format(
+            'path', 'request', 'MB/s', 'CPU s/GB'))
+        for name, bytes_range in (('full', None),
+                                  ('range', (size // 4, size - 1))):
+            for label, send in (('stream', send_stream),
+                                ('sendfile', send_file)):
+                mbps, cpu = run(send, store, path, size, bytes_range,
+                                args.rounds)
+                print('{0:<10}{1:<8}{2:>12.1f}{3:>14.3f}'.format(
+                    label, name, mbps, cpu))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
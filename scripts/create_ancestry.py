@@ -61,21 +61,38 @@ def create_image_ancestry(image_id):
 
 
 def resolve_all_tags():
-    for namespace in store.list_directory(store.repositories):
-        for repos in store.list_directory(namespace):
-            try:
-                for tag in store.list_directory(repos):
-                    fname = tag.split('/').pop()
-                    if not fname.startswith('tag_'):
-                        continue
-                    yield store.get_content(tag)
-            except exceptions.FileNotFoundError:
-                pass
-
-
-def compute_image_checksum(image_id, json_data):
+    # repositories/<namespace>/<repository>/tag_<name>
+    for (tag, size, mtime) in store.walk(store.repositories):
+        parts = tag.split('/')
+        if len(parts) != 4 or not parts[3].startswith('tag_'):
+            continue
+        try:
+            yield store.get_content(tag)
+        except exceptions.FileNotFoundError:
+            pass
+
+
+# What is stored under images/<id>/ (see the image_*_path of the driver)
+image_files = ('json', 'layer', 'ancestry', '_checksum', '_inprogress',
+               '_files', '_diff', '_ancestry_json', '_upload')
+
+
+def list_all_images():
+    """Map every image id to the names of its files, in a single walk."""
+    images = {}
+    # images/<id>/<file>, or images/<shards...>/<id>/<file>. Anything else
+    # (e.g. the parts of resumable uploads, deeper) isn't an image file.
+    for (path, size, mtime) in store.walk(store.images):
+        parts = path.split('/')
+        if len(parts) < 3 or parts[-1] not in image_files:
+            continue
+        images.setdefault(parts[-2], set()).add(parts[-1])
+    return images
+
+
+def compute_image_checksum(image_id, json_data, files):
     layer_path = store.image_layer_path(image_id)
-    if not store.exists(layer_path):
+    if 'layer' not in files:
         warning('{0} is broken (no layer)'.format(image_id))
         return
     print('Writing checksum for {0}'.format(image_id))
@@ -104,18 +121,16 @@ def load_image_json(image_id):
 
 
 def compute_missing_checksums():
-    for image in store.list_directory(store.images):
-        image_id = image.split('/').pop()
+    for (image_id, files) in list_all_images().items():
         if image_id not in ancestry_cache:
             warning('{0} is orphan'.format(image_id))
         json_data = load_image_json(image_id)
         if not json_data:
             continue
-        checksum_path = store.image_checksum_path(image_id)
-        if store.exists(checksum_path):
+        if '_checksum' in files:
             # Checksum already there, skipping
             continue
-        compute_image_checksum(image_id, json_data)
+        compute_image_checksum(image_id, json_data, files)
 
 
 if __name__ == '__main__':
@@ -11,17 +11,13 @@ store = storage.load()
 
 
 def walk_all_tags():
-    for namespace_path in store.list_directory(store.repositories):
-        for repos_path in store.list_directory(namespace_path):
-            try:
-                for tag in store.list_directory(repos_path):
-                    fname = tag.split('/').pop()
-                    if not fname.startswith('tag_'):
-                        continue
-                    (namespace, repos) = repos_path.split('/')[-2:]
-                    yield (namespace, repos, store.get_content(tag))
-            except OSError:
-                pass
+    # repositories/<namespace>/<repository>/tag_<name>
+    for (tag, size, mtime) in store.walk(store.repositories):
+        parts = tag.split('/')
+        if len(parts) != 4 or not parts[3].startswith('tag_'):
+            continue
+        (namespace, repos) = parts[1:3]
+        yield (namespace, repos, store.get_content(tag))
 
 
 def walk_ancestry(image_id):
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""Move images from the flat storage layout to the sharded one.
+
+Run it with `storage_layout: sharded` configured, while the registry is
+serving: files not moved yet are read from the flat layout meanwhile (see
+FlatFallback), so the flat copy of an image is removed as soon as it is
+copied.
+"""
+
+from __future__ import print_function
+
+import sys
+
+from docker_registry.core import driver
+from docker_registry.core import exceptions
+import docker_registry.storage as storage
+
+
+store = storage.load()
+flat = driver.FlatLayout()
+dry_run = True
+
+
+def warning(msg):
+    print('# Warning: ' + msg, file=sys.stderr)
+
+
+def list_flat_images():
+    """Map image ids in the flat layout (images/<id>/<file>) to their
+    files and sizes."""
+    images = {}
+    try:
+        for (path, size, mtime) in store.walk(store.images):
+            parts = path.split('/')
+            if len(parts) != 3:
+                continue
+            images.setdefault(parts[1], {})[parts[2]] = size
+    except exceptions.FileNotFoundError:
+        pass
+    return images
+
+
+def migrate_image(image_id, files):
+    src = flat.image_dir(store, image_id)
+    dst = store.layout.sharded_dir(store, image_id)
+    print('{0} -> {1}'.format(src, dst))
+    if dry_run:
+        return
+    for name in files:
+        src_path = '{0}/{1}'.format(src, name)
+        dst_path = '{0}/{1}'.format(dst, name)
+        if name == 'layer':
+            store.stream_write(dst_path,
+                               driver.StreamReader(
+                                   store.stream_read(src_path)),
+                               files[name])
+        else:
+            store.put_content(dst_path, store.get_content(src_path))
+    store.remove(src)
+
+
+def migrate():
+    for (image_id, files) in list_flat_images().items():
+        if '_inprogress' in files:
+            warning('{0} is being pushed, skipping'.format(image_id))
+            continue
+        if 'json' not in files:
+            warning('{0} is broken (no json), skipping'.format(image_id))
+            continue
+        migrate_image(image_id, files)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--seriously':
+        dry_run = False
+    if not isinstance(store.layout, driver.ShardedLayout):
+        print('Set `storage_layout: sharded` in the configuration first')
+        sys.exit(1)
+    migrate()
+    if dry_run:
+        print('-------')
+        print('/!\ No modification has been made (dry-run)')
+        print('/!\ In order to apply the changes, re-run with:')
+        print('$ {0} --seriously'.format(sys.argv[0]))
+    else:
+        print('# Changes applied.')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""Fill the caches with the most pulled images, and their ancestries.
+
+Run it after a deploy or a Redis flush, with the registry configuration:
+it reads the pull counts kept by the registry (see `popularity` in the
+configuration), then reads the metadata, files listing and layer of each
+of these images, through the same storage (and caches) as the registry.
+
+Usage: warm_cache.py [--top N] [--max-bytes BYTES]
+
+Images are picked hottest first, until their layers reach BYTES (the size
+of the layer cache by default). They are then read coldest first, so that
+the hottest ones are the most recently used entries of every LRU when
+warming is done, and the long tail never evicts them.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from docker_registry.core import compat
+from docker_registry.core import exceptions
+from docker_registry.lib import config
+from docker_registry.lib import layers
+from docker_registry.lib import popularity
+import docker_registry.storage as storage
+
+json = compat.json
+
+store = storage.load()
+cfg = config.load()
+
+
+def warning(msg):
+    print('# Warning: ' + msg, file=sys.stderr)
+
+
+def ancestry(image_id):
+    try:
+        return json.loads(store.get_content(
+            store.image_ancestry_path(image_id)))
+    except exceptions.FileNotFoundError:
+        warning('{0} has no ancestry, skipping'.format(image_id))
+        return []
+
+
+def layer_size(image_id):
+    try:
+        return store.get_size(store.image_layer_path(image_id))
+    except exceptions.FileNotFoundError:
+        return 0
+
+
+def pick(top, max_bytes):
+    """Image ids to warm, hottest first, their layers fitting max_bytes.
+
+    Parents are at least as hot as their hottest child.
+    """
+    picked = []
+    seen = set()
+    total = 0
+    for image_id, _ in popularity.top_images(top):
+        for parent_id in ancestry(image_id):
+            if parent_id in seen:
+                continue
+            seen.add(parent_id)
+            size = layer_size(parent_id)
+            if max_bytes and total + size > max_bytes:
+                return picked
+            total += size
+            picked.append(parent_id)
+    return picked
+
+
+def warm(image_id):
+    for path in (store.image_json_path(image_id),
+                 store.image_ancestry_path(image_id),
+                 store.image_checksum_path(image_id)):
+        try:
+            store.get_content(path)
+        except exceptions.FileNotFoundError:
+            pass
+    try:
+        # Reads the whole layer when the listing isn't cached yet
+        layers.get_image_files_json(image_id)
+        for _ in store.stream_read(store.image_layer_path(image_id)):
+            pass
+    except exceptions.FileNotFoundError:
+        warning('{0} has no layer'.format(image_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm the registry caches')
+    parser.add_argument('--top', type=int, default=100,
+                        help='number of most pulled images to warm')
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help='size of the layers to read at most')
+    args = parser.parse_args()
+    if not popularity.enabled():
+        print('Enable `popularity` and the `cache` Redis in the '
+              'configuration first')
+        sys.exit(1)
+    max_bytes = args.max_bytes
+    if max_bytes is None and cfg.layer_cache and cfg.layer_cache.path:
+        max_bytes = int(cfg.layer_cache.size or 0)
+    images = pick(args.top, max_bytes)
+    for image_id in reversed(images):
+        print(image_id)
+        warm(image_id)
+    print('# {0} images warmed'.format(len(images)))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,11 @@ class TestCache(TestCase):
 
     def setUp(self):
         self.cache = mock.MagicMock(
-            host='localhost', port=1234, db=0, password='pass')
+            host='localhost', port=1234, db=0, password='pass',
+            negative_ttl=10, timeout=1, connect_timeout=0.5,
+            breaker_threshold=5, breaker_reset=10, nodes=None)
+        self.options = dict(socket_timeout=1, socket_connect_timeout=0.5,
+                            threshold=5, reset_timeout=10)
 
     def tearDown(self):
         cache.redis_conn = None
@@ -23,7 +27,7 @@ class TestCache(TestCase):
 
         cache.enable_redis_cache(self.cache, None)
         self.assertTrue(cache.redis_conn is not None)
-        self.assertEqual(type(cache.redis_conn), cache.redis.StrictRedis)
+        self.assertTrue(isinstance(cache.redis_conn, cache.breaker.Redis))
         self.assertTrue(cache.cache_prefix is not None)
         self.assertEqual(cache.cache_prefix, 'cache_path:/')
 
@@ -40,11 +44,21 @@ class TestCache(TestCase):
         self.assertEqual(logger.info.call_count, 2)
         lru_init.assert_called_once_with(
             host=self.cache.host, port=self.cache.port, db=self.cache.db,
-            password=self.cache.password, path='/')
+            password=self.cache.password, path='/', negative_ttl=10,
+            nodes=None, **self.options)
 
         lru_init.reset_mock()
         path = 'test'
         cache.enable_redis_lru(self.cache, path)
         lru_init.assert_called_once_with(
             host=self.cache.host, port=self.cache.port, db=self.cache.db,
-            password=self.cache.password, path=path)
+            password=self.cache.password, path=path, negative_ttl=10,
+            nodes=None, **self.options)
+
+    @mock.patch.object(cache.lru, 'init')
+    def test_enable_redis_lru_nodes(self, lru_init):
+        self.cache.host = None
+        self.cache.nodes = 'redis1, redis2:6380'
+        cache.enable_redis_lru(self.cache, None)
+        self.assertEqual(lru_init.call_args[1]['nodes'],
+                         [('redis1', 6379), ('redis2', 6380)])
@@ -0,0 +1,71 @@
+import mock
+
+from docker_registry.core import breaker
+from docker_registry.lib import cache
+from docker_registry.lib import config
+from docker_registry.lib import popularity
+from tests.base import TestCase
+
+
+class TestPopularity(TestCase):
+
+    def setUp(self):
+        self.redis = breaker.Redis(db=5)
+        self.redis.flushdb()
+        patches = [
+            mock.patch.object(cache, 'redis_conn', self.redis),
+            mock.patch.object(popularity, 'cfg', config.Config(
+                {'popularity': {'enabled': True, 'window': 60,
+                                'windows': 3, 'decay': 0.5}})),
+            mock.patch.object(popularity, 'flush_interval', 3600),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        popularity.flush()
+
+    def tearDown(self):
+        self.redis.flushdb()
+
+    def test_disabled(self):
+        popularity.cfg = config.Config({})
+        popularity.record_image('foo', '10.0.0.1')
+        popularity.flush()
+        self.assertEqual(self.redis.keys('*'), [])
+
+    def test_top_images(self):
+        for client in ['10.0.0.1', '10.0.0.2', '10.0.0.2']:
+            popularity.record_image('foo', client)
+        popularity.record_image('bar', '10.0.0.1')
+        # Buffered until flushed
+        self.assertEqual(popularity.top_images(), [])
+        popularity.flush()
+        self.assertEqual(popularity.top_images(),
+                         [('foo', 3.0), ('bar', 1.0)])
+        self.assertEqual(popularity.top_images(1), [('foo', 3.0)])
+        self.assertEqual(popularity.unique_clients('foo'), 2)
+        self.assertTrue(self.redis.ttl(
+            popularity.counts_key('image', popularity._window())) > 0)
+
+    def test_decay(self):
+        self.redis.zincrby(popularity.counts_key(
+            'image', popularity._window(1)), value='old', amount=4)
+        self.redis.zincrby(popularity.counts_key(
+            'image', popularity._window(3)), value='gone', amount=100)
+        popularity.record_image('new')
+        popularity.record_image('new')
+        popularity.flush()
+        # The window before is worth half, the one before that is gone
+        self.assertEqual(dict(popularity.top_images()),
+                         {'new': 2.0, 'old': 2.0})
+
+    def test_top_tags(self):
+        popularity.record_tag('library', 'ubuntu', 'latest')
+        popularity.flush()
+        self.assertEqual(popularity.top_tags(),
+                         [('library/ubuntu:latest', 1.0)])
+
+    def test_redis_down(self):
+        cache.redis_conn = breaker.Redis(port=1, socket_connect_timeout=0.1)
+        popularity.record_image('foo', '10.0.0.1')
+        popularity.flush()
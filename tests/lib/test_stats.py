@@ -0,0 +1,45 @@
+import mock
+
+from docker_registry.core import compat
+from docker_registry.core import lru
+from docker_registry.lib import stats
+from tests.base import TestCase
+json = compat.json
+
+
+class TestStats(TestCase):
+
+    def test_endpoint(self):
+        resp = self.http_client.get('/_stats')
+        self.assertEqual(resp.status_code, 404, resp.data)
+        lru.stats.reset()
+        lru.stats.count('hits', 'image_json')
+        with mock.patch.object(stats, 'cfg',
+                               mock.MagicMock(stats_endpoint=True)):
+            with mock.patch.object(stats, '_snapshot', (0, None)):
+                resp = self.http_client.get('/_stats')
+                self.assertEqual(resp.status_code, 200, resp.data)
+                data = json.loads(resp.data)
+                self.assertEqual(
+                    data['lru']['classes']['image_json']['hits'], 1)
+                # Served from the snapshot for a while
+                lru.stats.count('hits', 'image_json')
+                resp = self.http_client.get('/_stats')
+                data = json.loads(resp.data)
+                self.assertEqual(
+                    data['lru']['classes']['image_json']['hits'], 1)
+
+    @mock.patch.object(stats, 'cfg', mock.MagicMock(stats_log_interval=0))
+    @mock.patch.object(stats, 'logger')
+    def test_log(self, logger):
+        lru.stats.reset()
+        lru.stats.count('misses', 'tag')
+        stats.maybe_log()
+        self.assertEqual(logger.info.call_count, 0)
+        stats.cfg.stats_log_interval = 60
+        stats._last_log = 0
+        stats.maybe_log()
+        stats.maybe_log()
+        self.assertEqual(logger.info.call_count, 1)
+        self.assertTrue('"tag": {"misses": 1}' in
+                        logger.info.call_args[0][0])
@@ -5,9 +5,6 @@ from docker_registry import testing
 # Mock any boto
 from docker_registry.testing import mock_boto  # noqa
 
-# Mock our s3 - xxx this smells like byte-range support is questionnable...
-from . import mock_s3   # noqa
-
 
 def getinit(name):
     def init(self):
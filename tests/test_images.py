@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import random
 
+import mock
+
 import base
 
 from docker_registry.core import compat
 import docker_registry.images as images
+import docker_registry.lib.uploads as uploads
 import docker_registry.lib.signals as signals
 
 json = compat.json
@@ -61,6 +65,99 @@ class TestImages(base.TestCase):
         self.assertEqual(ancestry[0], image_id)
         self.assertEqual(ancestry[1], parent_id)
 
+    def test_ancestry_json(self):
+        image_id = self.gen_hex_string()
+        parent_id = self.gen_hex_string()
+        self.upload_image(parent_id, parent_id=None, layer='a' * 1024)
+        self.upload_image(image_id, parent_id=parent_id, layer='b' * 512)
+        url = '/v1/images/{0}/ancestry/json'.format(image_id)
+        cached = images.store.image_ancestry_json_path(image_id)
+        # Incomplete ancestries aren't kept
+        checksum_path = images.store.image_checksum_path(parent_id)
+        checksum = images.store.get_content(checksum_path)
+        images.store.remove(checksum_path)
+        resp = self.http_client.get(url)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(json.loads(resp.data)[1]['checksums'], None)
+        self.assertFalse(images.store.exists(cached))
+        images.store.put_content(checksum_path, checksum)
+        # Failing to keep it doesn't fail the response
+        with mock.patch.object(images.store, 'put_content',
+                               side_effect=IOError('Disk full')):
+            resp = self.http_client.get(url)
+            # Streamed as it is read
+            self.assertEqual(resp.status_code, 200, resp.data)
+            self.assertEqual(len(json.loads(resp.data)), 2)
+        self.assertFalse(images.store.exists(cached))
+        self.assertNotIn('ETag', resp.headers)
+        for _ in range(2):
+            # Assembled, then from what was kept
+            resp = self.http_client.get(url)
+            self.assertEqual(resp.status_code, 200, resp.data)
+            entries = json.loads(resp.data)
+            self.assertEqual([entry['id'] for entry in entries],
+                             [image_id, parent_id])
+            self.assertEqual([entry['size'] for entry in entries],
+                             [512, 1024])
+            self.assertEqual(json.loads(entries[1]['json']),
+                             {'id': parent_id})
+            self.assertEqual(len(entries[0]['checksums']), 1)
+            self.assertTrue(images.store.exists(cached))
+        self.assertIn('ETag', resp.headers)
+        resp = self.http_client.get('/v1/images/{0}/ancestry/json'.format(
+            self.gen_hex_string()))
+        self.assertEqual(resp.status_code, 404, resp.data)
+
+    def test_ancestry_json_layer_urls(self):
+        # More than a batch
+        ids = [self.gen_hex_string() for _ in range(12)]
+        for image_id, parent_id in reversed(zip(ids, ids[1:] + [None])):
+            self.upload_image(image_id, parent_id=parent_id, layer='a')
+        urls = ['http://s3/' + images.store.image_layer_path(i) for i in ids]
+        url = '/v1/images/{0}/ancestry/json?layer_urls=true'.format(ids[0])
+        cached = images.store.image_ancestry_json_path(ids[0])
+        with mock.patch.object(images.cfg, 'storage_redirect', True,
+                               create=True):
+            with mock.patch.object(
+                    images.store, 'content_redirect_url',
+                    side_effect=lambda path: 'http://s3/' + path):
+                for _ in range(2):
+                    # Assembled, then from what was kept
+                    resp = self.http_client.get(url)
+                    self.assertEqual(resp.status_code, 200, resp.data)
+                    self.assertEqual([entry['layer_url'] for entry
+                                      in json.loads(resp.data)], urls)
+                    # URLs expire, they aren't kept
+                    self.assertFalse(any(
+                        'layer_url' in entry for entry
+                        in json.loads(images.store.get_content(cached))))
+
+    def test_conditional_get(self):
+        image_id = self.gen_hex_string()
+        self.upload_image(image_id, parent_id=None, layer='a' * 1024)
+        for name in ('json', 'layer', 'ancestry'):
+            url = '/v1/images/{0}/{1}'.format(image_id, name)
+            resp = self.http_client.get(url)
+            self.assertEqual(resp.status_code, 200, resp.data)
+            etag = resp.headers['ETag']
+            resp = self.http_client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304, name)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.data, '')
+            resp = self.http_client.get(url, headers={
+                'If-None-Match': '"other"',
+                'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+            self.assertEqual(resp.status_code, 200, name)
+        url = '/v1/images/{0}/json'.format(image_id)
+        resp = self.http_client.get(url, headers={
+            'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 304, resp.data)
+        # Not there: no 304
+        resp = self.http_client.get(
+            '/v1/images/{0}/json'.format(self.gen_hex_string()),
+            headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 404, resp.data)
+
     def test_notfound(self):
         resp = self.http_client.get('/v1/images/{0}/json'.format(
             self.gen_random_string()))
@@ -81,6 +178,159 @@ class TestImages(base.TestCase):
                                                     len(received_data))
         self.assertEqual(expected_data, received_data, msg)
 
+    def test_multiple_bytes_ranges(self):
+        image_id = self.gen_hex_string()
+        layer_data = self.gen_random_string(1024)
+        self.upload_image(image_id, parent_id=None, layer=layer_data)
+        url = '/v1/images/{0}/layer'.format(image_id)
+        # Adjacent and overlapping ranges are coalesced
+        resp = self.http_client.get(url, headers={
+            'Range': 'bytes=900-, 0-9,10-19 ,15-29, -10'})
+        self.assertEqual(resp.status_code, 206, resp.data)
+        content_type = resp.headers['Content-Type']
+        self.assertTrue(content_type.startswith(
+            'multipart/byteranges; boundary='))
+        boundary = content_type.split('=', 1)[1]
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+        parts = resp.data.split('--{0}'.format(boundary))
+        self.assertEqual(parts[0], '')
+        self.assertEqual(parts[-1], '--\r\n')
+        self.assertEqual(parts[1:-1], [
+            '\r\nContent-Type: application/octet-stream\r\n'
+            'Content-Range: bytes 0-29/1024\r\n\r\n' +
+            layer_data[:30] + '\r\n',
+            '\r\nContent-Type: application/octet-stream\r\n'
+            'Content-Range: bytes 900-1023/1024\r\n\r\n' +
+            layer_data[900:] + '\r\n'])
+
+    def test_suffix_bytes_range(self):
+        image_id = self.gen_hex_string()
+        layer_data = self.gen_random_string(1024)
+        self.upload_image(image_id, parent_id=None, layer=layer_data)
+        url = '/v1/images/{0}/layer'.format(image_id)
+        resp = self.http_client.get(url, headers={'Range': 'bytes=-100'})
+        self.assertEqual(resp.status_code, 206, resp.data)
+        self.assertEqual(resp.headers['Content-Range'],
+                         'bytes 924-1023/1024')
+        self.assertEqual(resp.data, layer_data[-100:])
+        resp = self.http_client.get(url, headers={'Range': 'bytes=2048-'})
+        self.assertEqual(resp.status_code, 416, resp.data)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */1024')
+        # Malformed, or of another version of the layer: all of it
+        for headers in ({'Range': 'bytes=10-5'},
+                        {'Range': 'bytes=0-9', 'If-Range': '"other"'}):
+            resp = self.http_client.get(url, headers=headers)
+            self.assertEqual(resp.status_code, 200, resp.data)
+            self.assertEqual(resp.data, layer_data)
+
+    def test_layer_mmap(self):
+        image_id = self.gen_hex_string()
+        layer_data = self.gen_random_string(1024)
+        self.upload_image(image_id, parent_id=None, layer=layer_data)
+        url = '/v1/images/{0}/layer'.format(image_id)
+        images.store._maps.clear()
+        with mock.patch.object(images.store, '_mmap', True):
+            resp = self.http_client.get(url)
+            self.assertEqual(resp.status_code, 200, resp.data)
+            self.assertEqual(resp.data, layer_data)
+            resp = self.http_client.get(url, headers={
+                'Range': 'bytes=0-9,100-109'})
+            self.assertEqual(resp.status_code, 206, resp.data)
+            self.assertTrue(layer_data[100:110] in resp.data)
+            # Sent with sendfile, the maps are for reads within the registry
+            self.assertEqual(len(images.store._maps), 0)
+            layer_path = images.store.image_layer_path(image_id)
+            self.assertEqual(''.join(
+                str(buf) for buf in images.store.stream_read(layer_path)),
+                layer_data)
+            self.assertEqual(len(images.store._maps), 1)
+
+    def _start_upload(self, layer_data):
+        image_id = self.gen_hex_string()
+        json_data = json.dumps({'id': image_id})
+        resp = self.http_client.put('/v1/images/{0}/json'.format(image_id),
+                                    data=json_data)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        url = '/v1/images/{0}/layer/upload'.format(image_id)
+        resp = self.http_client.post(url)
+        self.assertEqual(resp.status_code, 201, resp.data)
+        checksum = 'sha256:{0}'.format(
+            hashlib.sha256(json_data + '\n' + layer_data).hexdigest())
+        return image_id, url, checksum
+
+    def test_resumable_upload(self):
+        for forget in (False, True):
+            layer_data = self.gen_random_string(1024)
+            image_id, url, checksum = self._start_upload(layer_data)
+            offset = 0
+            for chunk in (layer_data[:300], layer_data[300:1000],
+                          layer_data[1000:]):
+                resp = self.http_client.put(
+                    '{0}?offset={1}'.format(url, offset), data=chunk)
+                self.assertEqual(resp.status_code, 200, resp.data)
+                offset += len(chunk)
+                self.assertEqual(json.loads(resp.data), {'offset': offset})
+                if forget:
+                    # Next chunk on another worker
+                    uploads._hashes.clear()
+            resp = self.http_client.post(url + '/complete')
+            self.assertEqual(resp.status_code, 200, resp.data)
+            # Same checksum as when pushed in one go
+            self.set_image_checksum(image_id, checksum)
+            resp = self.http_client.get(
+                '/v1/images/{0}/layer'.format(image_id))
+            self.assertEqual(resp.data, layer_data)
+            resp = self.http_client.get(url)
+            self.assertEqual(resp.status_code, 404, resp.data)
+
+    def test_resumable_upload_offset(self):
+        layer_data = self.gen_random_string(1024)
+        image_id, url, _ = self._start_upload(layer_data)
+        resp = self.http_client.put(url + '?offset=0', data=layer_data[:500])
+        self.assertEqual(resp.status_code, 200, resp.data)
+        # Resumed from the wrong offset: told where to resume from
+        resp = self.http_client.put(url + '?offset=200', data=layer_data)
+        self.assertEqual(resp.status_code, 416, resp.data)
+        self.assertEqual(resp.headers['X-Docker-Upload-Offset'], '500')
+        resp = self.http_client.get(url)
+        self.assertEqual(json.loads(resp.data), {'offset': 500})
+        # Nothing shows up until completed
+        resp = self.http_client.get('/v1/images/{0}/layer'.format(image_id))
+        self.assertEqual(resp.status_code, 400, resp.data)
+        resp = self.http_client.delete(url)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        resp = self.http_client.put(url + '?offset=500', data=layer_data)
+        self.assertEqual(resp.status_code, 404, resp.data)
+        resp = self.http_client.post(url)
+        resp = self.http_client.post(url + '/complete')
+        self.assertEqual(resp.status_code, 400, resp.data)
+
+    def test_resumable_upload_short_chunk(self):
+        layer_data = self.gen_random_string(1024)
+        image_id, url, checksum = self._start_upload(layer_data)
+        with mock.patch.object(images.store, 'upload_min_part', 100):
+            resp = self.http_client.put(url + '?offset=0',
+                                        data=layer_data[:50])
+            self.assertEqual(resp.status_code, 200, resp.data)
+            # A chunk can't follow a short one: sent again, with more
+            resp = self.http_client.put(url + '?offset=50',
+                                        data=layer_data[50:300])
+            self.assertEqual(resp.status_code, 400, resp.data)
+            self.assertEqual(resp.headers['X-Docker-Upload-Offset'], '0')
+            for offset, end in ((0, 300), (300, 350), (300, 1024)):
+                resp = self.http_client.put(
+                    '{0}?offset={1}'.format(url, offset),
+                    data=layer_data[offset:end])
+                self.assertEqual(resp.status_code, 200, resp.data)
+                self.assertEqual(json.loads(resp.data), {'offset': end})
+        self.assertEqual(uploads.state(image_id)['parts'],
+                         [[1, 300], [2, 724]])
+        resp = self.http_client.post(url + '/complete')
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.set_image_checksum(image_id, checksum)
+        resp = self.http_client.get('/v1/images/{0}/layer'.format(image_id))
+        self.assertEqual(resp.data, layer_data)
+
     def before_put_image_json_handler_ok(self, sender, image_json):
         return None
 
@@ -1,18 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import os
 import StringIO
 import sys
 import time
 
+import gevent
 from nose import tools
 
 from docker_registry.core import exceptions
+from docker_registry.core import lru
 import docker_registry.testing as testing
 
 from docker_registry.testing import mock_boto  # noqa
 
-from . import mock_s3   # noqa
-
 
 class StringIOWithError(StringIO.StringIO):
     '''Throw IOError after reaching EOF.'''
@@ -23,6 +24,16 @@ class StringIOWithError(StringIO.StringIO):
         return StringIO.StringIO.read(self, size)
 
 
+class ShortReads(object):
+    '''Return at most 1MB per read, as a socket may.'''
+
+    def __init__(self, content):
+        self._io = StringIO.StringIO(content)
+
+    def read(self, size):
+        return self._io.read(min(size, 1024 * 1024))
+
+
 class TestDriver(testing.Driver):
     '''Extra tests for coverage completion.'''
     def __init__(self):
@@ -64,7 +75,8 @@ class TestDriver(testing.Driver):
             self._storage.stream_write(filename, io)
         except IOError:
             pass
-        assert self._storage.exists(filename)
+        # The failed upload was aborted, no partial content
+        assert not self._storage.exists(filename)
         # Test that EOFed io string throws IOError on lib/storage/s3
         try:
             self._storage.stream_write(filename, io)
@@ -72,10 +84,148 @@ class TestDriver(testing.Driver):
             pass
         # Cleanup
         io.close()
-        self._storage.remove(filename)
         self._storage.buffer_size = 5 * 1024 * 1024
         assert not self._storage.exists(filename)
 
+    def test_stream_write_concurrent(self):
+        self._storage._upload_concurrency = 3
+        filename = self.gen_random_string()
+        # 4 parts of 5MB, the last one short
+        content = os.urandom(17 * 1024 * 1024)
+        self._storage.stream_write(filename, StringIO.StringIO(content))
+        assert self._storage.get_content(filename) == content
+        self._storage.remove(filename)
+
+    def test_stream_write_small(self):
+        filename = self.gen_random_string()
+        content = os.urandom(2048)
+        # Hold a connection, so that stream_write uses the patched bucket
+        with self._storage._pool.connection() as bucket:
+            bucket.initiate_multipart_upload = None
+            # Single PUT, with or without a size hint
+            for size in (None, len(content)):
+                self._storage.stream_write(
+                    filename, StringIO.StringIO(content), size)
+                assert self._storage.get_content(filename) == content
+            self._storage.stream_write(filename, StringIO.StringIO(''))
+            assert self._storage.get_content(filename) == ''
+            del bucket.initiate_multipart_upload
+        self._storage.remove(filename)
+
+    def test_stream_write_short_reads(self):
+        filename = self.gen_random_string()
+        parts = []
+        upload_part = self._storage._upload_part
+
+        def spy(path, upload_id, buf, num_part):
+            parts.append(len(buf))
+            return upload_part(path, upload_id, buf, num_part)
+        self._storage._upload_part = spy
+        # Parts are filled up: the first read doesn't pass for the whole
+        # content, nor make parts too small for S3
+        content = os.urandom(12 * 1024 * 1024)
+        self._storage.stream_write(filename, ShortReads(content))
+        assert self._storage.get_content(filename) == content
+        assert parts == [5 * 1024 * 1024, 5 * 1024 * 1024, 2 * 1024 * 1024]
+        self._storage.remove(filename)
+
+    def test_stream_write_size(self):
+        filename = self.gen_random_string()
+        content = os.urandom(6 * 1024 * 1024)
+        self._storage.stream_write(filename, StringIO.StringIO(content),
+                                   len(content))
+        assert self._storage.get_content(filename) == content
+        self._storage.remove(filename)
+
+    def test_upload_retry(self):
+        filename = self.gen_random_string()
+        upload_id = self._storage.upload_init(filename)
+        self._storage.upload_part(filename, upload_id, 1, 0,
+                                  StringIO.StringIO('0123456789'))
+        # Sending a part again replaces it
+        self._storage.upload_part(filename, upload_id, 2, 10,
+                                  StringIO.StringIO('abc'))
+        self._storage.upload_part(filename, upload_id, 2, 10,
+                                  StringIO.StringIO('abcdef'))
+        self._storage.upload_complete(filename, upload_id, [1, 2])
+        assert self._storage.get_content(filename) == '0123456789abcdef'
+        self._storage.remove(filename)
+
+    def test_pool(self):
+        pool = self._storage._pool
+        stats = pool.stats()
+        with pool.connection() as bucket:
+            # Nested checkouts share the connection
+            with pool.connection() as nested:
+                assert nested is bucket
+            assert pool.stats()['in_use'] == stats['in_use'] + 1
+        assert pool.stats()['in_use'] == stats['in_use']
+        # Keep-alive: the connection is handed out again
+        with pool.connection() as again:
+            assert again is bucket
+        try:
+            with pool.connection():
+                raise IOError('Connection reset by peer')
+        except IOError:
+            pass
+        with pool.connection() as other:
+            assert other is not bucket
+        assert pool.stats()['broken'] == stats['broken'] + 1
+
+    def test_pool_not_held(self):
+        pool = self._storage._pool
+        in_use = pool.stats()['in_use']
+        filename = self.gen_random_string()
+        self._storage.put_content(filename, 'foo')
+        # Suspended generators don't hold connections
+        for stream in (self._storage.stream_read(filename),
+                       self._storage.list_directory(),
+                       self._storage.walk()):
+            stream.next()
+            assert pool.stats()['in_use'] == in_use
+            stream.close()
+        # Nor do concurrent part uploads share one
+        buckets = set()
+        multipart = self._storage._multipart
+
+        def spy(*args):
+            mp = multipart(*args)
+            buckets.add(mp.bucket)
+            # Let the other parts start meanwhile
+            gevent.sleep(0.01)
+            return mp
+        self._storage._multipart = spy
+        self._storage._upload_concurrency = 3
+        content = os.urandom(11 * 1024 * 1024)
+        self._storage.stream_write(filename, StringIO.StringIO(content))
+        assert self._storage.get_content(filename) == content
+        assert len(buckets) == 3
+        assert pool.stats()['in_use'] == in_use
+        assert self._storage._boto_conn is not None
+        self._storage.remove(filename)
+
+    def test_stream_read_key(self):
+        if self._storage._read_ahead:
+            return
+        filename = self.gen_random_string()
+        content = os.urandom(300 * 1024)
+        self._storage.put_content(filename, content)
+        # A single GET, read a buffer at a time
+        self._storage.buffer_size = 128 * 1024
+        chunks = list(self._storage.stream_read(filename))
+        sizes = [len(buf) for buf in chunks]
+        assert sizes == [128 * 1024, 128 * 1024, 44 * 1024]
+        assert ''.join(chunks) == content
+        data = ''.join(self._storage.stream_read(filename, (1000, 200000)))
+        assert data == content[1000:200001]
+        self._storage.remove(filename)
+        try:
+            next(self._storage.stream_read(filename))
+        except exceptions.FileNotFoundError:
+            pass
+        else:
+            assert False
+
     def test_init_path(self):
         # s3 storage _init_path result keys are relative (no / at start)
         root_path = self._storage._root_path
@@ -173,3 +323,48 @@ class TestDriver(testing.Driver):
         self._storage.makeKey = lambda x: mockKey
 
         self._storage.get_content("/FOO")
+
+    def test_negative_cache(self):
+        lru.init()
+        try:
+            filename = self.gen_random_string()
+            for _ in range(2):
+                startTime = time.time()
+                try:
+                    self._storage.get_content(filename)
+                except exceptions.FileNotFoundError:
+                    pass
+                else:
+                    assert False
+            # Only the first miss went through the retries
+            assert time.time() - startTime < 0.1
+            assert not self._storage.exists(filename)
+            self._storage.put_content(filename, 'foo')
+            assert self._storage.exists(filename)
+            self._storage.remove(filename)
+            assert not self._storage.exists(filename)
+            self._storage.stream_write(filename, StringIO.StringIO('foo'))
+            assert self._storage.get_content(filename) == 'foo'
+        finally:
+            lru.init(enable=False)
+
+
+class TestDriverReadAhead(TestDriver):
+    '''Same tests, with parallel read-ahead enabled on stream_read.'''
+    def __init__(self):
+        self.scheme = 's3'
+        self.path = ''
+        self.config = testing.Config({'boto_read_ahead': 3,
+                                      'boto_read_ahead_chunk': 1000})
+
+    def test_stream_read_ahead(self):
+        filename = self.gen_random_string()
+        content = self.gen_random_string(10 * 1000 + 1).encode('utf8')
+        self._storage.put_content(filename, content)
+        assert ''.join(self._storage.stream_read(filename)) == content
+        # Ranges start and end in the middle of chunks
+        for bytes_range in ((0, 0), (500, 2499), (999, 1000),
+                            (9500, 10000), (9500, 20000)):
+            data = ''.join(self._storage.stream_read(filename, bytes_range))
+            assert data == content[bytes_range[0]:bytes_range[1] + 1]
+        self._storage.remove(filename)
@@ -1,9 +1,31 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import os
 import unittest
 
+import gevent
+
+from docker_registry.core import compat
 from docker_registry import toolkit
 
 
+class CountingReader(object):
+
+    def __init__(self, data):
+        self._fp = compat.StringIO(data)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self._fp.read(size)
+
+
+class FailingReader(object):
+
+    def read(self, size=-1):
+        raise IOError('Client went away')
+
+
 class TestToolkit(unittest.TestCase):
 
     def test_resolve_repository_name_good(self):
@@ -84,3 +106,52 @@ class TestToolkit(unittest.TestCase):
             hostname, image = toolkit.resolve_repository_name(repo['name'])
             self.assertEqual(hostname, repo['expected_hostname'])
             self.assertEqual(image, repo['expected_image'])
+
+    def test_pipelined_reader(self):
+        content = os.urandom(1000 * 1000)
+        h = hashlib.sha256()
+        sr = toolkit.PipelinedReader(compat.StringIO(content), depth=2,
+                                     chunk_size=1000)
+        sr.add_handler(h.update)
+        try:
+            # Sizes asked by drivers don't depend on the chunks received
+            data = sr.read(5 * 1000 + 1)
+            self.assertEqual(len(data), 5 * 1000 + 1)
+            data += sr.read()
+            self.assertEqual(sr.read(10), compat.bytes())
+            sr.join()
+        finally:
+            sr.close()
+        self.assertEqual(data, content)
+        self.assertEqual(h.hexdigest(), hashlib.sha256(content).hexdigest())
+
+    def test_pipelined_reader_backpressure(self):
+        fp = CountingReader(os.urandom(100 * 1000))
+        sr = toolkit.PipelinedReader(fp, depth=2, chunk_size=1000)
+        try:
+            sr.read(1000)
+            # The storage is stuck: the client isn't read anymore
+            gevent.sleep(0.1)
+            self.assertTrue(fp.reads < 10, fp.reads)
+            sr.join()
+        finally:
+            sr.close()
+        self.assertEqual(fp.reads, 101)
+
+    def test_pipelined_reader_errors(self):
+        sr = toolkit.PipelinedReader(FailingReader())
+        try:
+            self.assertRaises(IOError, sr.read, 10)
+        finally:
+            sr.close()
+
+        def fail(buf):
+            raise ValueError('Bad chunk')
+        sr = toolkit.PipelinedReader(compat.StringIO(os.urandom(10 * 1000)),
+                                     depth=1, chunk_size=1000)
+        sr.add_handler(fail)
+        try:
+            self.assertEqual(len(sr.read()), 10 * 1000)
+            self.assertRaises(ValueError, sr.join)
+        finally:
+            sr.close()